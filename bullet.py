@@ -1,9 +1,12 @@
 import pygame as pg
 
 from math import dist
-from typing import List
+from typing import Dict, List
 
 class Bullet:
+    COLOR = (255, 255, 0)
+    SPRITES: Dict[int, pg.Surface] = {} # radius -> filled circle, shared by every bullet
+
     def __init__(self, parent: any, x: float, y: float, velocity: List[float], base_damage: int, damage_growth: float,
                  poison_damage: int, penetration: float, lifesteal: float, bullet_img: pg.Surface) -> None:
 
@@ -24,6 +27,8 @@ class Bullet:
 
         self.image = bullet_img
 
+        self.rewind = 0.0 # seconds the host rewinds targets by when checking this bullet's hits, the shooter's view delay
+
     @property
     def distance_travelled(self) -> float:
         return dist((self.x, self.y), (self.start_x, self.start_y))
@@ -57,7 +62,35 @@ class Bullet:
         if not pg.Rect(self.x - self.image.width // 2, self.y - self.image.height // 2, self.image.width, self.image.height).colliderect(screen_rect): return
 
         #screen.blit(self.image, (self.x - self.image.width // 2 - screen_rect.x, self.y - self.image.height // 2 - screen_rect.y))
-        pg.draw.circle(screen, (255, 255, 0), (self.x - screen_rect.x, self.y - screen_rect.y), self.health_damage / 1.75)
+        pg.draw.circle(screen, self.COLOR, (self.x - screen_rect.x, self.y - screen_rect.y), self.health_damage / 1.75)
+
+    @classmethod
+    def sprite(cls, radius: int) -> pg.Surface:
+        if radius not in cls.SPRITES:
+            sprite = pg.Surface((radius * 2, radius * 2), pg.SRCALPHA)
+            pg.draw.circle(sprite, cls.COLOR, (radius, radius), radius)
+            cls.SPRITES[radius] = sprite
+
+        return cls.SPRITES[radius]
+
+    @classmethod
+    def draw_all(cls, screen: pg.Surface, bullets: List["Bullet"], draw_parent: any) -> None:
+        """draw for a whole list of bullets. They are culled against the screen in one collidelistall,
+        only the visible ones work out their damage and they go out as cached sprites in one fblits"""
+        if len(bullets) == 0: return
+
+        width, height = bullets[0].image.width, bullets[0].image.height
+        screen_rect = pg.Rect(draw_parent.x - screen.width // 2 + width // 2, draw_parent.y - screen.height // 2 + height // 2, screen.width, screen.height)
+
+        blits = []
+        for i in screen_rect.collidelistall([(bullet.x - width // 2, bullet.y - height // 2, width, height) for bullet in bullets]):
+            bullet = bullets[i]
+            radius = int(bullet.health_damage / 1.75) # pg.draw.circle truncates too
+            if radius < 1: continue
+
+            blits.append((cls.sprite(radius), (bullet.x - screen_rect.x - radius, bullet.y - screen_rect.y - radius)))
+
+        screen.fblits(blits)
 
     def hit(self, target: any) -> float:
         health_damage = self.health_damage
@@ -0,0 +1,81 @@
+import json
+import zlib
+
+from random import Random
+from time import perf_counter
+
+from networking import BaseClient, message_type
+
+NUM_MESSAGES = 2000
+
+def sample_messages(rng: Random) -> dict[str, object]:
+    """Generators for typical messages, keyed by message type"""
+    def player_update() -> dict:
+        return {"answer": {"player_update": [{
+            "x": rng.uniform(0, 30000), "y": rng.uniform(0, 30000), "index": i, "rotation": rng.choice((0, 90, 180, 270)),
+            "max_hp": 100, "max_shield": 100, "max_speed": 15, "damage": 8, "firerate": 1.3, "bullet_speed": 10.0, "penetration": 1.2,
+            "shield_regen_rate": 1.0, "lifesteal": 1.0, "poison_damage": 0, "zone_resistance": 1.0, "health_regen_rate": 1.2,
+            "damage_growth": 0.0, "hp": rng.uniform(0, 100), "shield": rng.uniform(0, 100)
+        } for i in range(100)], "t": 1700000000.0 + rng.random()}}
+
+    def set_bullets() -> dict:
+        return {"answer": {"set_bullets": [{
+            "x": rng.uniform(0, 30000), "y": rng.uniform(0, 30000), "velocity": [0, -rng.uniform(40, 90)], "damage": 8, "parent_index": rng.randrange(100)
+        } for _ in range(rng.randrange(1, 20))]}}
+
+    def player_input() -> dict:
+        seq = rng.randrange(100000)
+        return {"answer": {"player_input": {"index": 1, "inputs": [[seq + i, rng.choice("urdl"), rng.randrange(2), 0.0167] for i in range(2)]}}}
+
+    def input_ack() -> dict:
+        return {"answer": {"input_ack": {"seq": rng.randrange(100000), "x": rng.uniform(0, 30000), "y": rng.uniform(0, 30000), "rotation": 90}}}
+
+    def powerups_picked() -> dict:
+        return {"answer": {"powerups_picked": [[rng.randrange(720), rng.randrange(1, 3)] for _ in range(rng.randrange(1, 4))]}}
+
+    return {"player_update": player_update, "set_bullets": set_bullets, "player_input": player_input, "input_ack": input_ack, "powerups_picked": powerups_picked}
+
+def bench_oneshot(messages: list[dict]) -> tuple[float, int]:
+    """The old encoding: a fresh zlib.compress/decompress per message"""
+    start = perf_counter()
+    wire_bytes = 0
+
+    for message in messages:
+        raw_data = zlib.compress(json.dumps(message).encode())
+        wire_bytes += len(raw_data)
+        json.loads(zlib.decompress(raw_data))
+
+    return perf_counter() - start, wire_bytes
+
+def bench_connection(messages: list[dict]) -> tuple[float, int]:
+    """The current encoding, through a sending and a receiving BaseClient"""
+    sender = BaseClient(True)
+    receiver = BaseClient(False)
+
+    start = perf_counter()
+    wire_bytes = 0
+
+    for message in messages:
+        payload = sender.encode(message, message_type(message))
+        wire_bytes += len(payload)
+        receiver.decode(payload)
+
+    return perf_counter() - start, wire_bytes
+
+if __name__ == "__main__":
+    rng = Random(0)
+
+    print(f"{'message':<16}{'json B':>9}{'oneshot B':>11}{'ratio':>7}{'us/msg':>9}{'current B':>11}{'ratio':>7}{'us/msg':>9}")
+
+    for mtype, generate in sample_messages(rng).items():
+        messages = [generate() for _ in range(NUM_MESSAGES)]
+        json_bytes = sum(len(json.dumps(message)) for message in messages)
+
+        oneshot_time, oneshot_bytes = bench_oneshot(messages)
+        current_time, current_bytes = bench_connection(messages)
+
+        print(
+            f"{mtype:<16}{json_bytes // NUM_MESSAGES:>9}"
+            f"{oneshot_bytes // NUM_MESSAGES:>11}{json_bytes / oneshot_bytes:>7.2f}{oneshot_time / NUM_MESSAGES * 1e6:>9.1f}"
+            f"{current_bytes // NUM_MESSAGES:>11}{json_bytes / current_bytes:>7.2f}{current_time / NUM_MESSAGES * 1e6:>9.1f}"
+        )
@@ -0,0 +1,177 @@
+from array import array
+from time import time
+from typing import Dict, Iterable, Tuple
+
+class SnapshotBuffer:
+    """Fixed size ring buffer of (server time, x, y, rotation) snapshots for one remote entity"""
+
+    SIZE = 32
+
+    def __init__(self, size: int = SIZE) -> None:
+        self.size = size
+
+        self.times = [0.0] * size
+        self.xs = [0.0] * size
+        self.ys = [0.0] * size
+        self.rotations = [0] * size
+
+        self.head = -1 # slot of the newest snapshot
+        self.count = 0
+
+    @property
+    def latest_time(self) -> float:
+        if self.count == 0: return float('-inf')
+        return self.times[self.head]
+
+    def push(self, t: float, x: float, y: float, rotation: int) -> None:
+        if t <= self.latest_time:
+            return # Out of date or duplicate
+
+        self.head = (self.head + 1) % self.size
+        self.times[self.head] = t
+        self.xs[self.head] = x
+        self.ys[self.head] = y
+        self.rotations[self.head] = rotation
+
+        self.count = min(self.count + 1, self.size)
+
+    def sample(self, render_time: float, max_extrapolation: float) -> Tuple[float, float, int] | None:
+        """Returns the interpolated (x, y, rotation) at render_time, or None if there is nothing buffered"""
+        if self.count == 0:
+            return None
+
+        newest = self.head
+        if render_time >= self.times[newest] or self.count == 1:
+            if self.count == 1:
+                return (self.xs[newest], self.ys[newest], self.rotations[newest])
+
+            # Ran out of snapshots, carry on along the last known velocity for a little while then hold
+            previous = (newest - 1) % self.size
+            span = self.times[newest] - self.times[previous]
+            ahead = min(render_time - self.times[newest], max_extrapolation)
+
+            vx = (self.xs[newest] - self.xs[previous]) / span
+            vy = (self.ys[newest] - self.ys[previous]) / span
+
+            return (self.xs[newest] + vx * ahead, self.ys[newest] + vy * ahead, self.rotations[newest])
+
+        # Walk back from the newest snapshot to find the pair that straddles render_time
+        later = newest
+        for _ in range(self.count - 1):
+            earlier = (later - 1) % self.size
+
+            if self.times[earlier] <= render_time:
+                alpha = (render_time - self.times[earlier]) / (self.times[later] - self.times[earlier])
+
+                x = self.xs[earlier] + (self.xs[later] - self.xs[earlier]) * alpha
+                y = self.ys[earlier] + (self.ys[later] - self.ys[earlier]) * alpha
+
+                return (x, y, self.rotations[earlier])
+
+            later = earlier
+
+        # Older than anything buffered
+        return (self.xs[later], self.ys[later], self.rotations[later])
+
+class Interpolator:
+    """Renders remote entities a fixed delay in the past so there are always two snapshots to blend between.
+    The server's clock is mapped onto ours with the smallest (local receive time - server send time) seen, which drifts up slowly to follow clock drift."""
+
+    DELAY = 0.1 # seconds, should cover at least two snapshot intervals
+    MAX_EXTRAPOLATION = 0.25 # seconds
+    OFFSET_DRIFT = 0.01
+
+    def __init__(self, delay: float = DELAY, max_extrapolation: float = MAX_EXTRAPOLATION) -> None:
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+
+        self.buffers: Dict[int, SnapshotBuffer] = {}
+        self.clock_offset = None
+
+    @property
+    def render_time(self) -> float:
+        """The current render time on the server's clock"""
+        if self.clock_offset is None:
+            return 0.0
+
+        return time() - self.clock_offset - self.delay
+
+    def push_snapshot(self, server_time: float, entities: Iterable[Tuple[int, float, float, int]]) -> None:
+        offset = time() - server_time
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        else:
+            self.clock_offset += (offset - self.clock_offset) * self.OFFSET_DRIFT
+
+        for index, x, y, rotation in entities:
+            if index not in self.buffers:
+                self.buffers[index] = SnapshotBuffer()
+
+            self.buffers[index].push(server_time, x, y, rotation)
+
+    def sample(self, index: int) -> Tuple[float, float, int] | None:
+        if index not in self.buffers:
+            return None
+
+        return self.buffers[index].sample(self.render_time, self.max_extrapolation)
+
+    def remove(self, index: int) -> None:
+        self.buffers.pop(index, None)
+
+class PositionHistory:
+    """Host only. Where every shape was over the last few ticks, so hits can be checked against what a lagging shooter saw.
+    A ring of TICKS frames indexed by tick number, kept in flat float arrays (frame major) so recording allocates nothing"""
+
+    TICKS = 32 # a little over half a second at 60 fps
+
+    def __init__(self, num_shapes: int, ticks: int = TICKS) -> None:
+        self.num_shapes = num_shapes
+        self.ticks = ticks
+
+        self.times = array("d", [float('-inf')]) * ticks
+        self.xs = array("f", [0.0]) * (ticks * num_shapes)
+        self.ys = array("f", [0.0]) * (ticks * num_shapes)
+
+        self.tick = -1 # newest recorded tick
+
+    def record(self, t: float, shapes: Iterable[any]) -> None:
+        self.tick += 1
+        slot = self.tick % self.ticks
+        self.times[slot] = t
+
+        offset = slot * self.num_shapes
+        xs = self.xs
+        ys = self.ys
+        for shape in shapes:
+            xs[offset + shape.index] = shape.x
+            ys[offset + shape.index] = shape.y
+
+    def frame_at(self, t: float) -> Tuple[int, int, float] | None:
+        """Returns (earlier slot, later slot, blend) for time t, clamped to the recorded range. Look it up once and pass it to position for every shape"""
+        if self.tick < 0:
+            return None
+
+        newest = self.tick % self.ticks
+        if t >= self.times[newest]:
+            return (newest, newest, 0.0)
+
+        later = newest
+        for _ in range(min(self.tick, self.ticks - 1)):
+            earlier = (later - 1) % self.ticks
+
+            if self.times[earlier] <= t:
+                span = self.times[later] - self.times[earlier]
+                return (earlier, later, (t - self.times[earlier]) / span if span > 0 else 0.0)
+
+            later = earlier
+
+        # Older than anything recorded
+        return (later, later, 0.0)
+
+    def position(self, index: int, frame: Tuple[int, int, float]) -> Tuple[float, float]:
+        earlier, later, alpha = frame
+
+        a = earlier * self.num_shapes + index
+        b = later * self.num_shapes + index
+
+        return (self.xs[a] + (self.xs[b] - self.xs[a]) * alpha, self.ys[a] + (self.ys[b] - self.ys[a]) * alpha)
@@ -0,0 +1,112 @@
+import struct
+import zlib
+
+from base64 import b64decode, b64encode
+from typing import Dict, List
+
+# Full match state packed into one compact blob, so a late or reconnecting client is brought up to date with a single message.
+# Fixed size records via struct, zlib on top and base64 so it can ride inside a JSON message
+
+SHAPE_NAMES = ("Square", "Triangle", "Circle")
+RARITIES = ("Common", "Uncommon", "Rare", "Legendary")
+
+# Everything Shape.to_full_dict sends apart from the position, index and rotation
+SHAPE_FLOAT_FIELDS = (
+    "hp", "shield", "max_hp", "max_shield", "max_speed", "damage", "firerate", "bullet_speed", "penetration",
+    "shield_regen_rate", "lifesteal", "poison_damage", "zone_resistance", "health_regen_rate", "damage_growth"
+)
+
+# time, stage 1 seed, stage 2 seed, stage, safezone phase, safezone walls (left, right, top, bottom), stage 2 spawn bounds (left, right, top, bottom),
+# number of shapes, bullets and dropped powerups, length of the picked powerup bitmap
+HEADER = struct.Struct(">dIIBB4f4iHHHH")
+SHAPE = struct.Struct(">HBBHff" + "f" * len(SHAPE_FLOAT_FIELDS)) # index, shape name, is player, rotation, x, y, SHAPE_FLOAT_FIELDS
+BULLET = struct.Struct(">Hfffff") # parent index, x, y, velocity x, velocity y, damage
+POWERUP = struct.Struct(">HffB") # index, x, y, rarity
+NAME_LENGTH = struct.Struct(">B")
+
+def pack_name(name: str) -> bytes:
+    data = name.encode()[:255]
+    return NAME_LENGTH.pack(len(data)) + data
+
+def unpack_name(data: bytes, offset: int) -> tuple[str, int]:
+    length, = NAME_LENGTH.unpack_from(data, offset)
+    offset += NAME_LENGTH.size
+
+    return data[offset:offset + length].decode(errors="replace"), offset + length
+
+def encode_keyframe(keyframe: Dict[str, any]) -> str:
+    """keyframe holds "t", "seeds" (stage 1, stage 2), "stage", "safezone" (phase, walls), "stage_2_bounds", "picked" (PowerupBitset.to_bytes),
+    "shapes" (Shape.to_full_dict plus "shape_name", "is_player" and "player_name"), "bullets" (Bullet.to_dict) and "dropped_powerups" (Powerup.to_dict)"""
+    shapes = keyframe["shapes"]
+    bullets = keyframe["bullets"]
+    dropped_powerups = keyframe["dropped_powerups"]
+    picked = keyframe["picked"]
+    safezone = keyframe["safezone"]
+
+    parts = [HEADER.pack(
+        keyframe["t"], keyframe["seeds"][0], keyframe["seeds"][1], keyframe["stage"], safezone["phase"], *safezone["walls"], *keyframe["stage_2_bounds"],
+        len(shapes), len(bullets), len(dropped_powerups), len(picked)
+    )]
+
+    for shape in shapes:
+        parts.append(SHAPE.pack(
+            shape["index"], SHAPE_NAMES.index(shape["shape_name"]), shape["is_player"], int(shape["rotation"]) % 360, shape["x"], shape["y"],
+            *(shape[field] for field in SHAPE_FLOAT_FIELDS)
+        ))
+        parts.append(pack_name(shape["player_name"]))
+
+    for bullet in bullets:
+        parts.append(BULLET.pack(bullet["parent_index"], bullet["x"], bullet["y"], bullet["velocity"][0], bullet["velocity"][1], bullet["damage"]))
+
+    for powerup in dropped_powerups:
+        parts.append(POWERUP.pack(powerup["index"], powerup["x"], powerup["y"], RARITIES.index(powerup["rarity"])))
+        parts.append(pack_name(powerup["name"]))
+
+    parts.append(bytes(picked))
+
+    return b64encode(zlib.compress(b"".join(parts), 9)).decode()
+
+def decode_keyframe(blob: str) -> Dict[str, any]:
+    """Inverse of encode_keyframe"""
+    data = zlib.decompress(b64decode(blob))
+
+    (
+        t, seed_1, seed_2, stage, phase, left_wall, right_wall, top_wall, bottom_wall, min_x, max_x, min_y, max_y,
+        num_shapes, num_bullets, num_dropped, picked_length
+    ) = HEADER.unpack_from(data)
+    offset = HEADER.size
+
+    shapes: List[Dict[str, any]] = []
+    for _ in range(num_shapes):
+        index, shape_name, is_player, rotation, x, y, *values = SHAPE.unpack_from(data, offset)
+        offset += SHAPE.size
+
+        player_name, offset = unpack_name(data, offset)
+
+        shape = {
+            "index": index, "shape_name": SHAPE_NAMES[shape_name], "is_player": bool(is_player), "rotation": rotation, "x": x, "y": y,
+            "player_name": player_name, "squad": []
+        }
+        shape.update(zip(SHAPE_FLOAT_FIELDS, values))
+        shapes.append(shape)
+
+    bullets = []
+    for _ in range(num_bullets):
+        parent_index, x, y, velocity_x, velocity_y, damage = BULLET.unpack_from(data, offset)
+        offset += BULLET.size
+
+        bullets.append({"parent_index": parent_index, "x": x, "y": y, "velocity": [velocity_x, velocity_y], "damage": damage})
+
+    dropped_powerups = []
+    for _ in range(num_dropped):
+        index, x, y, rarity = POWERUP.unpack_from(data, offset)
+        offset += POWERUP.size
+
+        name, offset = unpack_name(data, offset)
+        dropped_powerups.append({"index": index, "x": x, "y": y, "rarity": RARITIES[rarity], "name": name})
+
+    return {
+        "t": t, "seeds": (seed_1, seed_2), "stage": stage, "safezone": {"phase": phase, "walls": (left_wall, right_wall, top_wall, bottom_wall)},
+        "stage_2_bounds": (min_x, max_x, min_y, max_y), "picked": data[offset:offset + picked_length],
+        "shapes": shapes, "bullets": bullets, "dropped_powerups": dropped_powerups
+    }
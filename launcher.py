@@ -81,6 +81,8 @@ class Launcher:
         self.get_name = lambda: "player"
         self.get_server_ip = lambda: "0.0.0.0"
         self.get_server_port = lambda: "31415"
+        self.use_udp = tk.BooleanVar(self.root, False)
+        self.use_render_process = tk.BooleanVar(self.root, False)
 
         self.ui_mgr = UIManager(self.root)
         self.construct()
@@ -100,6 +102,12 @@ class Launcher:
 
         return ""
 
+    def get_transport(self) -> str:
+        if self.use_udp.get():
+            return "udp"
+
+        return "tcp"
+
     def join_multiplayer(self) -> None:
         name = self.get_name()
         host = self.get_server_ip()
@@ -111,7 +119,7 @@ class Launcher:
 
         self.root.withdraw()
         proc = subprocess.Popen(
-            [self.get_executable(), "join", host, port, name]
+            [self.get_executable(), "join", host, port, name, self.get_transport()]
         )
         proc.wait()
         self.root.deiconify()
@@ -127,14 +135,17 @@ class Launcher:
 
         self.root.withdraw()
         proc = subprocess.Popen(
-            [self.get_executable(), "host", host, port, name]
+            [self.get_executable(), "host", host, port, name, self.get_transport()]
         )
         proc.wait()
         self.root.deiconify()
     
     def start_singleplayer(self) -> None:
         self.root.withdraw()
-        proc = subprocess.Popen([self.get_executable()])
+        if self.use_render_process.get():
+            proc = subprocess.Popen([self.get_executable(), "split", self.get_name()])
+        else:
+            proc = subprocess.Popen([self.get_executable()])
         proc.wait()
         self.root.deiconify()
 
@@ -147,12 +158,14 @@ class Launcher:
 
         self.get_server_ip = self.ui_mgr.TextInput("SERVER IP:", "0.0.0.0")
         self.get_server_port = self.ui_mgr.TextInput("PORT:", "31415")
+        self.ui_mgr.Checkbox("USE UDP:", self.use_udp)
 
         self.ui_mgr.Button("", "JOIN MULTIPLAYER", self.join_multiplayer)
         self.ui_mgr.Button("", "HOST MULTIPLAYER", self.host_multiplayer)
 
         self.ui_mgr.Subheading("\nSINGLEPLAYER")
 
+        self.ui_mgr.Checkbox("SEPARATE RENDER PROCESS:", self.use_render_process)
         self.ui_mgr.Button("", "START SINGLEPLAYER", self.start_singleplayer)
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from random import Random
+from time import time
+
+from netem import NetemProxy, add_condition_arguments, conditions_from_args
+from networking import Client, NetworkLoop, message_type
+
+FRAME_RATE = 60 # how often a scripted client looks at its messages and makes an input, like the game loop
+NET_TICK_RATE = 30 # input packets per second, same as ShapeRoyale.NET_TICK_RATE
+MOVE_INTERVAL = 0.5 # seconds a scripted client keeps going in one direction
+
+CONNECT_TIMEOUT = 30 # seconds, covers the server starting up (or finishing its previous match)
+HANDSHAKE_TIMEOUT = 30 # seconds
+STATS_TIMEOUT = 2 # seconds to wait for the "server_stats" answer
+
+class LoadClient:
+    """One scripted player speaking the real lobby/handshake/input protocol.
+    Runs as a task on the shared network loop, so a few hundred of them don't cost any extra threads."""
+
+    def __init__(self, host: str, port: int, transport: str, number: int) -> None:
+        self.client = Client(host, port, transport)
+        self.name = f"Load {number}"
+        self.rng = Random(number)
+
+        self.base_client = None
+        self.player_index = None
+
+        self.input_seq = 0
+        self.unsent_inputs = []
+        self.move = ""
+        self.last_move_time = 0
+
+        self.latencies = []
+        self.updates_received = 0
+        self.messages_received = 0
+        self.server_stats = None
+
+    def poll(self) -> list[dict[any, any]]:
+        return self.base_client.raw_data_stream.drain()
+
+    def bytes_transferred(self) -> tuple[int, int]:
+        """(sent, received) bytes so far, framing included"""
+        net_stats = self.base_client.net_stats
+        return (sum(size for _, size in net_stats.sent.copy().values()), sum(size for _, size in net_stats.received.copy().values()))
+
+    async def connect(self) -> None:
+        deadline = time() + CONNECT_TIMEOUT
+
+        while True:
+            try:
+                self.base_client = await self.client.open_connection()
+                return
+            except Exception:
+                if time() > deadline:
+                    raise
+
+                await asyncio.sleep(0.25)
+
+    async def lobby(self) -> None:
+        """Says ready until the server asks for the starting info"""
+        while True:
+            self.base_client.send({"answer": {"ready": True, "name": self.name}})
+            self.base_client.flush()
+
+            for message in self.poll():
+                if message.get("question") == "send_starting_info":
+                    self.base_client.send({"answer": {"send_starting_info": {"shape_index": self.rng.randrange(3), "name": self.name}}})
+                    self.base_client.flush()
+                    return
+
+            await asyncio.sleep(1 / FRAME_RATE)
+
+    async def handshake(self) -> None:
+        last_message_time = time()
+
+        while self.player_index is None:
+            for message in self.poll():
+                last_message_time = time()
+
+                answer = message.get("answer")
+                if isinstance(answer, dict) and "player_index" in answer:
+                    self.player_index = answer["player_index"]
+
+            if time() - last_message_time > 0.5:
+                self.base_client.send({"question": "keyframe"})
+                self.base_client.flush()
+                last_message_time = time()
+
+            await asyncio.sleep(1 / FRAME_RATE)
+
+    def handle(self, message: dict[any, any]) -> None:
+        self.messages_received += 1
+
+        answer = message.get("answer")
+        if not isinstance(answer, dict):
+            return
+
+        match message_type(message):
+            case "player_update":
+                # Same machine, so the snapshot's timestamp is on our clock
+                self.latencies.append(time() - answer["t"])
+                self.updates_received += 1
+
+            case "server_stats":
+                self.server_stats = answer["server_stats"]
+
+    async def play(self, duration: float) -> None:
+        end_time = time() + duration
+        last_frame_time = time()
+        last_send_time = 0
+
+        while time() < end_time and not self.base_client.dead:
+            now = time()
+            dt = now - last_frame_time
+            last_frame_time = now
+
+            for message in self.poll():
+                self.handle(message)
+
+            if now - self.last_move_time > MOVE_INTERVAL:
+                self.move = self.rng.choice(("u", "r", "d", "l", ""))
+                self.last_move_time = now
+
+            self.input_seq += 1
+            self.unsent_inputs.append([self.input_seq, self.move, int(self.rng.random() < 0.3), round(dt, 4)])
+
+            if now - last_send_time >= 1 / NET_TICK_RATE:
+                self.base_client.send({"answer": {"player_input": {"index": self.player_index, "inputs": self.unsent_inputs}}})
+                self.base_client.flush()
+                self.unsent_inputs = []
+                last_send_time = now
+
+            await asyncio.sleep(1 / FRAME_RATE)
+
+    async def ask_server_stats(self) -> None:
+        self.base_client.send({"question": "server_stats"})
+        self.base_client.flush()
+
+        deadline = time() + STATS_TIMEOUT
+        while self.server_stats is None and time() < deadline and not self.base_client.dead:
+            for message in self.poll():
+                self.handle(message)
+
+            await asyncio.sleep(1 / FRAME_RATE)
+
+def percentile(values: list[float], fraction: float) -> float:
+    if len(values) == 0:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run_clients(host: str, port: int, transport: str, num_clients: int, duration: float) -> dict[str, any]:
+    clients = [LoadClient(host, port, transport, i + 1) for i in range(num_clients)]
+
+    # Everyone connects before anyone says ready, the server's countdown starts as soon as all connected players are ready
+    await asyncio.gather(*(client.connect() for client in clients))
+
+    await asyncio.wait_for(asyncio.gather(*(client.lobby() for client in clients)), HANDSHAKE_TIMEOUT)
+    await asyncio.wait_for(asyncio.gather(*(client.handshake() for client in clients)), HANDSHAKE_TIMEOUT)
+
+    start_bytes = [client.bytes_transferred() for client in clients]
+    start_time = time()
+
+    await asyncio.gather(*(client.play(duration) for client in clients))
+    elapsed = time() - start_time
+
+    end_bytes = [client.bytes_transferred() for client in clients]
+    alive = sum(not client.base_client.dead for client in clients)
+
+    await clients[0].ask_server_stats()
+
+    for client in clients:
+        client.base_client.disconnect()
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    received = [end[1] - start[1] for start, end in zip(start_bytes, end_bytes)]
+    sent = [end[0] - start[0] for start, end in zip(start_bytes, end_bytes)]
+
+    return {
+        "clients": num_clients, "alive": alive, "duration": elapsed,
+        "server": clients[0].server_stats or {},
+        "latency_ms": sum(latencies) / max(len(latencies), 1) * 1000, "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "updates_per_sec": sum(client.updates_received for client in clients) / elapsed / num_clients,
+        "recv_bytes_per_sec": sum(received) / elapsed / num_clients, "sent_bytes_per_sec": sum(sent) / elapsed / num_clients,
+        "server_out_bytes_per_sec": sum(received) / elapsed
+    }
+
+def spawn_server(host: str, port: int, transport: str, verbose: bool) -> subprocess.Popen:
+    """Starts a headless `main.py server` next to this file"""
+    output = None if verbose else subprocess.DEVNULL
+
+    return subprocess.Popen(
+        [sys.executable, "main.py", "server", host, str(port), transport], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=output, stderr=output
+    )
+
+def run_step(args: argparse.Namespace, num_clients: int, client_port: int) -> dict[str, any]:
+    server = spawn_server(args.host, args.port, args.transport, args.verbose) if args.spawn_server else None
+
+    try:
+        return NetworkLoop.get().submit(run_clients(args.host, client_port, args.transport, num_clients, args.duration)).result()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+def print_row(result: dict[str, any]) -> None:
+    server = result["server"]
+
+    print(
+        f"{result['clients']:>7}{result['alive']:>7}"
+        f"{server.get('tick_ms', 0):>9.2f}{server.get('tick_p95_ms', 0):>9.2f}{server.get('tick_max_ms', 0):>9.2f}{server.get('fps', 0):>7.1f}"
+        f"{result['latency_ms']:>9.1f}{result['latency_p95_ms']:>9.1f}{result['updates_per_sec']:>8.1f}"
+        f"{result['recv_bytes_per_sec'] / 1024:>10.1f}{result['sent_bytes_per_sec'] / 1024:>9.2f}{result['server_out_bytes_per_sec'] / 1024:>11.1f}"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs scripted clients against a ShapeRoyale server and reports how it copes as the number of clients grows.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=31415)
+    parser.add_argument("--transport", choices=("tcp", "udp"), default="tcp")
+    parser.add_argument("--clients", default="1,2,4,8,16,32", help="comma separated client counts, one run each")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of play per run")
+    parser.add_argument("--no-spawn", dest="spawn_server", action="store_false", help="use a server that is already running instead of starting `main.py server` for every run")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the spawned server's output")
+    parser.add_argument("--proxy-port", type=int, help="where the emulated link listens when any link option is given, defaults to --port + 1")
+    add_condition_arguments(parser)
+    args = parser.parse_args()
+
+    # With any link option the clients go through netem.py's proxy instead of straight to the server
+    proxy = None
+    client_port = args.port
+    if any((args.latency, args.jitter, args.bandwidth, args.loss, args.reorder)):
+        client_port = args.proxy_port if args.proxy_port is not None else args.port + 1
+        proxy = NetemProxy(args.host, client_port, args.host, args.port, args.transport, conditions_from_args(args), seed=args.seed)
+
+    print(f"{'clients':>7}{'alive':>7}{'tick ms':>9}{'p95':>9}{'max':>9}{'fps':>7}{'lat ms':>9}{'p95':>9}{'upd/s':>8}{'rx KB/s':>10}{'tx KB/s':>9}{'srv KB/s':>11}")
+
+    results = []
+    for num_clients in (int(count) for count in args.clients.split(",")):
+        try:
+            result = run_step(args, num_clients, client_port)
+        except Exception as e:
+            print(f"Loadtest - Error while running {num_clients} clients! {e}.")
+            continue
+
+        results.append(result)
+        print_row(result)
+
+    if proxy is not None:
+        print(f"Emulated link: {proxy.stats()}")
+        proxy.shutdown()
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
@@ -4,21 +4,28 @@ import sys
 
 #from sound import generate_sine_wave
 
-from menus import MainMenu, EndScreen
+from menus import MainMenu, ServerLobby, EndScreen
 from bullet import Bullet
-from shape import Player, Shape
-from powerups import Powerup
-from utils import AnimManager, FONTS_PATH
-
-from networking import Server, Client, BaseClient
-
-from time import time, sleep
-from json import loads
+from shape import Player, Shape, ShapeSprites
+from powerups import Powerup, PowerupBitset
+from utils import AnimManager, SpatialGrid, FONTS_PATH
+from interpolation import Interpolator, PositionHistory
+from replication import ReplicationScheduler
+from snapshot_workers import SnapshotWorkerPool
+from render_process import RenderProcess
+from keyframe import encode_keyframe, decode_keyframe, SHAPE_FLOAT_FIELDS
+
+from networking import Server, Client, BaseClient, MessageRouter, encode_answer_list
+
+from time import time, sleep, perf_counter
+from json import loads, dumps
 from math import dist, sqrt, floor, ceil
 from random import randint, choice, uniform, Random, randrange
 
+from collections import deque
+from secrets import token_hex
 from copy import deepcopy
-from typing import List, Sequence, Dict
+from typing import Dict, Iterable, List, Sequence
 
 startup_str = """
     ||
@@ -31,6 +38,18 @@ startup_str = """
 
 print(startup_str)
 
+# A dedicated server has no window and no audio device, SDL has to be told before it initializes
+HEADLESS = len(sys.argv) > 1 and sys.argv[1] == "server"
+# Single-player with the window in a render process (see render_process.py), this process only simulates
+SPLIT = len(sys.argv) > 1 and sys.argv[1] == "split"
+DISPLAY_ENV = os.environ.copy() # what the render process opens its window with
+
+if HEADLESS or SPLIT:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+if HEADLESS:
+    os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1") # SIGTERM/SIGINT should stop the process, not post a QUIT event nobody reads in the lobby
+
 pg.init()
 
 class Screen(pg.Surface):
@@ -109,12 +128,23 @@ class Safezone:
 
         self.next_phase()
 
+    def set_state(self, phase_index: int, walls: Sequence[float]) -> None:
+        """Jumps to a phase and wall positions received from the host, the running wall anims carry on from there"""
+        self.phase_index = phase_index
+        self.left_wall, self.right_wall, self.top_wall, self.bottom_wall = walls
+
     def get_wall_distance(self, player: Shape) -> tuple[float, float, float, float]:
         left_wall = self.left_wall - player.x
         right_wall = self.right_wall - player.x 
         top_wall = self.top_wall - player.y
         bottom_wall = self.bottom_wall - player.y
 
+        return (left_wall, right_wall, top_wall, bottom_wall)
+
+    def apply_damage(self, player: Shape) -> tuple[float, float, float, float]:
+        """Once per shape per simulation step, drawing the safezone doesn't damage anyone. Returns get_wall_distance"""
+        left_wall, right_wall, top_wall, bottom_wall = self.get_wall_distance(player)
+
         if left_wall > self.screen_width / 2 or right_wall < self.screen_width / 2 or top_wall > self.screen_height / 2 or bottom_wall < self.screen_height / 2:
             #player.add_poison(None, 30 * self.dt, 0.0, 2.0)
             player.take_damage((50 + player.health_regen_rate) * self.dt / player.zone_resistance)
@@ -147,55 +177,113 @@ class ShapeRoyale:
     NUM_PLAYERS = 100
     NUM_POWERUP_SECTIONS = 24 
     NUM_POWERUPS = NUM_POWERUP_SECTIONS * 20 # this must be divisible by the NUM_POWERUP_SECTIONS
+    STAGE_2_POWERUPS = NUM_POWERUP_SECTIONS * 10 # half, spawned inside the safezone once it has shrunk
+    FIRST_DROPPED_POWERUP_INDEX = NUM_POWERUPS + STAGE_2_POWERUPS # powerups dropped by dead players are numbered from here so indexes never collide
     POWERUP_SECTION_SIZE = MAP_SIZE / NUM_POWERUP_SECTIONS
 
     MAX_BULLET_TRAVEL_DIST = 2000
 
+    DRAW_CELL_SIZE = 1000 # shapes and bullets are bucketed into cells this big to find what's on screen
+    DRAW_MARGIN = 200 # px around the screen things are still looked at in, shapes draw their name and health above and left of themselves
+
+    HANDSHAKE_POLL_TIMEOUT = 0.5 # seconds
+    RECONNECT_INTERVAL = 1.0 # seconds between attempts to get back to the host after the connection dropped
+    EMPTY_SERVER_GRACE = 10 * RECONNECT_INTERVAL # seconds a dedicated server keeps going after its last client died, so a brief drop can still rejoin
+
+    NET_TICK_RATE = 30 # input packets per second sent by clients
+    SNAPSHOT_RATE = 20 # state snapshots per second sent by the host
+    SNAPSHOT_WORKERS = 2 # processes that encode the host's snapshots, 0 encodes them on the game thread
+    MAX_INPUT_DT = 0.1 # longest frame the host will simulate for a single client input
+    MAX_INPUT_BUDGET = 0.25 # seconds of client input the host simulates ahead of its own clock at most, covers inputs arriving in bursts
+    MAX_INPUTS_PER_MESSAGE = 32 # a client sends a couple per message, the rest of a longer list is ignored
+    MAX_PENDING_INPUTS = 256
+    MAX_REWIND = 0.25 # seconds, the most a client's bullets get lag compensated by
+    TICK_HISTORY = 300 # frames of simulation timing kept for the "server_stats" question
+
+    NET_STATS_PATH = "../ShapeRoyale/Data/net_stats.json" # written when F3 is pressed
+
+    HEADLESS_SIZE = (1920, 1080) # the screen size the simulation assumes when there is no screen
+
     def __init__(self, display_surf: pg.Surface | None = None) -> None:
         if not (self.NUM_POWERUPS / self.NUM_POWERUP_SECTIONS).is_integer() or self.NUM_POWERUPS % self.NUM_POWERUP_SECTIONS != 0:
             raise Exception("NUM_POWERUPS must be divisible by NUM_POWERUP_SECTIONS such that the resualt is a valid integer!")
 
-        info = pg.display.get_desktop_sizes()[0]
-        self.WIDTH = min(info[0], 1920)
-        self.HEIGHT = min(info[1], 1080)
-        
-        if display_surf is None:
-            self.screen = pg.display.set_mode((self.WIDTH, self.HEIGHT), pg.SRCALPHA | pg.FULLSCREEN | pg.SCALED, display=0)
+        self.headless = HEADLESS
+        self.split = SPLIT
+        self.renders = not (self.headless or self.split) # whether this process draws the game
+
+        if self.headless or self.split:
+            self.WIDTH, self.HEIGHT = self.HEADLESS_SIZE
         else:
+            info = pg.display.get_desktop_sizes()[0]
+            self.WIDTH = min(info[0], 1920)
+            self.HEIGHT = min(info[1], 1080)
+        
+        if display_surf is not None:
             self.screen = display_surf
+        elif not self.renders:
+            # Nothing is ever shown, but images still need a display mode to be converted
+            self.screen = pg.display.set_mode((self.WIDTH, self.HEIGHT))
+        else:
+            self.screen = pg.display.set_mode((self.WIDTH, self.HEIGHT), pg.SRCALPHA | pg.FULLSCREEN | pg.SCALED, display=0)
 
         self.anim_manager = AnimManager()
 
         self.server = None
         self.client = None
         self.player_name = "player"
+        self.transport = sys.argv[5] if len(sys.argv) > 5 else "tcp"
 
         if len(sys.argv) > 1:
             if sys.argv[1] == "host":
                 self.host_server()
             elif sys.argv[1] == "join":
                 self.join_server()
+            elif sys.argv[1] == "server":
+                self.transport = sys.argv[4] if len(sys.argv) > 4 else "tcp"
+                self.host_server()
 
         if len(sys.argv) == 4 and (self.client is not None or self.server is not None):
             self.player_name = sys.argv[3]
 
-        self.main_menu = MainMenu(self.screen, self.server, self.client, self.player_name)
+        if self.headless:
+            # Player 0 is normally the host, on a dedicated server generate_players makes it a bot like the rest
+            lobby = ServerLobby(self.server)
+            real_player_info = {}
+        elif self.split:
+            # No menu without a window, main.py split [name] [shape index]
+            lobby = None
+            if len(sys.argv) > 2:
+                self.player_name = sys.argv[2][:25]
+            shape_index = int(sys.argv[3]) if len(sys.argv) > 3 else randrange(3)
+            real_player_info = {0: (shape_index, self.player_name, None)}
+        else:
+            lobby = self.main_menu = MainMenu(self.screen, self.server, self.client, self.player_name)
+            real_player_info = {0: (self.main_menu.player.shape_index, self.player_name, None)}
 
-        real_player_info = {0: (self.main_menu.player.shape_index, self.player_name, None)}
+        subscribers = lobby.subscribers if lobby is not None else set() # spectator relays (see relay.py), they watch instead of playing
 
         if self.server is not None:
-            while len(real_player_info)-1 != len(self.server.clients):
-                for i, client in enumerate(self.server.clients):
-                    for message in client.data_stream:
-                        for dtype, query in message.items():
-                            if dtype != "answer" or "send_starting_info" not in query:
-                                continue
-                            
-                            player_name = query["send_starting_info"]["name"]
-                            if len(player_name) > 25:
-                                player_name = player_name[:25]
+            for i, client in enumerate(self.server.clients):
+                while i+1 not in real_player_info and client not in subscribers:
+                    if client.dead:
+                        # Left before the match started, generate_players puts a bot at its index that a late joiner can take over
+                        break
+
+                    message = client.recv(timeout=self.HANDSHAKE_POLL_TIMEOUT)
+                    for dtype, query in message.items():
+                        if dtype == "answer" and "subscribe" in query:
+                            # A relay that connected while the lobby was closing
+                            subscribers.add(client)
+
+                        if dtype != "answer" or "send_starting_info" not in query:
+                            continue
+                        
+                        player_name = query["send_starting_info"]["name"]
+                        if len(player_name) > 25:
+                            player_name = player_name[:25]
 
-                            real_player_info[i+1] = (query["send_starting_info"]["shape_index"], player_name, client)
+                        real_player_info[i+1] = (query["send_starting_info"]["shape_index"], player_name, client)
 
         self.clock = pg.time.Clock()
 
@@ -205,14 +293,7 @@ class ShapeRoyale:
         self.safezone = Safezone(self.screen.width, self.screen.height, self.MAP_SIZE_X, self.MAP_SIZE_Y, self.phase_config)
 
         self.shape_names = ["Square", "Triangle", "Circle"]
-        self.shape_images = {
-            "SquareFriendly": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Square_Sprite_Player.png"), 0.1).convert_alpha(),
-            "SquareEnemy": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Square_Sprite_Enemy.png"), 0.1).convert_alpha(),
-            "TriangleFriendly": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Triangle_Sprite_Player.png"), 0.1).convert_alpha(),
-            "TriangleEnemy": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Triangle_Sprite_Enemy.png"), 0.1).convert_alpha(),
-            "CircleFriendly": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Circle_Sprite_Player.png"), 0.1).convert_alpha(),
-            "CircleEnemy": pg.transform.smoothscale_by(pg.image.load("../ShapeRoyale/Data/assets/Circle_Sprite_Enemy.png"), 0.1).convert_alpha()
-        }
+        self.shape_sprites = ShapeSprites.get(self.shape_names)
         
         with open("../ShapeRoyale/Data/shapes.json", "r") as f:
             self.shape_info = loads(f.read())
@@ -230,19 +311,27 @@ class ShapeRoyale:
 
         self.powerup_stage_1_seed = randrange(2**32)
         self.powerup_stage_2_seed = randrange(2**32)
+        self.powerup_stage_2_bounds = (0, 0, 0, 0) # left, right, top, bottom, set when stage 2 spawns
+        self.next_powerup_index = self.FIRST_DROPPED_POWERUP_INDEX
+
+        # Picked up powerups. The host replicates the bits its clients haven't got yet once per snapshot, late joiners get the whole set in their keyframe
+        self.picked_powerups = PowerupBitset(self.FIRST_DROPPED_POWERUP_INDEX)
+        self.replicated_powerups = PowerupBitset()
 
         if self.client is None:
             self.players = self.generate_players(real_player_info)
             self.powerups = self.generate_powerups(self.powerup_stage_1_seed)
 
-        self.sounds = {
-            "hitHurt": pg.Sound("../ShapeRoyale/Data/assets/Sounds/hitHurt.wav"),
-            "laserShoot": pg.Sound("../ShapeRoyale/Data/assets/Sounds/laserShoot.wav"),
-            "powerUp": pg.Sound("../ShapeRoyale/Data/assets/Sounds/powerUp.wav"),
-        }
-        self.sounds["hitHurt"].set_volume(0.70)
-        self.sounds["laserShoot"].set_volume(0.70)
-        self.sounds["powerUp"].set_volume(0.50)
+        self.sounds = {}
+        if self.renders:
+            self.sounds = {
+                "hitHurt": pg.Sound("../ShapeRoyale/Data/assets/Sounds/hitHurt.wav"),
+                "laserShoot": pg.Sound("../ShapeRoyale/Data/assets/Sounds/laserShoot.wav"),
+                "powerUp": pg.Sound("../ShapeRoyale/Data/assets/Sounds/powerUp.wav"),
+            }
+            self.sounds["hitHurt"].set_volume(0.70)
+            self.sounds["laserShoot"].set_volume(0.70)
+            self.sounds["powerUp"].set_volume(0.50)
 
         self.powerup_sections = [(i*self.POWERUP_SECTION_SIZE, (i+1)*self.POWERUP_SECTION_SIZE) for i in range(self.NUM_POWERUP_SECTIONS)]
         self.powerup_section_index = 0
@@ -251,7 +340,7 @@ class ShapeRoyale:
         self.spectating_lbl = pg.font.Font(f"{FONTS_PATH}/PressStart2P.ttf", 60).render("You are spectating!", True, (255, 255, 255))
 
         self.spectator_index = 0
-        self.spectating = False
+        self.spectating = self.headless
         self.spectator_player = None
         
         if len(self.players) > 0:
@@ -260,9 +349,60 @@ class ShapeRoyale:
 
         self.minimap_surf = pg.Surface((200, 200), pg.SRCALPHA)
 
+        # Drawing only visits what the view touches
+        self.shape_grid = SpatialGrid(self.DRAW_CELL_SIZE)
+        self.bullet_grid = SpatialGrid(self.DRAW_CELL_SIZE)
+
         self.end_screen = None
         self.has_done_bonus_powerups = False
 
+        # Client side prediction. Inputs stay pending until the host acknowledges having simulated them
+        self.input_seq = 0
+        self.pending_inputs = deque(maxlen=self.MAX_PENDING_INPUTS)
+        self.unsent_inputs = []
+        self.last_input_send_time = 0
+
+        # Remote shapes are drawn a little in the past, blended between the host's snapshots
+        self.interpolator = Interpolator()
+
+        # Host side lag compensation, remote clients' bullets are checked against where the targets were on the shooter's screen
+        self.position_history = PositionHistory(self.NUM_PLAYERS)
+
+        # Host only, picks what goes into each client's snapshot within its bandwidth budget
+        self.replication = ReplicationScheduler(self.SNAPSHOT_RATE)
+        self.last_snapshot_time = 0
+        self.snapshot_workers = None
+        num_snapshot_workers = min(self.SNAPSHOT_WORKERS, (os.cpu_count() or 1) - 1) # only worth it with a core to spare for each
+        if self.server is not None and num_snapshot_workers > 0:
+            self.snapshot_workers = SnapshotWorkerPool.get(num_snapshot_workers, self.SNAPSHOT_RATE)
+
+        self.tick_times = deque(maxlen=self.TICK_HISTORY) # ms of work per frame, not counting the wait for the next frame
+
+        # Split single-player only, the renderer draws what this process simulates and sends back its inputs
+        self.render_process = None
+        if self.split:
+            self.render_process = RenderProcess.get(self.NUM_PLAYERS, self.WIDTH, self.HEIGHT, DISPLAY_ENV)
+            self.render_process.start_match(self.players)
+            _, _, self.spectator_steps, self.restarts, _ = self.render_process.controls() # counted since the renderer started
+
+        self.router = MessageRouter()
+        self.register_handlers()
+
+        # Host only, late joins and reconnects. Clients that haven't been given a shape yet get the starting info question and then a keyframe
+        self.joined_clients = set(self.server.clients) if self.server is not None else set()
+        self.invited_clients = set()
+        self.rejoin_tokens = {} # shape index -> token the client has to show to get that shape back after its connection drops
+        self.subscribers = subscribers # relays get every shape and bullet in each snapshot and fan it out to their spectators
+
+        # Client only, getting back into the match after the connection drops
+        self.rejoin_token = None
+        self.reported_spectate = None # index of the shape we last told the host (or relay) our screen follows
+        self.reconnect_attempt = None
+        self.last_reconnect_time = 0
+
+        # Headless only, when the last client died
+        self.everyone_left_time = None
+
         self.main()
     
     @property
@@ -273,14 +413,14 @@ class ShapeRoyale:
             return self.players[0]
 
     def host_server(self) -> None:
-        self.server = Server(sys.argv[2], int(sys.argv[3]))
+        self.server = Server(sys.argv[2], int(sys.argv[3]), self.transport)
 
     def join_server(self) -> None:
         self.screen.fill((0, 0, 0))
         loading_lbl = pg.font.Font(f"{FONTS_PATH}/PressStart2P.ttf", 60).render("Connecting to server...", True, (255, 255, 255))
         self.screen.blit(loading_lbl, (self.WIDTH // 2 - loading_lbl.width // 2, self.HEIGHT // 2 - loading_lbl.height // 2))
 
-        self.client = Client(sys.argv[2], int(sys.argv[3]))
+        self.client = Client(sys.argv[2], int(sys.argv[3]), self.transport)
         connected = False
         while not connected:
             pg.display.flip()
@@ -330,24 +470,28 @@ class ShapeRoyale:
             print(shape_index, name, client)
             shape_type = self.shape_names[shape_index]
             new_shape = Shape(
-                self.MAP_SIZE, randint(3000, self.MAP_SIZE_X-3000), randint(3000, self.MAP_SIZE_Y-3000), i, shape_type, self.shape_info, self.shape_images[f"{shape_type}Friendly"],
-                self.shape_images[f"{shape_type}Enemy"], self.bullets, self.bullet_img, True, [], client, name
+                self.MAP_SIZE, randint(3000, self.MAP_SIZE_X-3000), randint(3000, self.MAP_SIZE_Y-3000), i, shape_type, self.shape_info, self.shape_sprites,
+                self.bullets, self.bullet_img, True, [], client, name
             )
             new_shape.squad.append(new_shape)
             shapes.append(new_shape)
 
-        for i in range(len(shapes), self.NUM_PLAYERS):
+        # Bots fill every index no real player has, relays leave gaps in the client list
+        for i in range(self.NUM_PLAYERS):
+            if i in real_player_info:
+                continue
+
             name = choice(self.shape_names)
             new_shape = Shape(
-                self.MAP_SIZE, randint(3000, self.MAP_SIZE_X-3000), randint(3000, self.MAP_SIZE_Y-3000), i, name, self.shape_info, self.shape_images[f"{name}Friendly"],
-                self.shape_images[f"{name}Enemy"], self.bullets, self.bullet_img, is_player=False, squad=[], player_name=f"Bot {i+1}"
+                self.MAP_SIZE, randint(3000, self.MAP_SIZE_X-3000), randint(3000, self.MAP_SIZE_Y-3000), i, name, self.shape_info, self.shape_sprites,
+                self.bullets, self.bullet_img, is_player=False, squad=[], player_name=f"Bot {i+1}"
             )
             new_shape.squad.append(new_shape)
             shapes.append(new_shape)
 
         return shapes
 
-    def generate_powerups(self, seed: int, starting_index: int = 0, spawn_min_x: float = 0, spawn_max_x: float = MAP_SIZE-1, spawn_min_y: float = 0, spawn_max_y: float = MAP_SIZE-1) -> List[Powerup]:
+    def generate_powerups(self, seed: int, starting_index: int = 0, count: int = NUM_POWERUPS, spawn_min_x: float = 0, spawn_max_x: float = MAP_SIZE-1, spawn_min_y: float = 0, spawn_max_y: float = MAP_SIZE-1) -> List[Powerup]:
         powerups = []
 
         common_rarity_max = self.powerup_info["Common"]["spawn_chance"]
@@ -357,7 +501,7 @@ class ShapeRoyale:
 
         rng = Random(seed)
 
-        for i in range(self.NUM_POWERUPS):
+        for i in range(count):
             rarity_number = rng.uniform(0.0, 1.0)
 
             if rarity_number <= legendary_rarity_max: rarity = "Legendary"
@@ -371,199 +515,566 @@ class ShapeRoyale:
 
         return powerups
 
+    def send_snapshots(self) -> None:
+        """Host only. Every client gets its own snapshot: its own shape, then other shapes by priority and the bullets closest to it, up to its byte budget.
+        Each shape and bullet is serialized once however many clients it goes to"""
+        shape_items = {player.index: dumps(player.to_full_dict()) for player in self.players}
+        sizes = {index: len(item) + 2 for index, item in shape_items.items()}
+        bullet_items = [(bullet, dumps(bullet.to_dict())) for bullet in self.bullets]
+
+        shapes_by_client = {player.client: player for player in self.players if player.client is not None}
+
+        for client in self.server.clients:
+            if client.dead:
+                self.replication.remove(client)
+                continue
+
+            if client in self.subscribers:
+                # One full stream per relay, however many spectators it has
+                client.send_encoded("player_update", encode_answer_list("player_update", shape_items.values(), {"t": self.last_snapshot_time}))
+                client.send_encoded("set_bullets", encode_answer_list("set_bullets", [item for _, item in bullet_items]))
+                continue
+
+            viewer = shapes_by_client.get(client)
+            budget = self.replication.budget(client)
+
+            selected, used = self.replication.select(client, viewer, self.players, sizes, budget)
+            client.send_encoded("player_update", encode_answer_list("player_update", [shape_items[shape.index] for shape in selected], {"t": self.last_snapshot_time}))
+
+            if viewer is None:
+                continue
+
+            close_bullets = []
+            for bullet, item in sorted(bullet_items, key=lambda bullet_item: dist((bullet_item[0].x, bullet_item[0].y), (viewer.x, viewer.y))):
+                used += len(item) + 2
+                if used > budget:
+                    break
+
+                close_bullets.append(item)
+
+            client.send_encoded("set_bullets", encode_answer_list("set_bullets", close_bullets))
+
+    def submit_snapshots(self) -> None:
+        """Host only. send_snapshots on the snapshot workers, the game thread only packs the shapes and bullets and works out the budgets.
+        The payloads are sent as they come back, a frame or so later"""
+        shapes_by_client = {player.client: player for player in self.players if player.client is not None}
+
+        jobs = []
+        for client in self.server.clients:
+            if client.dead:
+                self.snapshot_workers.forget(client)
+                continue
+
+            jobs.append((client, shapes_by_client.get(client), client in self.subscribers, self.replication.budget(client)))
+
+        self.snapshot_workers.submit(self.last_snapshot_time, self.players, self.bullets, jobs)
+
+    def server_stats(self) -> dict[str, any]:
+        """Host only. How long the simulation takes per frame, see loadtest.py"""
+        tick_times = sorted(self.tick_times)
+        if len(tick_times) == 0:
+            tick_times = [0.0]
+
+        return {
+            "players": len(self.players), "clients": self.server.num_connections, "fps": self.clock.get_fps(),
+            "tick_ms": sum(tick_times) / len(tick_times), "tick_p95_ms": tick_times[int(len(tick_times) * 0.95)], "tick_max_ms": tick_times[-1],
+            "router": self.router.stats(), "snapshot_workers": self.snapshot_workers.stats() if self.snapshot_workers is not None else {}
+        }
+
+    def build_keyframe(self) -> str:
+        """Host only. The whole match in one message, see keyframe.py"""
+        return encode_keyframe({
+            "t": time(), "seeds": (self.powerup_stage_1_seed, self.powerup_stage_2_seed), "stage": 2 if self.has_done_bonus_powerups else 1,
+            "safezone": {"phase": self.safezone.phase_index, "walls": (self.safezone.left_wall, self.safezone.right_wall, self.safezone.top_wall, self.safezone.bottom_wall)},
+            "stage_2_bounds": self.powerup_stage_2_bounds,
+            "picked": self.picked_powerups.to_bytes(),
+            "shapes": [player.to_dict() | player.to_full_dict() for player in self.players],
+            "bullets": [bullet.to_dict() for bullet in self.bullets],
+            "dropped_powerups": [powerup.to_dict() for powerup in self.powerups if powerup.index >= self.FIRST_DROPPED_POWERUP_INDEX]
+        })
+
+    def send_keyframe(self, client: BaseClient, player: Shape | None, keyframe: str | None = None) -> None:
+        """Host only. Brings client up to date, player is the shape it controls (None to spectate) and gets a fresh rejoin token"""
+        answer = {"keyframe": keyframe if keyframe is not None else self.build_keyframe()}
+
+        if player is not None:
+            token = token_hex(8)
+            self.rejoin_tokens[player.index] = token
+            answer.update({"player_index": player.index, "token": token})
+
+        client.send({"answer": answer})
+
+    def join_client(self, client: BaseClient, starting_info: dict[str, any]) -> None:
+        """Host only. A client that connected after the match started takes over a bot, one of the shape it picked if there is one"""
+        self.joined_clients.add(client)
+
+        shape_index = starting_info.get("shape_index", 0)
+        shape_name = self.shape_names[shape_index] if 0 <= shape_index < len(self.shape_names) else None
+
+        bots = [player for player in self.players if not player.is_player and player.client is None]
+        if len(bots) == 0:
+            self.send_keyframe(client, None)
+            return
+
+        bot = min(bots, key=lambda bot: bot.shape_name != shape_name)
+        bot_name = bot.player_name
+
+        bot.client = client
+        bot.is_player = True
+        bot.set_player_name(starting_info.get("name", "player")[:25])
+
+        print(f"{bot.player_name} joined the match, taking over {bot_name}.")
+        self.send_keyframe(client, bot)
+
+    def rejoin_client(self, client: BaseClient, rejoin: dict[str, any]) -> None:
+        """Host only. A client whose connection dropped gets its shape back if it still has the right token, otherwise it spectates"""
+        self.joined_clients.add(client)
+
+        target_player = None
+        for player in self.players:
+            if player.index == rejoin.get("index"):
+                target_player = player
+                break
+
+        if target_player is None or self.rejoin_tokens.get(target_player.index) != rejoin.get("token"):
+            self.send_keyframe(client, None)
+            return
+
+        print(f"{target_player.player_name} reconnected.")
+
+        target_player.client = client
+        self.send_keyframe(client, target_player)
+
+    def apply_keyframe(self, answer: dict[str, any]) -> None:
+        """Client only. Replaces the whole match with the host's keyframe, used when joining and after reconnecting"""
+        keyframe = decode_keyframe(answer["keyframe"])
+        stage_1_seed, stage_2_seed = keyframe["seeds"]
+
+        # Powerups, the seeded layouts minus what has been picked up plus what dead players dropped
+        self.powerup_grid = [[[] for _ in range(self.NUM_POWERUP_SECTIONS)] for _ in range(self.NUM_POWERUP_SECTIONS)]
+        self.powerups = self.generate_powerups(stage_1_seed)
+        self.has_done_bonus_powerups = keyframe["stage"] >= 2
+        if self.has_done_bonus_powerups:
+            self.powerups.extend(self.generate_powerups(stage_2_seed, self.NUM_POWERUPS, self.STAGE_2_POWERUPS, *keyframe["stage_2_bounds"]))
+
+        self.picked_powerups = PowerupBitset(data=keyframe["picked"])
+        self.remove_powerups([powerup.index for powerup in self.powerups if powerup.index in self.picked_powerups])
+
+        for powerup_desc in keyframe["dropped_powerups"]:
+            new_powerup = Powerup(powerup_desc["x"], powerup_desc["y"], powerup_desc["rarity"], self.powerup_info, self.on_powerup_pickup, powerup_desc["index"], powerup_desc["name"])
+            self.powerups.append(new_powerup)
+            self.powerup_grid[floor(new_powerup.y / self.POWERUP_SECTION_SIZE)][floor(new_powerup.x / self.POWERUP_SECTION_SIZE)].append(new_powerup)
+
+        # Shapes and bullets. The bullet list is shared with the shapes so it's refilled rather than replaced
+        self.bullets.clear()
+        self.players = []
+        for player_desc in keyframe["shapes"]:
+            shape_name = player_desc["shape_name"]
+            new_player = Shape(
+                self.MAP_SIZE, player_desc["x"], player_desc["y"], player_desc["index"], shape_name, self.shape_info, self.shape_sprites,
+                self.bullets, self.bullet_img, player_desc["is_player"], [], None, player_desc["player_name"]
+            )
+            new_player.rotation = player_desc["rotation"]
+            for key in SHAPE_FLOAT_FIELDS:
+                setattr(new_player, key, player_desc[key])
+
+            self.players.append(new_player)
+
+        for bullet in keyframe["bullets"]:
+            target_player = None
+            for player in self.players:
+                if player.index == bullet["parent_index"]:
+                    target_player = player
+                    break
+
+            self.bullets.append(Bullet(target_player, bullet["x"], bullet["y"], bullet["velocity"], bullet["damage"], 1, 1, 1, 1, self.bullet_img))
+
+        self.safezone.set_state(keyframe["safezone"]["phase"], keyframe["safezone"]["walls"])
+
+        self.interpolator = Interpolator()
+        self.interpolator.push_snapshot(keyframe["t"], [(player.index, player.x, player.y, player.rotation) for player in self.players])
+
+        # Our own shape, or spectating if the host had none to give us
+        self.rejoin_token = answer.get("token")
+        self.starting_player = None
+        for player in self.players:
+            if player.index == answer.get("player_index"):
+                self.starting_player = player
+                break
+
+        self.spectating = self.starting_player is None
+        if self.spectating:
+            self.starting_player = self.players[0]
+        else:
+            self.starting_player.squad.append(self.starting_player)
+
+        self.spectator_index = self.players.index(self.starting_player)
+        self.spectator_player = self.starting_player
+        self.reported_spectate = None
+
+    def remove_powerups(self, indexes: Iterable[int]) -> None:
+        """Client only. Takes picked up powerups off the map in one pass over the powerup list"""
+        indexes = set(indexes)
+        if len(indexes) == 0:
+            return
+
+        remaining = []
+        for powerup in self.powerups:
+            if powerup.index not in indexes:
+                remaining.append(powerup)
+                continue
+
+            grid_square = self.powerup_grid[floor(powerup.y / self.POWERUP_SECTION_SIZE)][floor(powerup.x / self.POWERUP_SECTION_SIZE)]
+            if powerup in grid_square:
+                grid_square.remove(powerup)
+
+        self.powerups = remaining
+
+    def view_bounds(self) -> tuple[float, float, float, float]:
+        """Left, top, right and bottom of the map area on screen around the shape we follow, DRAW_MARGIN included"""
+        return (
+            self.player.x - self.WIDTH / 2 - self.DRAW_MARGIN, self.player.y - self.HEIGHT / 2 - self.DRAW_MARGIN,
+            self.player.x + self.WIDTH / 2 + self.DRAW_MARGIN, self.player.y + self.HEIGHT / 2 + self.DRAW_MARGIN
+        )
+
+    def powerups_in_view(self, left: float, top: float, right: float, bottom: float) -> List[Powerup]:
+        """The powerup grid doubles as the broadphase for drawing them"""
+        last_section = self.NUM_POWERUP_SECTIONS - 1
+        found = []
+
+        for y_tile in range(max(0, floor(top / self.POWERUP_SECTION_SIZE)), min(last_section, floor(bottom / self.POWERUP_SECTION_SIZE)) + 1):
+            for x_tile in range(max(0, floor(left / self.POWERUP_SECTION_SIZE)), min(last_section, floor(right / self.POWERUP_SECTION_SIZE)) + 1):
+                found.extend(self.powerup_grid[y_tile][x_tile])
+
+        return found
+
+    def try_reconnect(self) -> None:
+        """Client only. Called every frame while the connection to the host is down, asks for our shape back once a new connection is up"""
+        if self.reconnect_attempt is None:
+            if time() - self.last_reconnect_time >= self.RECONNECT_INTERVAL:
+                self.last_reconnect_time = time()
+                self.reconnect_attempt = self.client.network_loop.submit(self.client.open_connection())
+
+            return
+
+        if not self.reconnect_attempt.done():
+            return
+
+        attempt = self.reconnect_attempt
+        self.reconnect_attempt = None
+
+        try:
+            self.client.base_client = attempt.result()
+        except Exception as e:
+            print(f"ShapeRoyale - Error while reconnecting! {e}.")
+            return
+
+        if self.rejoin_token is not None:
+            self.client.send({"answer": {"rejoin": {"index": self.starting_player.index, "token": self.rejoin_token}}})
+        else:
+            self.client.send({"question": "keyframe"})
+
+    def play_sound(self, name: str) -> None:
+        if self.render_process is not None:
+            self.render_process.play_sound(name)
+        elif name in self.sounds:
+            self.sounds[name].play()
+
+    def step_spectator(self, step: int) -> None:
+        self.spectator_index = (self.spectator_index + step) % len(self.players)
+        self.spectator_player = self.player
+
     def on_powerup_pickup(self, powerup: Powerup) -> None:
         if powerup in self.powerups:
             self.powerups.remove(powerup)
 
-    def main(self) -> None:
-        dt_mut = 1
-        dt_sum = 0
+    def record_input(self, move: str, shoot: bool, dt: float) -> None:
+        """Client only. Remembers an input that has already been applied locally and sends the unsent ones at NET_TICK_RATE"""
+        self.input_seq += 1
+        command = [self.input_seq, move, int(shoot), round(dt, 4)]
+
+        self.pending_inputs.append(command)
+        self.unsent_inputs.append(command)
 
+        if time() - self.last_input_send_time >= 1 / self.NET_TICK_RATE and not self.client.base_client.dead:
+            self.client.send({"answer": {"player_input": {
+                "index": self.starting_player.index, "inputs": self.unsent_inputs, "view_time": self.interpolator.render_time
+            }}})
+            self.unsent_inputs = []
+            self.last_input_send_time = time()
+
+    def reconcile_inputs(self, ack: dict[str, any]) -> None:
+        """Client only. Snaps our shape to the host's authoritative position and replays the inputs it hasn't simulated yet"""
+        if self.starting_player not in self.players:
+            return
+
+        while len(self.pending_inputs) > 0 and self.pending_inputs[0][0] <= ack["seq"]:
+            self.pending_inputs.popleft()
+
+        self.starting_player.x = ack["x"]
+        self.starting_player.y = ack["y"]
+        self.starting_player.rotation = ack["rotation"]
+
+        for _, move, _, dt in self.pending_inputs:
+            self.starting_player.apply_input(move, dt)
+
+    def apply_remote_inputs(self, player: Shape, inputs: List[List[any]], view_time: float = 0.0) -> None:
+        """Host only. Simulates a client's inputs in order, skipping any that have already been applied.
+        view_time is the (host clock) time the client was showing the other shapes at.
+        The inputs' frame times are spent from a budget that refills with the host's clock, so a client can't move faster than real time"""
+        now = time()
+        player.input_budget = min(player.input_budget + now - player.input_budget_time, self.MAX_INPUT_BUDGET)
+        player.input_budget_time = now
+
+        for seq, move, shoot, dt in inputs[:self.MAX_INPUTS_PER_MESSAGE]:
+            if seq <= player.last_input_seq:
+                continue
+
+            player.last_input_seq = seq
+
+            dt = min(max(dt, 0), self.MAX_INPUT_DT)
+            if dt > player.input_budget:
+                continue # Dropped, the input_ack puts the client back where the host has it
+
+            player.input_budget -= dt
+            player.apply_input(move, dt)
+            if shoot and player.shoot() and view_time > 0:
+                player.bullets[-1].rewind = min(max(now - view_time, 0), self.MAX_REWIND)
+
+    def register_handlers(self) -> None:
+        """Every message the match reacts to, host handlers get the connection the message came from as well"""
         if self.server is not None:
-            player_data = [player.to_dict() for player in self.players]
-            for i, client in enumerate(self.server.clients):
-                client.send({"answer": {"powerup_set": {"seed": self.powerup_stage_1_seed, "stage": 1}}})
-                client.send({"answer": {"player_set": player_data}})
-                    #client.send({"answer": {"player_set": True}})
-                client.send({"answer": {"player_index": i+1}})
+            self.router.register("answer", "player_input", self.on_player_input)
+            self.router.register("answer", "ready", self.on_ready)
+            self.router.register("answer", "send_starting_info", self.on_send_starting_info)
+            self.router.register("answer", "rejoin", self.on_rejoin)
+            self.router.register("answer", "subscribe", self.on_subscribe)
+            self.router.register("question", "keyframe", self.on_keyframe_question)
+            self.router.register("question", "server_stats", self.on_server_stats_question)
+
+        elif self.client is not None:
+            self.router.register("answer", "player_update", self.on_player_update)
+            self.router.register("answer", "input_ack", self.on_input_ack)
+            self.router.register("answer", "winner", self.on_winner)
+            self.router.register("answer", "player_remove", self.on_player_remove)
+            self.router.register("answer", "set_bullets", self.on_set_bullets)
+            self.router.register("answer", "powerup_add", self.on_powerup_add)
+            self.router.register("answer", "powerups_picked", self.on_powerups_picked)
+            self.router.register("answer", "powerup_set", self.on_powerup_set)
+            self.router.register("answer", "keyframe", self.apply_keyframe)
+
+    # Host handlers
+
+    def on_player_input(self, client: BaseClient, query: dict[str, any]) -> None:
+        update = query["player_input"]
+        target_player = None
+        for player in self.players:
+            if player.index == update["index"]:
+                target_player = player
+                break
+
+        # Clients may only drive their own shape
+        if target_player is not None and target_player.client is client:
+            self.apply_remote_inputs(target_player, update["inputs"], update.get("view_time", 0.0))
+
+    def on_ready(self, client: BaseClient, query: dict[str, any]) -> None:
+        """Still in the main menu after the match started, it gets asked for its starting info once it's ready"""
+        if query["ready"] and client not in self.joined_clients and client not in self.invited_clients:
+            self.invited_clients.add(client)
+            client.send({"question": "send_starting_info"})
+
+    def on_send_starting_info(self, client: BaseClient, query: dict[str, any]) -> None:
+        if client not in self.joined_clients:
+            self.join_client(client, query["send_starting_info"])
+
+    def on_rejoin(self, client: BaseClient, query: dict[str, any]) -> None:
+        if client not in self.joined_clients:
+            self.rejoin_client(client, query["rejoin"])
+
+    def on_subscribe(self, client: BaseClient, query: dict[str, any]) -> None:
+        """A spectator relay, it gets the whole match once and then the full snapshot stream"""
+        if client not in self.subscribers:
+            self.subscribers.add(client)
+            self.joined_clients.add(client)
+            self.send_keyframe(client, None)
+
+    def on_keyframe_question(self, client: BaseClient, query: str) -> None:
+        client_player = None
+        for player in self.players:
+            if player.client is client:
+                client_player = player
+                break
+
+        self.send_keyframe(client, client_player)
+
+    def on_server_stats_question(self, client: BaseClient, query: str) -> None:
+        client.send({"answer": {"server_stats": self.server_stats()}})
+
+    # Client handlers
+
+    def on_player_update(self, query: dict[str, any]) -> None:
+        update = query["player_update"]
+        players_by_index = {player.index: player for player in self.players}
+        for player_update in update:
+            target_player = players_by_index.get(player_update["index"])
+            if target_player is not None:
+                for key, value in player_update.items():
+                    if key in ("x", "y", "rotation"):
+                        continue # Own shape is predicted and corrected by input_ack, the rest are interpolated
+
+                    setattr(target_player, key, value)
+
+                target_player.last_update = time()
+
+        self.interpolator.push_snapshot(query["t"], [
+            (player_update["index"], player_update["x"], player_update["y"], player_update["rotation"]) for player_update in update
+        ])
+
+    def on_input_ack(self, query: dict[str, any]) -> None:
+        self.reconcile_inputs(query["input_ack"])
+
+    def on_winner(self, query: dict[str, any]) -> None:
+        update = query["winner"]
+        target_player = None
+        for player in self.players:
+            if player.index == update["index"]:
+                target_player = player
+                break
+
+        if target_player is not None:
+            for key, value in update.items():
+                setattr(target_player, key, value)
+
+    def on_player_remove(self, query: dict[str, any]) -> None:
+        target_player = None
+        for player in self.players:
+            if player.index == query["player_remove"]:
+                target_player = player
+                break
+
+        if target_player is not None:
+            self.players.remove(target_player)
+            self.interpolator.remove(target_player.index)
+
+    def on_set_bullets(self, query: dict[str, any]) -> None:
+        players_by_index = {player.index: player for player in self.players}
 
-        if self.client is not None:
-            done = False
-            while not done:
-                for message in self.client.base_client.data_stream:
-                    for dtype, query in message.items():
-                        if dtype != "answer":
-                            continue
+        self.bullets = []
+        for bullet in query["set_bullets"]:
+            self.bullets.append(Bullet(players_by_index.get(bullet["parent_index"]), bullet["x"], bullet["y"], bullet["velocity"], bullet["damage"], 1, 1, 1, 1, self.bullet_img))
 
-                        if "powerup_set" in query:
-                            if query["powerup_set"]["stage"] == 1:
-                                self.powerups = self.generate_powerups(query["powerup_set"]["seed"])
-                            else:
-                                self.powerups.extend(self.generate_powerups(query["powerup_set"]["seed"], self.NUM_POWERUPS, int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall)))
+    def on_powerup_add(self, query: dict[str, any]) -> None:
+        powerup_desc = query["powerup_add"]
 
-                        elif "player_set" in query:
-                            self.players = [Shape(self.MAP_SIZE, player_desc["x"], player_desc["y"], player_desc["index"], player_desc["shape_name"], self.shape_info, self.shape_images[f"{player_desc["shape_name"]}Friendly"], self.shape_images[f"{player_desc["shape_name"]}Enemy"], self.bullets, self.bullet_img, player_desc["is_player"], player_desc["squad"], None, player_desc["player_name"]) for player_desc in query["player_set"]]
-                            for player in self.players:
-                                player.last_update = time()
+        new_powerup = Powerup(
+            powerup_desc["x"], powerup_desc["y"], powerup_desc["rarity"], self.powerup_info, self.on_powerup_pickup, powerup_desc["index"], powerup_desc["name"]
+        )
 
-                        elif "player_index" in query:
-                            self.spectator_index = query["player_index"]
-                            #self.spectating = True
+        self.powerups.append(new_powerup)
 
-                        if self.players == []:
-                            self.client.send({"question": "player_set"})
+        grid_square = self.powerup_grid[floor(new_powerup.y / self.POWERUP_SECTION_SIZE)][floor(new_powerup.x / self.POWERUP_SECTION_SIZE)]
+        grid_square.append(new_powerup)
 
-                        if self.powerups != [] and self.players != [] and self.spectator_index != 0: done = True
-                
-            self.player.squad.append(self.player)
-            self.starting_player = self.players[self.spectator_index]
+    def on_powerups_picked(self, query: dict[str, any]) -> None:
+        self.remove_powerups(self.picked_powerups.apply(query["powerups_picked"]))
+
+    def on_powerup_set(self, query: dict[str, any]) -> None:
+        if query["powerup_set"]["stage"] == 1:
+            self.powerups = self.generate_powerups(query["powerup_set"]["seed"])
+        else:
+            self.has_done_bonus_powerups = True
+            self.powerups.extend(self.generate_powerups(query["powerup_set"]["seed"], self.NUM_POWERUPS, self.STAGE_2_POWERUPS, *query["powerup_set"]["bounds"]))
+
+    def main(self) -> None:
+        dt_mut = 1
+        dt_sum = 0
+
+        if self.server is not None:
+            # Everyone starts from the same keyframe, only the shape it's sent with differs
+            keyframe = self.build_keyframe()
+            for player in self.players:
+                if player.client is not None and not player.client.dead:
+                    self.send_keyframe(player.client, player, keyframe)
+
+            for client in self.subscribers:
+                self.send_keyframe(client, None, keyframe)
+
+        if self.client is not None:
+            self.starting_player = None
+            while self.starting_player is None:
+                message = self.client.base_client.recv(timeout=self.HANDSHAKE_POLL_TIMEOUT)
+                if message == {}:
+                    self.client.send({"question": "keyframe"})
+
+                for dtype, query in message.items():
+                    if dtype == "answer" and "keyframe" in query:
+                        self.apply_keyframe(query)
 
         self.spectator_player = self.player
         while 1:
             if len(self.players) <= 1:
                 if len(self.players) == 0:
                     print(f"Tie")
+                    if self.headless:
+                        self.server.shutdown()
                     return
                 else:
                     print(f"Winner: {self.players[0]}")
+
+                    if self.headless:
+                        self.server.broadcast({"answer": {"winner": self.players[0].to_winner_dict()}})
+                        self.server.flush()
+                        self.server.shutdown()
+                        return
+
                     dt_mut *= 0.99
                     self.end_screen = EndScreen(self.screen, self.starting_player, self.players[0])
 
                     if self.server is not None:
-                        for client in self.server.clients:
-                            client.send({"answer": {"winner": self.player.to_winner_dict()}})
+                        self.server.broadcast({"answer": {"winner": self.player.to_winner_dict()}})
+
+            if self.headless and all(client.dead for client in self.server.clients if client not in self.subscribers):
+                if self.everyone_left_time is None:
+                    self.everyone_left_time = time()
+                elif time() - self.everyone_left_time >= self.EMPTY_SERVER_GRACE:
+                    print("Everyone left, ending the match.")
+                    self.server.shutdown()
+                    return
+            else:
+                self.everyone_left_time = None
 
             dt = (self.clock.tick(60) / 1000.0) * dt_mut
+            tick_start = perf_counter()
             dt_sum += dt
 
+            send_snapshot = self.server is not None and time() - self.last_snapshot_time >= 1 / self.SNAPSHOT_RATE
+
             if self.client is not None:
+                if self.client.base_client.dead and self.end_screen is None:
+                    self.try_reconnect()
+
                 for message in self.client.base_client.data_stream:
-                    for dtype, query in message.items():
-                        if dtype != "answer":
-                            continue
+                    self.router.dispatch(message)
 
-                        if "player_update" in query:
-                            update = query["player_update"]
-                            for player_update in update:
-                                target_player = None
-                                for player in self.players:
-                                    if player.index == player_update["index"]:
-                                        target_player = player
-                                        break
-
-                                if target_player is not None:
-                                    for key, value in player_update.items():
-                                        if key in ("x", "y", "rotation") and target_player == self.player and not self.spectating:
-                                            continue
-
-                                        setattr(target_player, key, value)
-
-                                    target_player.last_update = time()
-
-                        if "winner" in query:
-                            update = query["winner"]
-                            target_player = None
-                            for player in self.players:
-                                if player.index == update["index"]:
-                                    target_player = player
-                                    break
-                            
-                            if target_player is not None:
-                                for key, value in update.items():
-                                    setattr(target_player, key, value)
-
-                        if "player_remove" in query:
-                            target_player = None
-                            for player in self.players:
-                                if player.index == query["player_remove"]:
-                                    target_player = player
-                                    break
-                            
-                            if target_player is not None:
-                                #if target_player.index < self.spectator_index:
-                                #    self.spectator_index -= 1
-
-                                self.players.remove(target_player)
-
-                        if "set_bullets" in query:
-                            update = query["set_bullets"]
-                            self.bullets = []
-                            for bullet in update:
-                                target_player = None
-                                for player in self.players:
-                                    if player.index == bullet["parent_index"]:
-                                        target_player = player
-                                        break
-
-                                self.bullets.append(Bullet(target_player, bullet["x"], bullet["y"], bullet["velocity"], bullet["damage"], 1, 1, 1, 1, self.bullet_img))
-
-                        if "powerup_add" in query:
-                            powerup_desc = query["powerup_add"]
-
-                            new_powerup = Powerup(
-                                powerup_desc["x"], powerup_desc["y"], powerup_desc["rarity"], self.powerup_info, self.on_powerup_pickup, powerup_desc["index"], powerup_desc["name"]
-                            )
-
-                            self.powerups.append(new_powerup)
-
-                            grid_square = self.powerup_grid[floor(new_powerup.y / self.POWERUP_SECTION_SIZE)][floor(new_powerup.x / self.POWERUP_SECTION_SIZE)]
-                            grid_square.append(new_powerup)
-
-                        if "powerup_remove" in query:
-                            update = query["powerup_remove"]
-
-                            target_powerup = None
-                            for powerup in self.powerups:
-                                if powerup.index == update["powerup_index"]:
-                                    target_powerup = powerup
-                                    break
-                            
-                            if target_powerup is not None:
-                                grid_square = self.powerup_grid[floor(target_powerup.y / self.POWERUP_SECTION_SIZE)][floor(target_powerup.x / self.POWERUP_SECTION_SIZE)]
-                                if target_powerup in grid_square:
-                                    grid_square.remove(target_powerup)
-
-                                if target_powerup in self.powerups:
-                                    self.powerups.remove(target_powerup)
-
-                        if "powerup_set" in query:
-                            if query["powerup_set"]["stage"] == 1:
-                                self.powerups = self.generate_powerups(query["powerup_set"]["seed"])
-                            else:
-                                self.NUM_POWERUPS = self.NUM_POWERUP_SECTIONS * 10
-                                self.powerups.extend(self.generate_powerups(query["powerup_set"]["seed"], self.NUM_POWERUPS, int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall)))
+                for player in self.players:
+                    if player is self.starting_player:
+                        continue
+
+                    sample = self.interpolator.sample(player.index)
+                    if sample is not None:
+                        player.x, player.y, player.rotation = sample
 
             elif self.server is not None:
                 for client in self.server.clients:
                     for message in client.data_stream:
-                        for dtype, query in message.items():
-                            if dtype == "answer":
-                                if "player_pos_update" in query:
-                                    update = query["player_pos_update"]
-                                    target_player = None
-                                    for player in self.players:
-                                        if player.index == update["index"]:
-                                            target_player = player
-                                            break
-
-                                    if target_player is not None:
-                                        for key, value in update.items():
-                                            setattr(target_player, key, value)
-
-                                elif "player_shoot" in query:
-                                    target_player = None
-                                    for player in self.players:
-                                        if player.index == query["player_shoot"]["index"]:
-                                            target_player = player
-                                            break
-                                    
-                                    if target_player is not None:
-                                        target_player.shoot()
+                        self.router.dispatch(message, client)
 
-                            else:
-                                if "player_set" in query:
-                                    player_data = [player.to_dict() for player in self.players]
-                                    client.send({"answer": {"player_set": player_data}})
+                if self.snapshot_workers is not None:
+                    # Encoded while this frame was waiting, out straight away instead of at the end of the frame
+                    for client, mtype, payload in self.snapshot_workers.results():
+                        client.send_encoded(mtype, payload)
+
+                    self.server.flush()
 
             for event in pg.event.get():
                 if event.type == pg.QUIT:
@@ -575,15 +1086,9 @@ class ShapeRoyale:
                 if self.spectating:
                     if event.type == pg.MOUSEBUTTONDOWN:
                         if event.button == 3:
-                            self.spectator_index -= 1
-                            if self.spectator_index < 0:
-                                self.spectator_index = len(self.players) - 1
-
-                            self.spectator_player = self.player
-                            
+                            self.step_spectator(-1)
                         elif event.button == 1:
-                            self.spectator_index = (self.spectator_index + 1) % len(self.players)
-                            self.spectator_player = self.player
+                            self.step_spectator(1)
 
                 if event.type == pg.KEYDOWN:
                     #if event.key in [pg.K_LEFT, pg.K_RIGHT, pg.K_UP, pg.K_DOWN, pg.K_a, pg.K_d, pg.K_w, pg.K_s, pg.K_SPACE]:
@@ -593,6 +1098,36 @@ class ShapeRoyale:
                         if self.end_screen is not None:
                             self.__init__(self.screen)
 
+                    if event.key == pg.K_F3:
+                        if self.server is not None:
+                            self.server.dump_stats(self.NET_STATS_PATH, {"router": self.router.stats()})
+                        elif self.client is not None:
+                            self.client.dump_stats(self.NET_STATS_PATH, {"router": self.router.stats()})
+
+            keys = pg.key.get_pressed()
+            move = ""
+            if keys[pg.K_UP] or keys[pg.K_w]: move = "u"
+            elif keys[pg.K_RIGHT] or keys[pg.K_d]: move = "r"
+            elif keys[pg.K_DOWN] or keys[pg.K_s]: move = "d"
+            elif keys[pg.K_LEFT] or keys[pg.K_a]: move = "l"
+            shoot = keys[pg.K_SPACE]
+
+            if self.render_process is not None:
+                # The renderer has the window, so the keyboard and mouse too
+                move, shoot, spectator_steps, restarts, quit = self.render_process.controls()
+                if quit or not self.render_process.alive:
+                    self.render_process.shutdown()
+                    sys.exit(0)
+
+                if self.spectating and spectator_steps != self.spectator_steps:
+                    self.step_spectator(spectator_steps - self.spectator_steps)
+                self.spectator_steps = spectator_steps
+
+                if restarts != self.restarts:
+                    self.restarts = restarts
+                    if self.end_screen is not None:
+                        self.__init__(self.screen)
+
             num_powerups = len(self.powerups)
             num_powerups_in_sec = 0
             for y in self.powerup_grid:
@@ -604,84 +1139,86 @@ class ShapeRoyale:
 
             self.spectator_index = self.players.index(self.spectator_player)
 
+            # Lets a relay pick the shapes and bullets around what we're watching
+            if self.client is not None and self.spectating and self.spectator_player.index != self.reported_spectate and not self.client.base_client.dead:
+                self.client.send({"answer": {"spectate": self.spectator_player.index}})
+                self.reported_spectate = self.spectator_player.index
+
             self.anim_manager.update(dt)
             self.safezone.update(dt)
 
-            self.screen.fill((0, 0, 0))
-            self.safezone.blit(self.screen, self.player)
+            if self.renders:
+                self.screen.fill((0, 0, 0))
+                self.safezone.blit(self.screen, self.player)
 
             x_walls_dist = self.safezone.right_wall - self.safezone.left_wall
             y_walls_dist = self.safezone.bottom_wall - self.safezone.top_wall
 
             if x_walls_dist < self.MAP_SIZE / 1.66 and y_walls_dist < self.MAP_SIZE / 1.66 and not self.has_done_bonus_powerups and self.client is None:
-                self.NUM_POWERUPS = self.NUM_POWERUP_SECTIONS * 10 # half
-                self.powerups.extend(self.generate_powerups(self.powerup_stage_2_seed, self.NUM_POWERUPS, int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall)))
+                self.powerup_stage_2_bounds = (int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall))
+                self.powerups.extend(self.generate_powerups(self.powerup_stage_2_seed, self.NUM_POWERUPS, self.STAGE_2_POWERUPS, *self.powerup_stage_2_bounds))
                 self.has_done_bonus_powerups = True
 
                 if self.server is not None:
-                    for client in self.server.clients:
-                        client.send({"answer": {"powerup_set": {"seed": self.powerup_stage_2_seed, "stage": 2}}})
-
-            keys = pg.key.get_pressed()
+                    self.server.broadcast({"answer": {"powerup_set": {"seed": self.powerup_stage_2_seed, "stage": 2, "bounds": self.powerup_stage_2_bounds}}})
 
             if not self.spectating:
-                if keys[pg.K_UP] or keys[pg.K_w]: self.player.move_up(dt)
-                elif keys[pg.K_RIGHT] or keys[pg.K_d]: self.player.move_right(dt)
-                elif keys[pg.K_DOWN] or keys[pg.K_s]: self.player.move_down(dt)
-                elif keys[pg.K_LEFT] or keys[pg.K_a]: self.player.move_left(dt)
+                self.player.apply_input(move, dt)
 
                 if self.client is not None:
-                    if not self.spectating:
-                        self.client.send({"answer": {"player_pos_update": {"x": self.player.x, "y": self.player.y, "rotation": self.player.rotation, "index": self.player.index}}})
+                    self.record_input(move, shoot, dt)
 
-                if keys[pg.K_SPACE]:
+                if shoot:
                     if self.player.shoot():
-                        self.sounds["laserShoot"].play()
-                    
-                    if self.client is not None:
-                        if not self.spectating:
-                            self.client.send({"answer": {"player_shoot": {"index": self.player.index}}})
+                        self.play_sound("laserShoot")
 
                 elif keys[pg.K_LSHIFT]:
                     if self.player.showing_powerup_popup:
                         self.player.showing_powerup_popup = False
                 
-            self.minimap_surf.fill((0, 0, 0))
+            if self.renders:
+                self.minimap_surf.fill((0, 0, 0))
+
+                for powerup in self.powerups:
+                    self.minimap_surf.set_at((powerup.x / self.MAP_SIZE * 200, powerup.y / self.MAP_SIZE * 200), (255, 255, 255))
 
-            for powerup in self.powerups:
-                powerup.draw(self.screen, self.player)
-                self.minimap_surf.set_at((powerup.x / self.MAP_SIZE * 200, powerup.y / self.MAP_SIZE * 200), (255, 255, 255))
+                for powerup in self.powerups_in_view(*self.view_bounds()):
+                    powerup.draw(self.screen, self.player)
 
             dead_players = []
 
             for bullet in self.bullets:
                 bullet.move(dt)
 
+            rewound_frames = {}
+            if self.client is None:
+                now = time()
+                for bullet in self.bullets:
+                    if bullet.rewind > 0:
+                        rewound_frames[bullet] = self.position_history.frame_at(now - bullet.rewind)
+
             for i, player in enumerate(self.players):
                 #player.shoot()
                 player.update(dt)
 
-                left_wall, right_wall, top_wall, bottom_wall = self.safezone.get_wall_distance(player)
+                left_wall, right_wall, top_wall, bottom_wall = self.safezone.apply_damage(player)
 
                 closest_bullet = None
                 closest_dist = float('inf')
-                close_bullets = []
-
                 bullets_to_remove = []
                 for bullet in self.bullets:
-                    if player == self.player:
-                        bullet.draw(self.screen, self.player)
-
                     bullet_dist = dist((bullet.x, bullet.y), (player.x, player.y))
-                    #if bullet_dist < 2000:
-                    #    close_bullets.append(bullet)
-                    close_bullets.append(bullet)
                     
                     if bullet.parent == player: continue
 
-                    if player.global_rect.colliderect(bullet.rect):
+                    hit_rect = player.global_rect
+                    if rewound_frames.get(bullet) is not None:
+                        rewound_x, rewound_y = self.position_history.position(player.index, rewound_frames[bullet])
+                        hit_rect.move_ip(rewound_x - player.x, rewound_y - player.y)
+
+                    if hit_rect.colliderect(bullet.rect):
                         if player == self.player:
-                            self.sounds["hitHurt"].play()
+                            self.play_sound("hitHurt")
 
                         if self.client is None:
                             damage = bullet.hit(player)
@@ -705,10 +1242,6 @@ class ShapeRoyale:
                     if bullet in self.bullets:
                         self.bullets.remove(bullet)
 
-                if self.server is not None:
-                    if player.index != 0 and player.index <= len(self.server.clients):
-                        self.server.clients[player.index-1].send({"answer": {"set_bullets": [bullet.to_dict() for bullet in close_bullets]}})
-
                 close_powerups = []
                 closest_powerup = None
                 closest_dist = float('inf')
@@ -727,14 +1260,13 @@ class ShapeRoyale:
 
                             if powerup_dist <= player.rect.w:
                                 if player == self.player:
-                                    self.sounds["powerUp"].play()
+                                    self.play_sound("powerUp")
 
                                 if self.client is None or 1:
                                     self.powerup_grid[floor(powerup.y / self.POWERUP_SECTION_SIZE)][floor(powerup.x / self.POWERUP_SECTION_SIZE)].remove(powerup)
                                     
-                                    if self.server is not None:
-                                        for client in self.server.clients:
-                                            client.send({"answer": {"powerup_remove": {"powerup_index": powerup.index}}})
+                                    if self.client is None:
+                                        self.picked_powerups.add(powerup.index)
 
                                     powerup.pickup(player)
                             else:
@@ -749,7 +1281,6 @@ class ShapeRoyale:
                     #pg.draw.circle(self.screen, (255, 255, 255), (closest_powerup.x - closest_powerup.image.width // 2 - (player.x - self.WIDTH // 2 + closest_powerup.image.width // 2), closest_powerup.y - closest_powerup.image.height // 2 - (player.y - self.HEIGHT // 2 + closest_powerup.image.height // 2)), 5)
 
                 player.set_close_powerups(close_powerups)
-                player.draw(self.screen, self.player)
 
                 closest_player = None
                 closest_dist = float('inf')
@@ -782,16 +1313,12 @@ class ShapeRoyale:
                         if self.server is None:
                             player.ai_move(dt, (int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall)), (left_wall_dist, right_wall_dist, top_wall_dist, bottom_wall_dist), closest_powerup, closest_player, closest_bullet)
                         else:
-                            if player.index > len(self.server.clients):
+                            if player.client is None:
                                 player.ai_move(dt, (int(self.safezone.left_wall), int(self.safezone.right_wall), int(self.safezone.top_wall), int(self.safezone.bottom_wall)), (left_wall_dist, right_wall_dist, top_wall_dist, bottom_wall_dist), closest_powerup, closest_player, closest_bullet)
 
                 if player.dead and self.client is None:
                     dead_players.append(player)
 
-                if self.client is not None:
-                    if time() - player.last_update > 3:
-                        player.x = -1000
-
             for dead_player in dead_players:
                 if len(self.players) == 1: continue
 
@@ -799,17 +1326,16 @@ class ShapeRoyale:
                     self.spectating = True
 
                 for rarity, powerup_info, on_pickup in dead_player.collected_powerups:
-                    new_powerup = Powerup(min(self.MAP_SIZE_X - 1, max(0, dead_player.x + randint(-50, 50))), min(self.MAP_SIZE_Y-1, max(0, dead_player.y + randint(-50, 50))), rarity, powerup_info, on_pickup, len(self.powerups))
+                    new_powerup = Powerup(min(self.MAP_SIZE_X - 1, max(0, dead_player.x + randint(-50, 50))), min(self.MAP_SIZE_Y-1, max(0, dead_player.y + randint(-50, 50))), rarity, powerup_info, on_pickup, self.next_powerup_index)
+                    self.next_powerup_index += 1
                     self.powerups.append(new_powerup)
                     self.powerup_grid[floor(new_powerup.y / self.POWERUP_SECTION_SIZE)][floor(new_powerup.x / self.POWERUP_SECTION_SIZE)].append(new_powerup)
 
                     if self.server is not None:
-                        for client in self.server.clients:
-                            client.send({"answer": {"powerup_add": new_powerup.to_dict()}})
+                        self.server.broadcast({"answer": {"powerup_add": new_powerup.to_dict()}})
 
                 if self.server is not None:
-                    for client in self.server.clients:
-                        client.send({"answer": {"player_remove": dead_player.index}})
+                    self.server.broadcast({"answer": {"player_remove": dead_player.index}})
 
                 self.players.remove(dead_player)
                 
@@ -818,29 +1344,60 @@ class ShapeRoyale:
 
                 self.dead_players.append(dead_player)
 
+            if self.renders:
+                view = self.view_bounds()
+
+                # Bullets go under the shapes and their name and health bars
+                self.bullet_grid.rebuild(self.bullets)
+                Bullet.draw_all(self.screen, self.bullet_grid.query(*view), self.player)
+
+                # The grid hands them back by cell, sorting keeps overlapping shapes stacked the same way every frame with the followed one on top
+                self.shape_grid.rebuild(self.players)
+                for player in sorted(self.shape_grid.query(*view), key=lambda player: (player is self.player, player.index)):
+                    player.draw(self.screen, self.player)
+
             if self.server is not None:
-                game_player_info = {"answer": {"player_update": [game_player.to_full_dict() for game_player in self.players]}}
-                for client in self.server.clients:
-                    client.send(game_player_info)
+                self.position_history.record(time(), self.players)
+
+            if send_snapshot:
+                self.last_snapshot_time = time()
+
+                picked = self.picked_powerups.delta(self.replicated_powerups)
+                if len(picked) > 0:
+                    self.server.broadcast({"answer": {"powerups_picked": picked}})
+                    self.replicated_powerups = self.picked_powerups.copy()
+
+                if self.snapshot_workers is not None:
+                    self.submit_snapshots()
+                else:
+                    self.send_snapshots()
+
+                for player in self.players:
+                    if player.client is not None:
+                        player.client.send({"answer": {"input_ack": {"seq": player.last_input_seq, "x": player.x, "y": player.y, "rotation": player.rotation}}})
 
             if self.starting_player.index != self.player.index:
                 self.spectating = True
 
-            pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, (self.safezone.left_wall - self.WIDTH / 2) / self.MAP_SIZE * 200, 200))
-            pg.draw.rect(self.minimap_surf, (255, 0, 0), ((self.safezone.right_wall) / self.MAP_SIZE * 200, 0, 200, 200))
-            pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, 200, (self.safezone.top_wall - self.HEIGHT / 2) / self.MAP_SIZE * 200))
-            pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, (self.safezone.bottom_wall + self.HEIGHT / 2) / self.MAP_SIZE * 200, 200, 200))
+            if self.renders:
+                pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, (self.safezone.left_wall - self.WIDTH / 2) / self.MAP_SIZE * 200, 200))
+                pg.draw.rect(self.minimap_surf, (255, 0, 0), ((self.safezone.right_wall) / self.MAP_SIZE * 200, 0, 200, 200))
+                pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, 200, (self.safezone.top_wall - self.HEIGHT / 2) / self.MAP_SIZE * 200))
+                pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, (self.safezone.bottom_wall + self.HEIGHT / 2) / self.MAP_SIZE * 200, 200, 200))
 
-            pg.draw.rect(self.minimap_surf, (0, 0, 255), (self.player.x / self.MAP_SIZE * 200 - 1, self.player.y / self.MAP_SIZE * 200 - 1, 2, 2))
+                pg.draw.rect(self.minimap_surf, (0, 0, 255), (self.player.x / self.MAP_SIZE * 200 - 1, self.player.y / self.MAP_SIZE * 200 - 1, 2, 2))
 
-            pg.draw.rect(self.screen, (255, 255, 255), (self.WIDTH - 252, 48, 204, 204), width=2)
-            self.screen.blit(self.minimap_surf, (self.WIDTH - 250, 50))
+                pg.draw.rect(self.screen, (255, 255, 255), (self.WIDTH - 252, 48, 204, 204), width=2)
+                self.screen.blit(self.minimap_surf, (self.WIDTH - 250, 50))
 
-            if self.spectating:
-                self.screen.blit(self.spectating_lbl, (self.WIDTH / 2 - self.spectating_lbl.width / 2, 50))
+                if self.spectating:
+                    self.screen.blit(self.spectating_lbl, (self.WIDTH / 2 - self.spectating_lbl.width / 2, 50))
 
-            self.screen.blit(self.fps_font.render(f"{self.clock.get_fps():.2f}", True, (255, 255, 255)), (20, 20))
-            self.screen.blit(self.fps_font.render(f"{self.spectator_index+1}/{len(self.players)}", True, (255, 255, 255)), (20, 40))
+                self.screen.blit(self.fps_font.render(f"{self.clock.get_fps():.2f}", True, (255, 255, 255)), (20, 20))
+                self.screen.blit(self.fps_font.render(f"{self.spectator_index+1}/{len(self.players)}", True, (255, 255, 255)), (20, 40))
+
+                if self.client is not None and self.client.rtt is not None:
+                    self.screen.blit(self.fps_font.render(f"{self.client.rtt * 1000:.0f}ms", True, (255, 255, 255)), (20, 60))
 
             self.powerup_section_index += 1
             if self.powerup_section_index >= self.NUM_POWERUP_SECTIONS: self.powerup_section_index = 0
@@ -856,9 +1413,25 @@ class ShapeRoyale:
                     self.server.shutdown()
                     self.server = None
 
-                self.end_screen.draw()
+                if self.renders:
+                    self.end_screen.draw()
 
-            pg.display.flip()
+            if self.server is not None:
+                self.server.flush()
+            elif self.client is not None:
+                self.client.flush()
+
+            self.tick_times.append((perf_counter() - tick_start) * 1000)
+
+            if self.render_process is not None:
+                self.render_process.publish(self, self.end_screen is not None and dt_mut < 0.10)
+            elif self.renders:
+                pg.display.flip()
 
 if __name__ == "__main__":
-    ShapeRoyale()
\ No newline at end of file
+    if HEADLESS:
+        # A dedicated server hosts one match after another
+        while True:
+            ShapeRoyale()
+    else:
+        ShapeRoyale()
\ No newline at end of file
@@ -3,13 +3,13 @@ import sys
 
 #from sound import generate_sine_wave
 
-from networking import Server, Client, BaseClient
+from networking import Server, Client, BaseClient, MessageRouter
 
 from utils import FONTS_PATH
 from shape import Player, Shape
 
 from json import loads
-from time import time
+from time import time, sleep
 
 class MainMenu:
     TIMER_LENGTH = 1
@@ -63,8 +63,36 @@ class MainMenu:
             for i in range(len(self.server.clients)):
                 self.player_info[i] = {"ready": False, "name": "player"}
 
+        self.server_ready = False
+        self.subscribers = set() # host only, connections that are spectator relays rather than players
+
+        self.router = MessageRouter()
+        if self.server is not None:
+            self.router.register("answer", "ready", self.on_ready)
+            self.router.register("answer", "subscribe", self.on_subscribe)
+        elif self.client is not None:
+            self.router.register("question", "send_starting_info", self.on_send_starting_info)
+
         self.main()
 
+    def on_ready(self, i: int, query: dict[str, any]) -> None:
+        """Host only, i is the client's position in the server's client list"""
+        player_name = query["name"]
+        if len(player_name) > 25:
+            player_name = player_name[:25]
+
+        self.player_info[i] = {"ready": query["ready"], "name": player_name}
+
+    def on_subscribe(self, i: int, query: dict[str, any]) -> None:
+        """Host only, a spectator relay. It never gets a shape so it doesn't hold up the start"""
+        self.subscribers.add(self.server.clients[i])
+        self.player_info[i] = {"ready": True, "name": "Spectator relay"}
+
+    def on_send_starting_info(self, query: str) -> None:
+        """Client only, the host is starting the game"""
+        self.client.send({"answer": {"send_starting_info": {"shape_index": self.player.shape_index, "name": self.player_name}}})
+        self.server_ready = True
+
     def reset_timer(self) -> None:
         self.timer_active = False
         self.timer_start_time = time()
@@ -83,8 +111,8 @@ class MainMenu:
                 self.server.sendall({"question": "send_starting_info"})
 
             if self.client is not None:
-                server_ready = False
-                while not server_ready:
+                self.server_ready = False
+                while not self.server_ready:
                     self.clock.tick(60)
 
                     pg.display.flip()
@@ -102,13 +130,11 @@ class MainMenu:
                                 return
 
                     self.client.send({"answer": {"ready": self.player.ready, "name": self.player_name}})
+                    self.client.flush()
 
                     #print("waiting for data stream")
                     for message in self.client.base_client.data_stream:
-                        for dtype, query in message.items():
-                            if dtype == "question" and query == "send_starting_info":
-                                self.client.send({"answer": {"send_starting_info": {"shape_index": self.player.shape_index, "name": self.player_name}}})
-                                server_ready = True
+                        self.router.dispatch(message)
 
             self.start_game = True
 
@@ -230,24 +256,95 @@ class MainMenu:
 
                 for i, client in enumerate(self.server.clients):
                     for message in client.data_stream:
-                        for dtype, query in message.items():
-                            if dtype != "answer":
-                                continue
-
-                            if "ready" in query:
-                                player_name = query["name"]
-                                if len(player_name) > 25:
-                                    player_name = player_name[:25]
-
-                                self.player_info[i] = {"ready": query["ready"], "name": player_name}
+                        self.router.dispatch(message, i)
 
             if self.client is not None:
                 self.client.send({"answer": {"ready": self.player.ready, "name": self.player_name}})
 
             self.check_game_start()
 
+            if self.server is not None:
+                self.server.flush()
+            elif self.client is not None:
+                self.client.flush()
+
             pg.display.flip()
 
+class ServerLobby:
+    """Lobby of a dedicated server. Nothing is drawn and there is no host player, the game starts once MIN_CLIENTS have joined and all of them are ready"""
+
+    TIMER_LENGTH = MainMenu.TIMER_LENGTH
+    TICK_RATE = 20 # lobby updates per second
+    MIN_CLIENTS = 1
+
+    def __init__(self, server: Server, min_clients: int = MIN_CLIENTS) -> None:
+        self.server = server
+        self.min_clients = min_clients
+
+        self.player_info = {}
+        self.ready_time = None
+        self.start_game = False
+        self.subscribers = set() # connections that are spectator relays rather than players
+
+        self.router = MessageRouter()
+        self.router.register("answer", "ready", self.on_ready)
+        self.router.register("answer", "subscribe", self.on_subscribe)
+
+        self.main()
+
+    def on_ready(self, i: int, query: dict[str, any]) -> None:
+        player_name = query["name"]
+        if len(player_name) > 25:
+            player_name = player_name[:25]
+
+        if query["ready"] != self.player_info[i]["ready"]:
+            print(f"{player_name} - Ready: {query['ready']}")
+
+        self.player_info[i] = {"ready": query["ready"], "name": player_name}
+
+    def on_subscribe(self, i: int, query: dict[str, any]) -> None:
+        """A spectator relay, it doesn't count towards MIN_CLIENTS"""
+        if self.server.clients[i] not in self.subscribers:
+            print("Spectator relay connected.")
+
+        self.subscribers.add(self.server.clients[i])
+
+    def check_game_start(self) -> None:
+        live_players = [
+            player_info for i, player_info in self.player_info.items() if not self.server.clients[i].dead and self.server.clients[i] not in self.subscribers
+        ]
+
+        if len(live_players) < self.min_clients or not all(player_info["ready"] for player_info in live_players):
+            if self.ready_time is not None:
+                print("Countdown cancelled.")
+
+            self.ready_time = None
+            return
+
+        if self.ready_time is None:
+            print(f"All {len(live_players)} players ready, starting in {self.TIMER_LENGTH}s...")
+            self.ready_time = time()
+
+        if time() - self.ready_time >= self.TIMER_LENGTH:
+            self.server.sendall({"question": "send_starting_info"})
+            self.start_game = True
+
+    def main(self) -> None:
+        print(f"Waiting for players ({self.min_clients} needed)...")
+
+        while not self.start_game:
+            sleep(1 / self.TICK_RATE)
+
+            for i, client in enumerate(self.server.clients):
+                if i not in self.player_info:
+                    self.player_info[i] = {"ready": False, "name": "player"}
+
+                for message in client.data_stream:
+                    self.router.dispatch(message, i)
+
+            self.check_game_start()
+            self.server.flush()
+
 class EndScreen:
     def __init__(self, screen: pg.Surface, my_player: Shape, winner: Shape | None) -> None:
         self.screen = screen
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import socket
+
+from collections import deque
+from random import Random
+from time import sleep
+from typing import Dict, List
+
+from networking import NetworkLoop, TRANSPORTS
+
+class LinkConditions:
+    """How bad one direction of an emulated link is. Times are in seconds, bandwidth in bytes per second (0 = unlimited)"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, bandwidth: float = 0, loss: float = 0.0, reorder: float = 0.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+
+    def __str__(self) -> str:
+        bandwidth = f"{self.bandwidth / 1024:.0f}KB/s" if self.bandwidth > 0 else "unlimited"
+        return f"{self.latency * 1000:.0f}ms +-{self.jitter * 1000:.0f}ms, {bandwidth}, {self.loss:.1%} loss, {self.reorder:.1%} reordered"
+
+class Link:
+    """One direction of one emulated connection. Everything sent is held back by the latency (plus jitter) and paced by the bandwidth cap.
+    A stream (TCP) link keeps the order and turns loss into a retransmission stall, a datagram (UDP) link drops, reorders and tail drops when its queue is full"""
+
+    RETRANSMIT_DELAY = 0.2 # seconds a lost TCP segment holds up the stream, roughly the minimum retransmission timeout
+    REORDER_DELAY = 0.02 # seconds a reordered datagram is held back on top of its normal delay
+    QUEUE_LIMIT = 64 * 1024 # bytes a datagram link buffers behind its bandwidth cap before it starts dropping
+    STREAM_QUEUE_LIMIT = 16 * 1024 # bytes a stream link buffers before it stops reading from its sender, so the backlog builds up in the sender's socket
+    RESUME_LIMIT = 4 * 1024 # bytes a paused stream link drains down to before it reads from its sender again
+
+    def __init__(self, direction: str, conditions: LinkConditions, ordered: bool, rng: Random) -> None:
+        self.direction = direction
+        self.conditions = conditions
+        self.ordered = ordered
+        self.rng = rng
+        self.loop = asyncio.get_running_loop()
+
+        self.free_time = 0.0 # when the emulated wire has finished sending everything queued so far
+        self.last_delivery = 0.0
+        self.in_flight = deque() # ordered links only, [when, data, deliver] in sending order
+        self.source = None # ordered links only, the transport the data comes from, so a full link pushes back on it like a real socket would
+        self.paused = False
+
+        self.sent = [0, 0] # [chunks, bytes]
+        self.dropped = 0
+        self.reordered = 0
+        self.stalled = 0
+        self.pauses = 0
+
+    def send(self, data: bytes, deliver: object) -> None:
+        """Calls deliver(data) once the data has made it across, or never if it was lost"""
+        now = self.loop.time()
+        conditions = self.conditions
+
+        if not self.ordered:
+            if self.rng.random() < conditions.loss:
+                self.dropped += 1
+                return
+
+            if conditions.bandwidth > 0 and (self.free_time - now) * conditions.bandwidth > self.QUEUE_LIMIT:
+                self.dropped += 1
+                return
+
+        arrival = now
+        if conditions.bandwidth > 0:
+            self.free_time = max(now, self.free_time) + len(data) / conditions.bandwidth
+            arrival = self.free_time
+
+            if self.ordered and self.source is not None and not self.paused and (self.free_time - now) * conditions.bandwidth > self.STREAM_QUEUE_LIMIT:
+                self.pause_source()
+
+        delay = max(0.0, conditions.latency + self.rng.uniform(-conditions.jitter, conditions.jitter))
+
+        if self.ordered:
+            if self.rng.random() < conditions.loss:
+                delay += self.RETRANSMIT_DELAY
+                self.stalled += 1
+
+            # Jitter can't reorder a byte stream
+            when = max(arrival + delay, self.last_delivery)
+        else:
+            if self.rng.random() < conditions.reorder:
+                delay += self.REORDER_DELAY
+                self.reordered += 1
+
+            when = arrival + delay
+
+        self.last_delivery = when
+        self.sent[0] += 1
+        self.sent[1] += len(data)
+
+        if not self.ordered:
+            self.loop.call_at(when, deliver, data)
+            return
+
+        # The event loop doesn't keep timers due at the same time in order, so only the oldest chunk of a stream is ever scheduled
+        self.in_flight.append((when, data, deliver))
+        if len(self.in_flight) == 1:
+            self.loop.call_at(when, self.deliver_next)
+
+    def pause_source(self) -> None:
+        """Nothing more is sent while the source is paused, so the queue drains to RESUME_LIMIT exactly when the wire gets that far"""
+        self.paused = True
+        self.pauses += 1
+        self.source.pause_reading()
+        self.loop.call_at(self.free_time - self.RESUME_LIMIT / self.conditions.bandwidth, self.resume_source)
+
+    def resume_source(self) -> None:
+        self.paused = False
+        if not self.source.is_closing():
+            self.source.resume_reading()
+
+    def deliver_next(self) -> None:
+        _, data, deliver = self.in_flight.popleft()
+        deliver(data)
+
+        if self.in_flight:
+            self.loop.call_at(self.in_flight[0][0], self.deliver_next)
+
+    def after_last(self, callback: object) -> None:
+        """Calls callback once everything already sent has been delivered, eg. to pass a close on"""
+        if self.in_flight:
+            self.in_flight.append((self.last_delivery, None, lambda _: callback()))
+            return
+
+        self.loop.call_at(max(self.loop.time(), self.last_delivery), callback)
+
+    def stats(self) -> Dict[str, int]:
+        return {"chunks": self.sent[0], "bytes": self.sent[1], "dropped": self.dropped, "reordered": self.reordered, "stalled": self.stalled, "pauses": self.pauses}
+
+class TcpPipe(asyncio.Protocol):
+    """One side of a proxied TCP connection. What it receives goes through its link and is written by the pipe on the other side"""
+
+    RECV_BUFFER = 16 * 1024 # bytes, the kernel would otherwise soak up megabytes on loopback before the sender notices its link is full
+
+    def __init__(self, proxy: "NetemProxy", link: Link) -> None:
+        self.proxy = proxy
+        self.link = link
+
+        self.transport = None
+        self.peer = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.link.source = transport
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECV_BUFFER)
+
+        if self.peer is None:
+            # Accepted from a client, nothing is read until the server side is connected
+            transport.pause_reading()
+            self.proxy.loop.create_task(self.connect_upstream())
+
+    async def connect_upstream(self) -> None:
+        upstream = TcpPipe(self.proxy, self.proxy.new_link("down"))
+        upstream.peer = self
+        self.peer = upstream
+
+        deadline = self.proxy.loop.time() + self.proxy.CONNECT_WAIT
+        while True:
+            try:
+                await self.proxy.loop.create_connection(lambda: upstream, self.proxy.target_host, self.proxy.target_port)
+                break
+            except Exception as e:
+                if self.proxy.loop.time() < deadline and not self.transport.is_closing():
+                    await asyncio.sleep(0.25)
+                    continue
+
+                print(f"NetemProxy - Error while connecting to {(self.proxy.target_host, self.proxy.target_port)}! {e}.")
+                self.transport.close()
+                return
+
+        self.transport.resume_reading()
+
+    def data_received(self, data: bytes) -> None:
+        self.link.send(data, self.peer.write)
+
+    def write(self, data: bytes) -> None:
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self.peer is not None:
+            self.link.after_last(self.peer.close)
+
+class UdpUpstream(asyncio.DatagramProtocol):
+    """The proxy's own socket towards the server for one client address"""
+
+    def __init__(self, proxy: "NetemProxy", client_addr: tuple[str, int]) -> None:
+        self.proxy = proxy
+        self.client_addr = client_addr
+
+        self.transport = None
+        self.up_link = proxy.new_link("up")
+        self.down_link = proxy.new_link("down")
+        self.last_active = proxy.loop.time()
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.proxy.server.remove(self)
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.last_active = self.proxy.loop.time()
+        self.down_link.send(data, lambda data: self.proxy.reply(data, self.client_addr))
+
+    def send(self, data: bytes) -> None:
+        self.last_active = self.proxy.loop.time()
+        self.up_link.send(data, self.write)
+
+    def write(self, data: bytes) -> None:
+        if not self.transport.is_closing():
+            self.transport.sendto(data)
+
+    def error_received(self, exc: Exception) -> None:
+        # Nobody listening on the server's port any more, the client's next datagram opens a fresh upstream
+        self.transport.close()
+
+class UdpListener(asyncio.DatagramProtocol):
+    """The proxy's socket clients talk to. Every client address gets its own upstream socket so the server still sees separate peers"""
+
+    IDLE_TIMEOUT = 30 # seconds without a datagram either way before an upstream socket is closed, longer than any side waits before giving up
+    EXPIRE_INTERVAL = 5 # seconds
+
+    def __init__(self, proxy: "NetemProxy") -> None:
+        self.proxy = proxy
+        self.transport = None
+        self.expire_handle = None
+
+        self.upstreams: Dict[tuple[str, int], UdpUpstream] = {}
+        self.pending: Dict[tuple[str, int], List[bytes]] = {} # datagrams that arrived while the upstream socket was being opened
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.expire()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+
+    def expire(self) -> None:
+        now = self.proxy.loop.time()
+        for upstream in list(self.upstreams.values()):
+            if now - upstream.last_active > self.IDLE_TIMEOUT:
+                upstream.transport.close()
+
+        self.expire_handle = self.proxy.loop.call_later(self.EXPIRE_INTERVAL, self.expire)
+
+    def remove(self, upstream: UdpUpstream) -> None:
+        if self.upstreams.get(upstream.client_addr) is upstream:
+            del self.upstreams[upstream.client_addr]
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        upstream = self.upstreams.get(addr)
+        if upstream is not None:
+            upstream.send(data)
+            return
+
+        if addr not in self.pending:
+            self.pending[addr] = []
+            self.proxy.loop.create_task(self.open_upstream(addr))
+
+        self.pending[addr].append(data)
+
+    async def open_upstream(self, addr: tuple[str, int]) -> None:
+        upstream = UdpUpstream(self.proxy, addr)
+
+        try:
+            await self.proxy.loop.create_datagram_endpoint(lambda: upstream, remote_addr=(self.proxy.target_host, self.proxy.target_port))
+        except Exception as e:
+            print(f"NetemProxy - Error while opening an upstream socket for {addr}! {e}.")
+            self.pending.pop(addr, None)
+            return
+
+        self.upstreams[addr] = upstream
+        for data in self.pending.pop(addr, []):
+            upstream.send(data)
+
+    def error_received(self, exc: Exception) -> None:
+        ...
+
+class NetemProxy:
+    """Loopback proxy that makes a local connection behave like a bad one, so netcode changes can be measured repeatably on one machine.
+    Clients connect to listen_port instead of the server, up is the client -> server direction and down the server -> client one.
+    Runs on the shared network loop, so it can live in the same process as a Client or the load generator"""
+
+    CONNECT_WAIT = 10 # seconds an accepted TCP connection keeps trying to reach the server, so the proxy can be up before the server is
+
+    def __init__(self, listen_host: str, listen_port: int, target_host: str, target_port: int, transport: str = "tcp",
+                 up: LinkConditions | None = None, down: LinkConditions | None = None, seed: int | None = None) -> None:
+        if transport not in TRANSPORTS:
+            raise Exception(f"NetemProxy - Unknown transport \"{transport}\"! Expected one of {TRANSPORTS}.")
+
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.target_host = target_host
+        self.target_port = target_port
+        self.transport = transport
+
+        self.up = up or LinkConditions()
+        self.down = down or self.up
+
+        self.rng = Random(seed)
+        self.links: List[Link] = []
+
+        self.network_loop = NetworkLoop.get()
+        self.loop = self.network_loop.loop
+        self.server = None
+
+        self.network_loop.submit(self.start()).result()
+
+    async def start(self) -> None:
+        if self.transport == "tcp":
+            self.server = await self.loop.create_server(lambda: TcpPipe(self, self.new_link("up")), self.listen_host, self.listen_port)
+        else:
+            _, self.server = await self.loop.create_datagram_endpoint(lambda: UdpListener(self), local_addr=(self.listen_host, self.listen_port))
+
+        print(f"Emulating a bad {self.transport} link on {(self.listen_host, self.listen_port)} -> {(self.target_host, self.target_port)}...")
+        print(f"    up:   {self.up}")
+        print(f"    down: {self.down}")
+
+    def new_link(self, direction: str) -> Link:
+        """Runs on the network thread. direction is "up" (client -> server) or "down" (server -> client)"""
+        link = Link(direction, self.up if direction == "up" else self.down, self.transport == "tcp", Random(self.rng.random()))
+        self.links.append(link)
+
+        return link
+
+    def reply(self, data: bytes, addr: tuple[str, int]) -> None:
+        """UDP only, sends a datagram from the server back to the client at addr"""
+        if not self.server.transport.is_closing():
+            self.server.transport.sendto(data, addr)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Totals per direction"""
+        totals = {"up": {}, "down": {}}
+
+        for link in list(self.links):
+            direction = totals[link.direction]
+            for key, value in link.stats().items():
+                direction[key] = direction.get(key, 0) + value
+
+        return totals
+
+    def shutdown(self) -> None:
+        self.network_loop.call_soon(self.close)
+
+    def close(self) -> None:
+        """Runs on the network thread. Stops accepting, connections already proxied over TCP carry on until either side closes them"""
+        if self.transport == "tcp":
+            self.server.close()
+            return
+
+        for upstream in list(self.server.upstreams.values()):
+            upstream.transport.close()
+
+        self.server.transport.close()
+
+def add_condition_arguments(parser: argparse.ArgumentParser) -> None:
+    """The link options shared by netem.py and loadtest.py"""
+    parser.add_argument("--latency", type=float, default=0, help="one way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random +- ms on top of the latency")
+    parser.add_argument("--bandwidth", type=float, default=0, help="KB/s per direction per connection, 0 for unlimited")
+    parser.add_argument("--loss", type=float, default=0, help="fraction of packets lost (TCP: stalls the stream instead)")
+    parser.add_argument("--reorder", type=float, default=0, help="fraction of UDP packets delivered late")
+    parser.add_argument("--seed", type=int, help="makes the losses and jitter repeatable")
+
+def conditions_from_args(args: argparse.Namespace) -> LinkConditions:
+    return LinkConditions(args.latency / 1000, args.jitter / 1000, args.bandwidth * 1024, args.loss, args.reorder)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proxies ShapeRoyale connections through an emulated bad network. Point clients (main.py join, loadtest.py --no-spawn) at --listen.")
+    parser.add_argument("--listen", type=int, default=31416, help="port clients connect to")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server and of the proxy")
+    parser.add_argument("--port", type=int, default=31415, help="port of the server")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp")
+    add_condition_arguments(parser)
+    args = parser.parse_args()
+
+    proxy = NetemProxy(args.host, args.listen, args.host, args.port, args.transport, conditions_from_args(args), seed=args.seed)
+
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        print(f"Emulated link: {proxy.stats()}")
+        proxy.shutdown()
@@ -1,146 +1,1164 @@
+import asyncio
 import json
 import socket
+import struct
 import zlib
 
-from time import sleep
-from threading import Thread
-from typing import Generator
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Event, Condition, Lock
+from time import time, perf_counter
+from typing import Generator, Coroutine, Iterable, List
 
-class BaseClient:
-    def __init__(self, conn: socket.socket, addr: tuple[str, int], is_client: bool) -> None:
-        self.conn = conn
-        self.addr = addr
-        #self.sockname = list(self.conn.getsockname())
+TRANSPORTS = ("tcp", "udp")
+
+# Messages where only the newest copy matters. A queued one is dropped as soon as a newer one of the same type arrives
+STATE_MESSAGES = ("player_update", "set_bullets", "input_ack", "ready", "ping", "pong")
+
+# State messages that only carry part of the state (the shapes the ReplicationScheduler picked), so a newer one doesn't make a queued one redundant
+DELTA_MESSAGES = ("player_update",)
+SUPERSEDED_MESSAGES = tuple(mtype for mtype in STATE_MESSAGES if mtype not in DELTA_MESSAGES)
+
+# State messages only the game reads. They are queued still encoded and decoded on the game thread, a superseded one never is
+DEFERRED_MESSAGES = ("player_update", "set_bullets", "input_ack", "ready")
+
+# First byte of every payload, says how the rest of it is encoded
+FRAME_RAW = 0 # plain JSON
+FRAME_STREAM = 1 # deflate, continuing the connection's compression stream
+FRAME_STANDALONE = 2 # deflate with the preset dictionary, decodable on its own
+
+# Second byte of every payload, which state message it holds (0 for everything else) so the receiver knows without decoding it
+STATE_TYPE_IDS = {mtype: i + 1 for i, mtype in enumerate(STATE_MESSAGES)}
+STATE_TYPES = {type_id: mtype for mtype, type_id in STATE_TYPE_IDS.items()}
+PAYLOAD_HEADER_SIZE = 2
+
+COMPRESS_THRESHOLD = 96 # bytes of JSON, anything smaller is sent as is
+SYNC_FLUSH_TAIL = b"\x00\x00\xff\xff" # every Z_SYNC_FLUSH ends with this, so it is stripped before sending and put back on arrival
+
+def build_zdict() -> bytes:
+    """Preset deflate dictionary made of typical messages, so even the first (or a standalone) message compresses well.
+    Most common messages go last as zlib favours the end of the dictionary"""
+    samples = [
+        {"question": "send_starting_info"}, {"question": "keyframe"}, {"answer": {"ready": True, "name": "player"}},
+        {"answer": {"send_starting_info": {"shape_index": 0, "name": "player"}}},
+        {"answer": {"powerup_set": {"seed": 1234567890, "stage": 1}}}, {"answer": {"player_index": 1}},
+        {"answer": {"player_set": [{"x": 15000, "y": 15000, "index": 0, "shape_name": "Square", "is_player": True, "squad": [], "player_name": "Bot 1"}]}},
+        {"answer": {"winner": {"index": 0, "kills": 0, "shots_hit": 0, "shots_fired": 0, "total_damage": 0.0, "num_common_picked": 0, "num_uncommon_picked": 0, "num_rare_picked": 0, "num_legendary_picked": 0}}},
+        {"answer": {"powerup_add": {"x": 15000, "y": 15000, "rarity": "Uncommon", "index": 480, "name": "Health Pack"}}},
+        {"answer": {"player_remove": 12}}, {"answer": {"powerups_picked": [[123, 1], [480, 2]]}},
+        {"answer": {"set_bullets": [{"x": 15000.0, "y": 15000.0, "velocity": [0, -80.0], "damage": 8, "parent_index": 1}]}},
+        {"answer": {"player_input": {"index": 1, "inputs": [[1, "u", 0, 0.0167], [2, "r", 1, 0.0167]]}}},
+        {"answer": {"input_ack": {"seq": 1, "x": 15000.0, "y": 15000.0, "rotation": 0}}},
+        {"answer": {"player_update": [
+            {"x": 15000.0, "y": 15000.0, "index": 1, "rotation": 90, "max_hp": 100, "max_shield": 100, "max_speed": 15, "damage": 8, "firerate": 1.3, "bullet_speed": 10.0,
+             "penetration": 1.2, "shield_regen_rate": 1.0, "lifesteal": 1.0, "poison_damage": 0, "zone_resistance": 1.0, "health_regen_rate": 1.2, "damage_growth": 0.0, "hp": 100.0, "shield": 100.0}
+        ], "t": 1700000000.0}}
+    ]
+
+    return "".join(json.dumps(sample) for sample in samples).encode()
+
+ZDICT = build_zdict()
+
+def compress_standalone(data: bytes) -> bytes:
+    compressor = zlib.compressobj(wbits=-15, zdict=ZDICT)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_standalone(data: bytes | memoryview) -> bytes:
+    return zlib.decompressobj(wbits=-15, zdict=ZDICT).decompress(data)
+
+def payload_header(frame_type: int, mtype: str) -> bytes:
+    return bytes((frame_type, STATE_TYPE_IDS.get(mtype, 0)))
+
+def encode_standalone(json_data: dict[any, any]) -> bytes:
+    """Encodes a payload that doesn't depend on any connection's compression stream, so the same bytes can go to everyone"""
+    return encode_standalone_data(json.dumps(json_data).encode(), message_type(json_data))
+
+def encode_answer_list(key: str, items: Iterable[str], extra: dict[str, any] | None = None) -> bytes:
+    """Standalone payload of {"answer": {key: [items...], **extra}} where the items are already JSON, so items that go to several clients are serialized once"""
+    extra_json = "".join(f", {json.dumps(name)}: {json.dumps(value)}" for name, value in (extra or {}).items())
+    return encode_standalone_data(f'{{"answer": {{{json.dumps(key)}: [{", ".join(items)}]{extra_json}}}}}'.encode(), key)
+
+def encode_standalone_data(data: bytes, mtype: str) -> bytes:
+    if len(data) < COMPRESS_THRESHOLD:
+        return payload_header(FRAME_RAW, mtype) + data
+
+    return payload_header(FRAME_STANDALONE, mtype) + compress_standalone(data)
+
+def decode_standalone(payload: bytes | memoryview) -> dict[any, any]:
+    """Inverse of encode_standalone"""
+    frame_type = payload[0]
+    data = payload[PAYLOAD_HEADER_SIZE:]
+
+    if frame_type == FRAME_STANDALONE:
+        data = decompress_standalone(data)
+    elif frame_type != FRAME_RAW:
+        raise ValueError(f"Frame type {frame_type} can't be decoded on its own")
+
+    return json.loads(bytes(data))
+
+def merge_deltas(mtype: str, old_payload: bytes, new_payload: bytes) -> bytes:
+    """Standalone payload of a DELTA_MESSAGES type holding the items (by index) of both, the newer copy of those in both"""
+    old_answer = decode_standalone(old_payload)["answer"]
+    new_answer = decode_standalone(new_payload)["answer"]
+
+    items = {item["index"]: item for item in old_answer[mtype]}
+    items.update((item["index"], item) for item in new_answer[mtype])
+
+    return encode_standalone({"answer": {**new_answer, mtype: list(items.values())}})
+
+def message_type(json_data: dict[any, any]) -> str:
+    """Returns the tag a message is routed by, eg. {"answer": {"player_update": [...]}} -> "player_update" and {"question": "player_set"} -> "player_set" """
+    for query in json_data.values():
+        if isinstance(query, dict):
+            for key in query:
+                return key
+
+        return str(query)
+
+    return ""
+
+class MessageQueue:
+    """Bounded, thread-safe FIFO of messages. The network thread puts, the game thread gets (optionally blocking).
+    State messages supersede older queued copies of themselves, except delta messages which are all kept in order. When the queue is full a queued state message is dropped first, as the next one replaces it anyway,
+    and only then the oldest event.
+    Deferred state messages are queued still encoded (put_encoded) and decoded by whoever takes them, so a superseded one is never decoded at all."""
+
+    def __init__(self, maxsize: int = 1024, superseded_types: tuple[str] = SUPERSEDED_MESSAGES) -> None:
+        self.maxsize = maxsize
+        self.superseded_types = superseded_types
+
+        self.condition = Condition()
+        self.entries = deque() # [type, message] pairs, message is None once it has been superseded
+        self.tombstones = 0 # superseded entries still in entries, compacted away once they outnumber the live ones
+        self.latest_state = {}
+
+        self.depth = 0
+        self.max_depth = 0
+        self.received = 0
+        self.superseded = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def put(self, message: dict[any, any]) -> None:
+        self.add(message_type(message), message)
+
+    def put_encoded(self, mtype: str, payload: bytes) -> None:
+        """payload is a standalone payload (see encode_standalone) of type mtype"""
+        self.add(mtype, payload)
+
+    def add(self, mtype: str, message: dict[any, any] | bytes) -> None:
+        entry = [mtype, message]
+
+        with self.condition:
+            self.received += 1
+
+            if mtype in self.superseded_types:
+                old_entry = self.latest_state.pop(mtype, None)
+                if old_entry is not None:
+                    self.remove_entry(old_entry)
+                    self.superseded += 1
+
+            if self.depth >= self.maxsize:
+                self.evict()
+                self.dropped += 1
+
+            if mtype in self.superseded_types:
+                self.latest_state[mtype] = entry
+
+            self.entries.append(entry)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+            self.condition.notify()
+
+    def remove_entry(self, entry: list) -> None:
+        """Must be called with the condition held. Leaves a tombstone in entries, see compact"""
+        entry[1] = None
+        self.depth -= 1
+        self.tombstones += 1
+
+        if self.tombstones > max(self.depth, 16):
+            self.compact()
+
+    def compact(self) -> None:
+        """Must be called with the condition held. Without it a queue nobody reads would grow by a tombstone per superseded message"""
+        self.entries = deque(entry for entry in self.entries if entry[1] is not None)
+        self.tombstones = 0
+
+    def evict(self) -> None:
+        """Must be called with the condition held. Makes room for one message, a queued state message if there is one and otherwise the oldest event"""
+        if len(self.latest_state) > 0:
+            self.remove_entry(self.latest_state.pop(next(iter(self.latest_state))))
+        else:
+            self.pop_entry()
+
+    def pop_entry(self) -> dict[any, any] | bytes | None:
+        """Must be called with the condition held. The message may still be encoded, see decode"""
+        while len(self.entries) > 0:
+            mtype, message = self.entries.popleft()
+            if message is None:
+                self.tombstones -= 1
+                continue
+
+            if self.latest_state.get(mtype) is not None and self.latest_state[mtype][1] is message:
+                del self.latest_state[mtype]
+
+            self.depth -= 1
+            return message
+
+        return None
+
+    @staticmethod
+    def decode(message: dict[any, any] | bytes) -> dict[any, any] | None:
+        """Runs outside the lock so the network thread isn't held up by the decoding"""
+        if not isinstance(message, bytes):
+            return message
+
+        try:
+            return decode_standalone(message)
+        except Exception as e:
+            print(f"MessageQueue - Error while decoding a queued message! {e}.")
+            return None
+
+    def get(self, timeout: float | None = None) -> dict[any, any] | None:
+        """Blocks until a message is available. Returns None if the timeout runs out first"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.depth > 0, timeout):
+                return None
+
+            message = self.pop_entry()
+
+        return self.decode(message)
+
+    def drain(self) -> List[dict[any, any]]:
+        with self.condition:
+            messages = []
+            while self.depth > 0:
+                messages.append(self.pop_entry())
+
+        return [message for message in map(self.decode, messages) if message is not None]
+
+    def wake(self) -> None:
+        """Wakes any thread blocked in get, eg. when the connection dies"""
+        with self.condition:
+            self.condition.notify_all()
+
+    def stats(self) -> dict[str, int]:
+        with self.condition:
+            return {
+                "depth": self.depth, "max_depth": self.max_depth, "received": self.received, "superseded": self.superseded, "dropped": self.dropped
+            }
+
+class NetStats:
+    """Per connection counters: messages and bytes by message type in each direction, plus round trip time and clock offset from ping/pong"""
+
+    RTT_SMOOTHING = 0.125 # weight of a new sample in the smoothed round trip time
+    OFFSET_SAMPLES = 8 # the clock offset comes from the fastest of the last few pings, as those have the least queueing in them
+
+    def __init__(self) -> None:
+        self.start_time = time()
+
+        self.sent = {} # type -> [messages, bytes]
+        self.received = {}
+
+        self.rtt = None
+        self.smoothed_rtt = None
+        self.min_rtt = None
+        self.offset_samples = deque(maxlen=self.OFFSET_SAMPLES) # (rtt, offset) pairs
+        self.clock_offset = None # peer's clock - ours, in seconds
+
+    @staticmethod
+    def count(counters: dict[str, List[int]], mtype: str, size: int) -> None:
+        counter = counters.get(mtype)
+        if counter is None:
+            counters[mtype] = [1, size]
+        else:
+            counter[0] += 1
+            counter[1] += size
+
+    def count_sent(self, mtype: str, size: int) -> None:
+        self.count(self.sent, mtype, size)
+
+    def count_received(self, mtype: str, size: int) -> None:
+        self.count(self.received, mtype, size)
+
+    def add_pong(self, ping_time: float, peer_time: float) -> None:
+        """ping_time is when we sent the ping (our clock), peer_time is when the peer answered it (its clock)"""
+        now = time()
+        rtt = now - ping_time
+
+        self.rtt = rtt
+        self.smoothed_rtt = rtt if self.smoothed_rtt is None else self.smoothed_rtt + (rtt - self.smoothed_rtt) * self.RTT_SMOOTHING
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+        # Assume the answer was sent halfway through the round trip
+        self.offset_samples.append((rtt, peer_time - (ping_time + rtt / 2)))
+        self.clock_offset = min(self.offset_samples)[1]
+
+    def to_dict(self) -> dict[str, any]:
+        elapsed = max(time() - self.start_time, 1e-9)
+
+        def summarize(counters: dict[str, List[int]]) -> dict[str, any]:
+            by_type = {
+                mtype: {"messages": messages, "bytes": size, "bytes_per_sec": size / elapsed}
+                for mtype, (messages, size) in sorted(counters.copy().items(), key=lambda item: item[1][1], reverse=True)
+            }
+            total_bytes = sum(counter["bytes"] for counter in by_type.values())
+
+            return {
+                "messages": sum(counter["messages"] for counter in by_type.values()), "bytes": total_bytes, "bytes_per_sec": total_bytes / elapsed,
+                "by_type": by_type
+            }
+
+        return {
+            "elapsed": elapsed, "rtt": self.rtt, "smoothed_rtt": self.smoothed_rtt, "min_rtt": self.min_rtt, "clock_offset": self.clock_offset,
+            "sent": summarize(self.sent), "received": summarize(self.received)
+        }
+
+def merge_stats(stats: List[dict[str, any]]) -> dict[str, any]:
+    """Adds up the per type counters of several NetStats.to_dict() results"""
+    merged = {}
+
+    for direction in ("sent", "received"):
+        by_type = {}
+        for connection_stats in stats:
+            for mtype, counter in connection_stats[direction]["by_type"].items():
+                total = by_type.setdefault(mtype, {"messages": 0, "bytes": 0, "bytes_per_sec": 0.0})
+                total["messages"] += counter["messages"]
+                total["bytes"] += counter["bytes"]
+                total["bytes_per_sec"] += counter["bytes_per_sec"]
+
+        merged[direction] = {
+            "messages": sum(counter["messages"] for counter in by_type.values()), "bytes": sum(counter["bytes"] for counter in by_type.values()),
+            "bytes_per_sec": sum(counter["bytes_per_sec"] for counter in by_type.values()),
+            "by_type": dict(sorted(by_type.items(), key=lambda item: item[1]["bytes"], reverse=True))
+        }
+
+    return merged
+
+def dump_stats(path: str, stats: dict[str, any]) -> None:
+    try:
+        with open(path, "w") as file:
+            json.dump({"time": time(), **stats}, file, indent=4)
+    except Exception as e:
+        print(f"Networking - Error while dumping network stats! {e}.")
+
+class MessageRouter:
+    """Game side dispatch. Each (question or answer, message type) maps to one handler, called with the message's query plus whatever
+    dispatch was given (eg. the connection it came from). Keeps how long every handler takes so the expensive messages show up in the stats"""
+
+    def __init__(self) -> None:
+        self.handlers = {} # (dtype, message type) -> handler
+        self.timings = {} # "dtype:message type" -> [calls, total seconds, max seconds]
+        self.unhandled = 0
+
+    def register(self, dtype: str, mtype: str, handler: object) -> None:
+        self.handlers[(dtype, mtype)] = handler
+        self.timings[f"{dtype}:{mtype}"] = [0, 0.0, 0.0]
+
+    def dispatch(self, message: dict[any, any], *args: any) -> None:
+        for dtype, query in message.items():
+            if isinstance(query, dict):
+                mtype = next(iter(query), "")
+            else:
+                mtype = str(query)
+
+            handler = self.handlers.get((dtype, mtype))
+            if handler is None:
+                self.unhandled += 1
+                continue
+
+            start = perf_counter()
+            handler(*args, query)
+            elapsed = perf_counter() - start
+
+            timing = self.timings[f"{dtype}:{mtype}"]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+    def stats(self) -> dict[str, any]:
+        """Handlers that have run, most total time first"""
+        handlers = {
+            name: {"calls": calls, "total_ms": total * 1000, "mean_ms": total / calls * 1000, "max_ms": longest * 1000}
+            for name, (calls, total, longest) in self.timings.items() if calls > 0
+        }
+
+        return {"unhandled": self.unhandled, "handlers": dict(sorted(handlers.items(), key=lambda item: item[1]["total_ms"], reverse=True))}
+
+class NetworkLoop:
+    """A single asyncio event loop running on a daemon thread. Every Server, Client and BaseClient in the process shares it,
+    so the number of threads stays at one no matter how many sockets are open or how often they connect and disconnect."""
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls) -> "NetworkLoop":
+        if not hasattr(cls, "instance"):
+            cls.instance = cls()
+
+        return cls.instance
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedules a coroutine on the network thread. Returns a concurrent future so the game thread can block on it"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: object, *args: any) -> None:
+        self.loop.call_soon_threadsafe(callback, *args)
+
+class BaseClient(asyncio.BufferedProtocol):
+    HEADER_SIZE = 4 # bytes
+    RECV_BUFFER_SIZE = 256 * 1024 # bytes, grows if a single frame is bigger than this
+    STREAM_COMPRESSION = True
+
+    FLUSH_DELAY = 1 / 60 # seconds, the longest a queued message waits for an explicit flush
+    WRITE_BUFFER_HIGH = 64 * 1024 # bytes buffered by the transport before writing pauses and stale state starts being dropped
+    SEND_BUFFER = 64 * 1024 # bytes of kernel send buffer, left to autotune it grows to megabytes and a slow peer's backlog hides there instead of the transport
+    PING_INTERVAL = 1.0 # seconds
+
+    def __init__(self, is_client: bool, on_connect: object | None = None) -> None:
+        self.network_loop = NetworkLoop.get()
         self.is_client = is_client
+        self.on_connect = on_connect
+
+        self.transport = None
+        self.addr = None
 
         self.dead = False
-        self.raw_data_stream = []
+        self.connected = Event()
+        self.raw_data_stream = MessageQueue()
+
+        # The transport reads straight into this buffer (recv_into), frames are parsed out of it as memoryview slices
+        self.recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_start = 0 # first byte not parsed yet
+        self.recv_end = 0 # end of the received data
+
+        # Per connection deflate streams so small messages share history instead of each paying for a fresh zlib header
+        self.stream_lock = Lock()
+        self.compressor = zlib.compressobj(wbits=-15, zdict=ZDICT)
+        self.decompressor = zlib.decompressobj(wbits=-15, zdict=ZDICT)
 
-        self.disconnect_on_fail = not self.is_client
+        self.outgoing_lock = Lock()
+        self.outgoing = deque() # [type, frame, payload] entries, frame is None once a newer state message replaced it
+        self.latest_outgoing = {}
+        self.flush_pending = False
+        self.flush_handle = None
+        self.writing_paused = False
+
+        self.frames_sent = 0
+        self.batches_sent = 0
+        self.stale_dropped = 0
+
+        self.net_stats = NetStats()
+        self.ping_handle = None
 
-        self.recv_thread = Thread(target=self.poll_recv, daemon=True)
-        if not self.is_client:
-            self.recv_thread.start()
-    
     @property
     def data_stream(self) -> Generator:
-        data = self.raw_data_stream
-        self.raw_data_stream = []
-        yield from data
+        yield from self.raw_data_stream.drain()
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.type == socket.SOCK_STREAM and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+
+        transport.set_write_buffer_limits(high=self.WRITE_BUFFER_HIGH)
+        self.connected.set()
+        self.ping()
+
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if exc is not None:
+            print(f"BaseClient - Connection to {self.addr} lost! {exc}.")
+
+        self.dead = True
+        self.raw_data_stream.wake()
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+
+        if self.ping_handle is not None:
+            self.ping_handle.cancel()
+
+    def ping(self) -> None:
+        """Runs on the network thread every PING_INTERVAL. The peer's pong gives the round trip time and clock offset"""
+        if self.dead:
+            return
+
+        # Written straight away (along with anything else queued) so the flush delay doesn't end up in the round trip time
+        self.send({"question": "ping", "t": time()})
+        self.writer()
+
+        self.ping_handle = self.network_loop.loop.call_later(self.PING_INTERVAL, self.ping)
+
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        self.writer()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.recv_end == len(self.recv_buffer):
+            self.compact_recv_buffer(len(self.recv_buffer))
+
+        return self.recv_view[self.recv_end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.recv_end += nbytes
+
+        view = self.recv_view
+        start = self.recv_start
+
+        # A single read can hold several frames, handle all of them
+        while self.recv_end - start >= self.HEADER_SIZE:
+            data_size = int.from_bytes(view[start:start + self.HEADER_SIZE], byteorder="big")
+            frame_end = start + self.HEADER_SIZE + data_size
+
+            if frame_end > self.recv_end:
+                if frame_end - start > len(self.recv_buffer):
+                    self.recv_start = start
+                    self.compact_recv_buffer(frame_end - start)
+                    return
+
+                break
+
+            self.proc_recv(view[start + self.HEADER_SIZE:frame_end])
+            start = frame_end
+
+        if start == self.recv_end:
+            # Everything has been parsed, start writing at the front again without copying anything
+            self.recv_start = 0
+            self.recv_end = 0
+        else:
+            self.recv_start = start
+
+    def compact_recv_buffer(self, min_size: int) -> None:
+        """Moves the unparsed tail of a partial frame to the front of the buffer, growing it if that frame won't fit"""
+        leftover = bytes(self.recv_view[self.recv_start:self.recv_end])
+
+        if min_size > len(self.recv_buffer) or len(leftover) == len(self.recv_buffer):
+            self.recv_buffer = bytearray(max(min_size, len(self.recv_buffer) * 2))
+            self.recv_view = memoryview(self.recv_buffer)
+
+        self.recv_buffer[:len(leftover)] = leftover
+        self.recv_start = 0
+        self.recv_end = len(leftover)
 
     def disconnect(self) -> None:
         print(f"Disconnecting client {self.addr}.")
 
         self.dead = True
-        try:
-            self.recv_thread.join()
-        except Exception as e:
-            print(f"BaseClient - Error while joining recv_thread! {e}.")
+        if self.transport is not None:
+            self.network_loop.call_soon(self.close)
 
-    def poll_recv(self) -> None:
-        while 1:
-            data = self.recv()
-            if data == {}:
-                continue
+    def close(self) -> None:
+        """Runs on the network thread"""
+        self.transport.close()
 
-            self.raw_data_stream.append(data)
-        
     def sendnoto(self, json_data: dict[any, any]) -> None:
         self.send(json_data, to=False)
 
+    def encode(self, json_data: dict[any, any], mtype: str) -> bytes:
+        """Returns the payload, prefixed by its FRAME_* and state type bytes. State messages are compressed on their own so they can be dropped
+        (or skipped) without breaking the stream, everything else continues the connection's compression stream"""
+        if mtype in STATE_MESSAGES or not self.STREAM_COMPRESSION:
+            return encode_standalone(json_data)
+
+        data = json.dumps(json_data).encode()
+
+        if len(data) < COMPRESS_THRESHOLD:
+            return payload_header(FRAME_RAW, mtype) + data
+
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return payload_header(FRAME_STREAM, mtype) + compressed[:-len(SYNC_FLUSH_TAIL)]
+
+    def frame(self, mtype: str, payload: bytes) -> tuple[bytes, bytes]:
+        """The header and payload stay separate buffers so a broadcast payload is never copied per connection"""
+        return (len(payload).to_bytes(self.HEADER_SIZE, byteorder="big"), payload)
+
     def send(self, json_data: dict[any, any], to: bool = True) -> None:
-        #if to:
-        #    json_data["to"] = list(self.addr)
+        """Queues a message for the writer. Nothing touches the socket until the next flush (or FLUSH_DELAY passes)"""
+        if self.dead or self.transport is None:
+            return
 
-        data = json.dumps(json_data)
-        raw_data = zlib.compress(data.encode())
-        data_size = len(raw_data).to_bytes(4, byteorder="big") # 4 bytes
+        mtype = message_type(json_data)
 
-        try:
-            self.conn.sendto(data_size + raw_data, self.addr)
-            #self.conn.sendto(zlib.compress(raw_data), self.addr)
-        except Exception as e:
-            print(f"BaseClient - Error while sending data! {e}.")
+        # Frames have to be queued in the order they went through the compression stream
+        with self.stream_lock:
+            self.queue_frame(mtype, self.encode(json_data, mtype))
+
+    @property
+    def write_backlog(self) -> int:
+        """Bytes handed to the transport that haven't made it onto the wire yet"""
+        if self.transport is None or self.dead:
+            return 0
+
+        return self.transport.get_write_buffer_size()
+
+    def send_encoded(self, mtype: str, payload: bytes) -> None:
+        """Queues a payload that was already encoded with encode_standalone, see Server.broadcast"""
+        if self.dead or self.transport is None:
+            return
+
+        self.queue_frame(mtype, payload)
+
+    def queue_frame(self, mtype: str, payload: bytes) -> None:
+        merge_with = None
+
+        with self.outgoing_lock:
+            if self.writing_paused and mtype in STATE_MESSAGES:
+                # The peer isn't keeping up, so the queued snapshot will be stale by the time it could be sent
+                old_entry = self.latest_outgoing.get(mtype)
+                if old_entry is not None and old_entry[1] is not None:
+                    old_entry[1] = None
+                    self.stale_dropped += 1
+
+                    if mtype in DELTA_MESSAGES:
+                        merge_with = old_entry[2]
+
+        if merge_with is not None:
+            # The host already counts the shapes only the dropped one carried as sent, so they ride along in this one
+            try:
+                payload = merge_deltas(mtype, merge_with, payload)
+            except Exception as e:
+                print(f"BaseClient - Error while merging a stale {mtype}! {e}.")
+
+        entry = [mtype, self.frame(mtype, payload), payload]
+
+        with self.outgoing_lock:
+            self.latest_outgoing[mtype] = entry
+            self.outgoing.append(entry)
+
+            schedule = not self.flush_pending
+            self.flush_pending = True
+
+        if schedule:
+            try:
+                self.network_loop.call_soon(self.schedule_flush)
+            except Exception as e:
+                print(f"BaseClient - Error while sending data! {e}.")
+
+    def flush(self) -> None:
+        """Hands every message queued since the last flush to the writer. The game loop calls this once per tick"""
+        if self.dead or self.transport is None or not self.flush_pending:
+            return
 
-    def proc_recv(self, raw_data: bytes) -> None:
-        data = zlib.decompress(raw_data).decode()
-        #print(data)
+        self.network_loop.call_soon(self.writer)
 
+    def schedule_flush(self) -> None:
+        """Runs on the network thread. Makes sure queued messages go out even if nobody calls flush"""
+        if self.flush_handle is None and not self.dead:
+            self.flush_handle = self.network_loop.loop.call_later(self.FLUSH_DELAY, self.writer)
+
+    def writer(self) -> None:
+        """Runs on the network thread. Writes everything queued as one vectored write"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.writing_paused or self.transport.is_closing():
+            return
+
+        with self.outgoing_lock:
+            entries = [(mtype, frame) for mtype, frame, _ in self.outgoing if frame is not None]
+            self.outgoing.clear()
+            self.latest_outgoing.clear()
+            self.flush_pending = False
+
+        if len(entries) == 0:
+            return
+
+        self.write_frames([frame for _, frame in entries])
+        self.frames_sent += len(entries)
+        self.batches_sent += 1
+
+        for mtype, frame in entries:
+            self.net_stats.count_sent(mtype, self.frame_size(frame))
+
+    @staticmethod
+    def frame_size(frame: bytes | tuple[bytes, bytes]) -> int:
+        if isinstance(frame, tuple):
+            return sum(len(buffer) for buffer in frame)
+
+        return len(frame)
+
+    def write_frames(self, frames: List[tuple[bytes, bytes]]) -> None:
+        self.transport.writelines([buffer for frame in frames for buffer in frame])
+
+    def decode(self, raw_data: bytes | memoryview) -> dict[any, any] | None:
+        """Runs on the network thread. Returns None (and drops the connection) if the data is corrupt"""
         try:
+            frame_type = raw_data[0]
+
+            if frame_type == FRAME_RAW:
+                data = bytes(raw_data[PAYLOAD_HEADER_SIZE:])
+            elif frame_type == FRAME_STREAM:
+                data = self.decompressor.decompress(raw_data[PAYLOAD_HEADER_SIZE:]) + self.decompressor.decompress(SYNC_FLUSH_TAIL)
+            elif frame_type == FRAME_STANDALONE:
+                data = decompress_standalone(raw_data[PAYLOAD_HEADER_SIZE:])
+            else:
+                raise ValueError(f"Unknown frame type {frame_type}")
+
             json_data = json.loads(data)
+            self.net_stats.count_received(message_type(json_data), len(raw_data) + self.HEADER_SIZE)
 
-            if json_data.get("question") == "hello?":
+            return json_data
+        except Exception as e:
+            print(f"BaseClient - Error while loading json data! {e}. Assuming the connection is dead.")
+            self.close()
+            return None
+
+    def deliver(self, json_data: dict[any, any]) -> None:
+        """Runs on the network thread. Answers the transport's own messages (connection check, ping, stats) or passes the message on to the game"""
+        match json_data.get("question"):
+            case "hello?":
                 print("Sent init.")
                 self.send({"answer": "hi"})
                 return
-            #jif json_data.get("to", self.sockname) != self.sockname:
-            #    return {}
 
-        except Exception as e:
-            print(f"BaseClient - Error while loading json data! {e}. Assuming the server disconnected (connection dead).")
-            self.disconnect()
-            return {}
+            case "ping":
+                self.send({"answer": {"pong": {"t": json_data.get("t", 0.0), "now": time()}}})
+                self.writer()
+                return
 
-        self.raw_data_stream.append(json_data)
+            case "net_stats":
+                self.send({"answer": {"net_stats": self.stats()}})
+                return
 
-    def recv_exact(self, n: int) -> bytes:
-        buf = b''
-        while len(buf) < n:
-            chunk = self.conn.recv(n - len(buf))
-            if not chunk:
-                raise ConnectionError("Connection bad")
-            buf += chunk
-        return buf
+        answer = json_data.get("answer")
+        if isinstance(answer, dict) and "pong" in answer:
+            self.net_stats.add_pong(answer["pong"]["t"], answer["pong"]["now"])
+            return
 
-    def recv(self) -> dict[any, any]:
-        try:
-            data_size = int.from_bytes(self.recv_exact(4), byteorder="big")
-        except Exception as e:
-            print(f"BaseClient - Error while receiving data size! {e}. Attempting to clear receive buffer!")
-            exit()
-            try:
-                self.conn.recv(99999)
-            except Exception as e1:
-                print(f"BaseClient - Error while clearing buffer due to error! {e1}. Assuming this connection is dead.")
-                if self.disconnect_on_fail:
-                    self.disconnect()
-                return {}
+        self.raw_data_stream.put(json_data)
 
-        try:
-            raw_data = zlib.decompress(self.recv_exact(data_size))
-        except Exception as e:
-            print(f"BaseClient - Error while receiving data! {e}. Attempting to clear receive buffer!")
-            try:
-                self.conn.recv(4096)
-            except Exception as e1:
-                print(f"BaseClient - Error while clearing buffer due to error! {e1}. Assuming this connection is dead.")
-                if self.disconnect_on_fail:
-                    self.disconnect()
-                return {}
+    def stats(self) -> dict[str, any]:
+        """Everything known about this connection, JSON serializable"""
+        return {
+            "addr": str(self.addr), "dead": self.dead, **self.net_stats.to_dict(),
+            "frames_sent": self.frames_sent, "batches_sent": self.batches_sent, "stale_dropped": self.stale_dropped,
+            "outgoing_depth": len(self.outgoing), "recv_queue": self.raw_data_stream.stats()
+        }
+
+    def proc_recv(self, raw_data: bytes | memoryview) -> None:
+        """Runs on the network thread"""
+        if len(raw_data) < PAYLOAD_HEADER_SIZE:
+            print(f"BaseClient - Error while reading a frame from {self.addr}! Frame too short. Assuming the connection is dead.")
+            self.close()
+            return
+
+        mtype = STATE_TYPES.get(raw_data[1])
+        if mtype in DEFERRED_MESSAGES:
+            # Copied out of the receive buffer, which gets reused, and left for the game to decode if it's still the newest by then
+            self.net_stats.count_received(mtype, len(raw_data) + self.HEADER_SIZE)
+            self.raw_data_stream.put_encoded(mtype, bytes(raw_data))
+            return
+
+        json_data = self.decode(raw_data)
+        if json_data is not None:
+            self.deliver(json_data)
+
+    def recv(self, timeout: float | None = None) -> dict[any, any]:
+        """Blocks until a message arrives (or the timeout runs out, in which case an empty dict is returned)"""
+        if timeout is None:
+            # Wake up every now and then so a dead connection doesn't block forever
+            while not self.dead:
+                message = self.raw_data_stream.get(1)
+                if message is not None:
+                    return message
+
+            return {}
+
+        message = self.raw_data_stream.get(timeout)
+        if message is None:
             return {}
 
-        data = raw_data.decode()
-        #print(data)
+        return message
+
+class UdpConnection(BaseClient):
+    """One peer talking over a (possibly shared) UDP socket. Keeps the BaseClient API so the game can't tell the difference.
+    State messages go out unreliable and sequenced per message type (older ones are dropped on arrival).
+    Everything else goes over a reliable, ordered channel that is acked and resent until the ack comes back.
+    Payloads too big for one datagram are split into fragments rather than left to IP fragmentation."""
+
+    UDP_HEADER = struct.Struct(">BI") # channel, sequence number
+    FRAGMENT = struct.Struct(">HH") # fragment index, number of fragments, follows the UDP header on the *_FRAGMENT channels
+    HEADER_SIZE = UDP_HEADER.size
+
+    UNRELIABLE = 0
+    RELIABLE = 1
+    ACK = 2
+    KEEPALIVE = 3
+    UNRELIABLE_FRAGMENT = 4 # every fragment of the message has its seq
+    RELIABLE_FRAGMENT = 5 # every fragment has a seq of its own, so they are acked and resent one by one
+
+    MAX_DATAGRAM = 1200 # bytes, under the usual path MTU so IP never has to fragment
+    FRAGMENT_SIZE = MAX_DATAGRAM - UDP_HEADER.size - FRAGMENT.size
+    MAX_MESSAGE_SIZE = 16 * 1024 * 1024 # bytes, anything bigger isn't sent and a peer reassembling more is assumed to be broken
+    MAX_PARTIAL_MESSAGES = 8 # unreliable messages reassembled at once, the oldest one is given up on to make room
+
+    STREAM_COMPRESSION = False # Datagrams can be lost or reordered so every payload has to decode on its own
+
+    RESEND_TIMEOUT = 0.2 # seconds before an unacked reliable packet is sent again
+    KEEPALIVE_INTERVAL = 1.0 # seconds
+    TIMEOUT = 10.0 # seconds without hearing anything before the peer is considered gone
+    REORDER_WINDOW = 256 # reliable packets this far ahead of the next expected one are dropped unacked, so the peer resends them later
+    MAX_RESENDS = 25 # times a reliable packet is resent without an ack before the peer is considered gone
+
+    def __init__(self, endpoint: "UdpEndpoint", addr: tuple[str, int], is_client: bool, on_connect: object | None = None) -> None:
+        super().__init__(is_client, on_connect)
+
+        self.endpoint = endpoint
+        self.addr = addr
+
+        self.unreliable_seq = 0
+        self.reliable_seq = 0
+        self.unacked = {} # seq -> [packet, last sent time, resends]
+
+        self.last_state_seqs = {}
+        self.next_reliable_seq = 1
+        self.reorder_buffer = {} # seq -> (channel, payload)
+        self.reliable_fragments = [] # of the reliable message being reassembled
+        self.reliable_fragments_size = 0
+        self.partial_messages = {} # seq -> [fragments still missing, fragments] of unreliable messages
+
+        self.last_recv_time = time()
+        self.last_send_time = time()
+
+        self.resent = 0
+        self.out_of_order = 0
+        self.incomplete = 0 # unreliable messages given up on with fragments missing
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.last_recv_time = time()
+        self.ping()
+
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def close(self) -> None:
+        """Runs on the network thread. The socket may be shared with other peers so only this connection is dropped"""
+        self.endpoint.remove(self)
+        self.connection_lost(None)
+
+    def frame(self, mtype: str, payload: bytes) -> tuple[bytes, ...]:
+        """The datagrams carrying the payload, more than one if it doesn't fit in MAX_DATAGRAM"""
+        if len(payload) > self.MAX_MESSAGE_SIZE:
+            print(f"UdpConnection - Error while sending {mtype} to {self.addr}! {len(payload)} bytes is more than {self.MAX_MESSAGE_SIZE}.")
+            return ()
+
+        fragments = None
+        if self.UDP_HEADER.size + len(payload) > self.MAX_DATAGRAM:
+            count = -(-len(payload) // self.FRAGMENT_SIZE)
+            fragments = [
+                self.FRAGMENT.pack(i, count) + payload[i * self.FRAGMENT_SIZE:(i + 1) * self.FRAGMENT_SIZE] for i in range(count)
+            ]
+
+        if mtype in STATE_MESSAGES:
+            with self.outgoing_lock:
+                self.unreliable_seq += 1
+                seq = self.unreliable_seq
+
+            if fragments is None:
+                return (self.UDP_HEADER.pack(self.UNRELIABLE, seq) + payload,)
+
+            return tuple(self.UDP_HEADER.pack(self.UNRELIABLE_FRAGMENT, seq) + fragment for fragment in fragments)
+
+        if fragments is None:
+            parts = [(self.RELIABLE, payload)]
+        else:
+            parts = [(self.RELIABLE_FRAGMENT, fragment) for fragment in fragments]
+
+        packets = []
+        with self.outgoing_lock:
+            for channel, data in parts:
+                self.reliable_seq += 1
+                packet = self.UDP_HEADER.pack(channel, self.reliable_seq) + data
+                self.unacked[self.reliable_seq] = [packet, time(), 0]
+                packets.append(packet)
+
+        return tuple(packets)
+
+    def write_frames(self, frames: List[tuple[bytes, ...]]) -> None:
+        for frame in frames:
+            for packet in frame:
+                self.transport.sendto(packet, self.addr)
+
+        self.last_send_time = time()
+
+    def datagram_received(self, data: bytes) -> None:
+        """Runs on the network thread"""
+        if len(data) < self.UDP_HEADER.size:
+            return
+
+        channel, seq = self.UDP_HEADER.unpack_from(data)
+        payload = memoryview(data)[self.UDP_HEADER.size:]
+        self.last_recv_time = time()
+
+        match channel:
+            case self.ACK:
+                self.net_stats.count_received("ack", len(data))
+                with self.outgoing_lock:
+                    self.unacked.pop(seq, None)
+
+            case self.UNRELIABLE:
+                self.receive_state(seq, payload)
+
+            case self.UNRELIABLE_FRAGMENT:
+                message = self.add_unreliable_fragment(seq, payload)
+                if message is not None:
+                    self.receive_state(seq, message)
+
+            case self.KEEPALIVE:
+                self.net_stats.count_received("keepalive", len(data))
+
+            case self.RELIABLE | self.RELIABLE_FRAGMENT:
+                if seq - self.next_reliable_seq >= self.REORDER_WINDOW:
+                    self.out_of_order += 1
+                    return # Don't let a gap grow the reorder buffer without limit
+
+                self.transport.sendto(self.UDP_HEADER.pack(self.ACK, seq), self.addr)
+                self.net_stats.count_sent("ack", self.UDP_HEADER.size)
+
+                if seq < self.next_reliable_seq or seq in self.reorder_buffer:
+                    return # Already have it, our ack must have been lost
+
+                self.reorder_buffer[seq] = (channel, payload)
+                while self.next_reliable_seq in self.reorder_buffer:
+                    channel, payload = self.reorder_buffer.pop(self.next_reliable_seq)
+                    self.next_reliable_seq += 1
+
+                    if channel == self.RELIABLE:
+                        self.proc_recv(payload)
+                    elif not self.add_reliable_fragment(payload):
+                        return
+
+    def receive_state(self, seq: int, payload: bytes | memoryview) -> None:
+        if len(payload) < PAYLOAD_HEADER_SIZE:
+            return
+
+        # The state type byte is enough to throw away late packets without decoding them
+        mtype = STATE_TYPES.get(payload[1], "")
+        if seq <= self.last_state_seqs.get(mtype, 0):
+            self.out_of_order += 1
+            return
+
+        self.last_state_seqs[mtype] = seq
+        self.proc_recv(payload)
+
+    def add_unreliable_fragment(self, seq: int, payload: memoryview) -> bytes | None:
+        """The whole message once its last missing fragment arrives"""
+        if len(payload) <= self.FRAGMENT.size:
+            return None
+
+        index, count = self.FRAGMENT.unpack_from(payload)
+        if index >= count or count * self.FRAGMENT_SIZE > self.MAX_MESSAGE_SIZE:
+            return None
+
+        partial = self.partial_messages.get(seq)
+        if partial is None:
+            if len(self.partial_messages) >= self.MAX_PARTIAL_MESSAGES:
+                del self.partial_messages[min(self.partial_messages)]
+                self.incomplete += 1
+
+            partial = self.partial_messages[seq] = [count, [None] * count]
+
+        missing, fragments = partial
+        if count != len(fragments) or fragments[index] is not None:
+            return None
+
+        fragments[index] = payload[self.FRAGMENT.size:]
+        partial[0] = missing - 1
+        if partial[0] > 0:
+            return None
+
+        del self.partial_messages[seq]
+        return b"".join(fragments)
+
+    def add_reliable_fragment(self, payload: memoryview) -> bool:
+        """The reliable channel is ordered, so the fragments come in one after the other. False (and the connection dropped) if they don't add up"""
+        index, count = self.FRAGMENT.unpack_from(payload) if len(payload) >= self.FRAGMENT.size else (0, 0)
+        self.reliable_fragments_size += len(payload) - self.FRAGMENT.size
+
+        if index != len(self.reliable_fragments) or index >= count or self.reliable_fragments_size > self.MAX_MESSAGE_SIZE:
+            print(f"UdpConnection - Error while reading a fragment from {self.addr}! Fragment {index} of {count} out of place. Assuming the connection is dead.")
+            self.close()
+            return False
+
+        self.reliable_fragments.append(payload[self.FRAGMENT.size:])
+        if index == count - 1:
+            message = b"".join(self.reliable_fragments)
+            self.reliable_fragments = []
+            self.reliable_fragments_size = 0
+            self.proc_recv(message)
+
+        return True
+
+    def deliver(self, json_data: dict[any, any]) -> None:
+        if json_data.get("answer") == "hi":
+            self.connected.set()
+            return
+
+        super().deliver(json_data)
+
+    def maintain(self) -> None:
+        """Runs on the network thread every UdpEndpoint.MAINTAIN_INTERVAL. Resends unacked packets and keeps the peer alive"""
+        now = time()
+
+        if now - self.last_recv_time > self.TIMEOUT:
+            print(f"UdpConnection - No packets from {self.addr} in {self.TIMEOUT}s. Assuming the connection is dead.")
+            self.close()
+            return
+
+        with self.outgoing_lock:
+            resend = []
+            given_up = False
+            for entry in self.unacked.values():
+                if now - entry[1] > self.RESEND_TIMEOUT:
+                    resend.append(entry[0])
+                    entry[1] = now
+                    entry[2] += 1
+                    given_up = given_up or entry[2] > self.MAX_RESENDS
+
+        if given_up:
+            print(f"UdpConnection - Error while sending to {self.addr}! A packet went unacked {self.MAX_RESENDS} times. Assuming the connection is dead.")
+            self.close()
+            return
+
+        for packet in resend:
+            self.transport.sendto(packet, self.addr)
+            self.net_stats.count_sent("resend", len(packet))
+
+        self.resent += len(resend)
+
+        if len(resend) > 0:
+            self.last_send_time = now
+        elif now - self.last_send_time > self.KEEPALIVE_INTERVAL:
+            self.transport.sendto(self.UDP_HEADER.pack(self.KEEPALIVE, 0), self.addr)
+            self.net_stats.count_sent("keepalive", self.UDP_HEADER.size)
+            self.last_send_time = now
+
+    @property
+    def write_backlog(self) -> int:
+        """Reliable packets the peer hasn't acked yet, the socket is shared so its own buffer says nothing about this peer"""
+        with self.outgoing_lock:
+            return sum(len(entry[0]) for entry in self.unacked.values())
+
+    def stats(self) -> dict[str, any]:
+        return {**super().stats(), "resent": self.resent, "out_of_order": self.out_of_order, "incomplete": self.incomplete, "unacked": len(self.unacked)}
+
+class UdpEndpoint(asyncio.DatagramProtocol):
+    """A UDP socket and the UdpConnections using it. The server has one connection per remote address, a client has just the one"""
+
+    MAINTAIN_INTERVAL = 0.05 # seconds
+    HELLO = {"question": "hello?"} # what a client's first reliable packet must hold to get a connection
+
+    def __init__(self, is_client: bool, on_connect: object | None = None) -> None:
+        self.network_loop = NetworkLoop.get()
+        self.is_client = is_client
+        self.on_connect = on_connect
+
+        self.transport = None
+        self.connections = {}
+        self.maintain_handle = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.maintain()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self.maintain_handle is not None:
+            self.maintain_handle.cancel()
+
+        for connection in list(self.connections.values()):
+            connection.connection_lost(exc)
+
+        self.connections = {}
+
+    def error_received(self, exc: Exception) -> None:
+        print(f"UdpEndpoint - Error while receiving! {exc}.")
+
+    def connect(self, addr: tuple[str, int]) -> UdpConnection:
+        connection = UdpConnection(self, addr, self.is_client, self.on_connect)
+        self.connections[addr] = connection
+        connection.connection_made(self.transport)
+
+        return connection
+
+    @classmethod
+    def is_hello(cls, data: bytes) -> bool:
+        """Whether a datagram is the first reliable packet of a client's handshake"""
+        if len(data) < UdpConnection.UDP_HEADER.size + PAYLOAD_HEADER_SIZE:
+            return False
+
+        channel, seq = UdpConnection.UDP_HEADER.unpack_from(data)
+        payload = memoryview(data)[UdpConnection.UDP_HEADER.size:]
+        if channel != UdpConnection.RELIABLE or seq != 1 or payload[0] != FRAME_RAW:
+            return False # The hello is small enough to never be compressed
 
         try:
-            json_data = json.loads(data)
-            #jif json_data.get("to", self.sockname) != self.sockname:
-            #    return {}
+            return json.loads(bytes(payload[PAYLOAD_HEADER_SIZE:])) == cls.HELLO
+        except ValueError:
+            return False
 
-        except Exception as e:
-            print(f"BaseClient - Error while loading json data! {e}. Assuming the server disconnected (connection dead).")
-            if self.disconnect_on_fail:
-                self.disconnect()
-            return {}
+    def remove(self, connection: UdpConnection) -> None:
+        if self.connections.get(connection.addr) is connection:
+            del self.connections[connection.addr]
+
+        if self.is_client:
+            self.transport.close()
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        connection = self.connections.get(addr)
+
+        if connection is None:
+            if self.is_client:
+                return # Not from the server
+
+            if not self.is_hello(data):
+                return # Stray or stale packets mustn't take a player slot
+
+            connection = self.connect(addr)
+
+        connection.datagram_received(data)
+
+    def maintain(self) -> None:
+        for connection in list(self.connections.values()):
+            connection.maintain()
 
-        return json_data
+        self.maintain_handle = self.network_loop.loop.call_later(self.MAINTAIN_INTERVAL, self.maintain)
 
 class Client:
-    def __init__(self, host: str, port: int) -> None:
+    CONNECT_TIMEOUT = 5 # seconds
+
+    def __init__(self, host: str, port: int, transport: str = "tcp") -> None:
         self.HOST = host
         self.PORT = port
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if transport not in TRANSPORTS:
+            raise Exception(f"Client - Unknown transport \"{transport}\"! Expected one of {TRANSPORTS}.")
+
+        self.transport = transport
+
+        self.network_loop = NetworkLoop.get()
         self.base_client = None
 
     @property
@@ -163,78 +1181,150 @@ class Client:
 
         return self.base_client.recv
 
+    async def open_connection(self) -> BaseClient:
+        if self.transport == "tcp":
+            _, base_client = await self.network_loop.loop.create_connection(lambda: BaseClient(True), self.HOST, self.PORT)
+            return base_client
+
+        transport, endpoint = await self.network_loop.loop.create_datagram_endpoint(lambda: UdpEndpoint(True), remote_addr=(self.HOST, self.PORT))
+        base_client = endpoint.connect(transport.get_extra_info("peername"))
+
+        # There is no connection to accept over UDP, so check that someone is actually listening
+        base_client.send(UdpEndpoint.HELLO)
+        base_client.flush()
+
+        deadline = time() + self.CONNECT_TIMEOUT
+        while not base_client.connected.is_set():
+            if time() > deadline:
+                transport.close()
+                raise ConnectionError("No answer from the server")
+
+            await asyncio.sleep(0.05)
+
+        return base_client
+
     def connect(self, max_retries: bool = 3) -> bool:
         curr_try = 0
-            
-        if self.base_client is None:
-            self.base_client = BaseClient(self.sock, (self.HOST, self.PORT), True)
 
         while curr_try < max_retries:
             curr_try += 1
             print("Connecting...")
             try:
-                self.sock.connect((self.HOST, self.PORT))
-                self.base_client.recv_thread.start()
+                self.base_client = self.network_loop.submit(self.open_connection()).result(self.CONNECT_TIMEOUT * 2)
                 return True
-            except:
+            except Exception:
                 ...
 
         return False
+
+    def flush(self) -> None:
+        if self.base_client is not None:
+            self.base_client.flush()
+
+    @property
+    def rtt(self) -> float | None:
+        if self.base_client is None: return None
+        return self.base_client.net_stats.smoothed_rtt
+
+    def stats(self) -> dict[str, any]:
+        if self.base_client is None:
+            return {}
+
+        return self.base_client.stats()
+
+    def dump_stats(self, path: str, extra: dict[str, any] | None = None) -> None:
+        dump_stats(path, {"role": "client", "transport": self.transport, **self.stats(), **(extra or {})})
+
+    def disconnect(self) -> None:
+        if self.base_client is not None:
+            self.base_client.disconnect()
+
 class Server:
-    def __init__(self, host: str, port: int) -> None:
+    SHUTDOWN_TIMEOUT = 5 # seconds
+
+    def __init__(self, host: str, port: int, transport: str = "tcp") -> None:
         self.HOST = host
         self.PORT = port
 
+        if transport not in TRANSPORTS:
+            raise Exception(f"Server - Unknown transport \"{transport}\"! Expected one of {TRANSPORTS}.")
+
+        self.transport = transport
+
         self.clients = []
 
-        self.outgoing_blocks = {}
-        self.incoming_blocks = {}
+        self.network_loop = NetworkLoop.get()
+        self.server = None
+        self.endpoint = None
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.network_loop.submit(self.start()).result()
 
-        self.server_thread = Thread(target=self.start, daemon=True)
-        self.server_thread.start()
-    
     @property
-    def address(self) -> tuple[str, int]: return (self.ip, self.port)
+    def address(self) -> tuple[str, int]: return (self.HOST, self.PORT)
 
     @property
     def num_connections(self) -> int: return len(self.clients)
 
-    def handle_client(self, conn: bytes, addr: tuple[str, int]) -> None:
-        for client in self.clients:
-            if client.addr == addr:
-                #client.proc_recv(data)
-                return
-
-        print(f"Client with addr {addr} connected!")
+    def handle_client(self, base_client: BaseClient) -> None:
+        """Runs on the network thread once a connection has been accepted"""
+        print(f"Client with addr {base_client.addr} connected!")
 
-        self.clients.append(BaseClient(conn, addr, False))
-        #self.clients[-1].send({"answer": "hi"})
+        self.clients.append(base_client)
 
     def sendall(self, json_data: dict[any, any]) -> None:
+        self.broadcast(json_data)
+
+    def broadcast(self, json_data: dict[any, any], clients: List[BaseClient] | None = None) -> None:
+        """Serializes and compresses a message once and queues the same bytes on every connection (or just the given ones)"""
+        if clients is None:
+            clients = self.clients
+
+        mtype = message_type(json_data)
+        payload = encode_standalone(json_data)
+
+        for client in clients:
+            client.send_encoded(mtype, payload)
+
+    def flush(self) -> None:
         for client in self.clients:
-            client.send(json_data)
-        
-    def start(self) -> None:
-        print(f"Running server on {(self.HOST, self.PORT)}...")
+            client.flush()
 
-        self.sock.bind((self.HOST, self.PORT))
-        self.sock.listen()
+    def stats(self) -> dict[str, any]:
+        connections = [client.stats() for client in self.clients]
+        return {"num_connections": self.num_connections, "total": merge_stats(connections), "connections": connections}
 
-        while 1:
-            conn, addr = self.sock.accept()
-            #data, addr = self.sock.recvfrom(2048)
-            self.handle_client(conn, addr)
+    def dump_stats(self, path: str, extra: dict[str, any] | None = None) -> None:
+        dump_stats(path, {"role": "server", "transport": self.transport, **self.stats(), **(extra or {})})
+
+    async def start(self) -> None:
+        print(f"Running {self.transport} server on {(self.HOST, self.PORT)}...")
+
+        if self.transport == "tcp":
+            self.server = await self.network_loop.loop.create_server(
+                lambda: BaseClient(False, on_connect=self.handle_client), self.HOST, self.PORT, reuse_address=True
+            )
+        else:
+            _, self.endpoint = await self.network_loop.loop.create_datagram_endpoint(
+                lambda: UdpEndpoint(False, on_connect=self.handle_client), local_addr=(self.HOST, self.PORT)
+            )
+
+    async def close(self) -> None:
+        if self.endpoint is not None:
+            self.endpoint.transport.close()
+            return
+
+        self.server.close()
 
-    def shutdown(self) -> None:
         for client in self.clients:
-            client.conn.close()
+            if client.transport is not None:
+                client.transport.close()
+
+            client.dead = True
 
+        await self.server.wait_closed()
+
+    def shutdown(self) -> None:
         try:
-            self.sock.shutdown(socket.SHUT_RDWR)
+            self.network_loop.submit(self.close()).result(self.SHUTDOWN_TIMEOUT)
         except Exception as e:
             print(f"Server - Error while shutting down! {e}.")
-        
-        self.sock.close()
\ No newline at end of file
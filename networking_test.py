@@ -16,4 +16,6 @@ elif sys.argv[1] == "client":
     client.connect()
 
     while not client.base_client.dead:
-        print(client.base_client.recv())
\ No newline at end of file
+        data = client.base_client.recv(timeout=1)
+        if data != {}:
+            print(data)
\ No newline at end of file
@@ -30,6 +30,67 @@ class Poison:
 
             if self.duration <= 0: self.on_poison_end(self)
 
+class PowerupBitset:
+    """Which powerup indexes have been picked up, one bit each. Grows as dropped powerups get higher indexes.
+    Only ever gains bits during a match, so the difference from an older copy is just the newly picked powerups"""
+
+    def __init__(self, size: int = 0, data: bytes = b"") -> None:
+        self.bits = bytearray(data)
+        self.grow(size)
+
+    def grow(self, size: int) -> None:
+        num_bytes = (size + 7) // 8
+        if num_bytes > len(self.bits):
+            self.bits.extend(bytes(num_bytes - len(self.bits)))
+
+    def add(self, index: int) -> None:
+        self.grow(index + 1)
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, index: int) -> bool:
+        return index >> 3 < len(self.bits) and bool(self.bits[index >> 3] >> (index & 7) & 1)
+
+    def copy(self) -> "PowerupBitset":
+        return PowerupBitset(data=self.bits)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+
+    def delta(self, older: "PowerupBitset") -> List[List[int]]:
+        """Runs of [first index, count] that are set here but not in older, XORed a byte at a time so untouched bytes cost next to nothing"""
+        runs = []
+
+        for byte_index, byte in enumerate(self.bits):
+            if byte_index < len(older.bits):
+                byte ^= older.bits[byte_index]
+
+            if byte == 0:
+                continue
+
+            for bit in range(8):
+                if not byte >> bit & 1:
+                    continue
+
+                index = byte_index * 8 + bit
+                if len(runs) > 0 and runs[-1][0] + runs[-1][1] == index:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([index, 1])
+
+        return runs
+
+    def apply(self, runs: List[List[int]]) -> List[int]:
+        """Sets the runs from delta, returns the indexes that weren't set yet"""
+        added = []
+
+        for first_index, count in runs:
+            for index in range(first_index, first_index + count):
+                if index not in self:
+                    self.add(index)
+                    added.append(index)
+
+        return added
+
 class Powerup:
     WIDTH = 50
     HEIGHT = 50
@@ -110,5 +171,6 @@ class Powerup:
             case "Rare": player.num_rare_picked += 1
             case "Legendary": player.num_legendary_picked += 1
 
+        player.last_powerup = (self.rarity, self.name)
         player.show_powerup_popup(self.render_popup())
         self.on_pickup(self)
\ No newline at end of file
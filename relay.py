@@ -0,0 +1,239 @@
+import argparse
+
+from collections import deque
+from json import dumps
+from math import dist
+from time import perf_counter, sleep, time
+from typing import Dict, List
+
+from networking import BaseClient, Client, MessageRouter, Server, TRANSPORTS, encode_answer_list, encode_standalone
+from replication import ReplicationScheduler
+
+# Spectator relay. Connects to a host as a single subscriber, takes its full snapshot stream and fans it out to any number of
+# read-only spectators, which are normal `main.py join` clients pointed at the relay. Adding viewers costs the host nothing.
+
+class RelayShape:
+    """What the replication scheduler needs from a shape, taken from one entry of the host's player_update"""
+
+    def __init__(self, update: dict[str, any]) -> None:
+        self.index = update["index"]
+        self.x = update["x"]
+        self.y = update["y"]
+        self.rotation = update["rotation"]
+        self.hp = update["hp"]
+        self.shield = update["shield"]
+        self.last_shoot_time = 0.0 # not in the snapshot, so shooting adds no priority on the relay
+
+        self.item = dumps(update) # serialized once, however many spectators it goes to
+
+class SpectatorRelay:
+    TICK_RATE = 60 # how often the relay looks at its connections
+    SNAPSHOT_RATE = 20 # the host's, see ShapeRoyale.SNAPSHOT_RATE
+    HANDSHAKE_POLL_TIMEOUT = 0.5 # seconds
+    RECONNECT_INTERVAL = 1.0 # seconds between attempts to reach the host
+    KEYFRAME_INTERVAL = 10 # seconds between fresh keyframes from the host, bounds the events a late spectator gets replayed
+    TICK_HISTORY = 300 # ticks of timing kept for the "server_stats" question
+
+    EVENT_MESSAGES = ("powerup_add", "powerups_picked", "player_remove", "powerup_set", "winner")
+
+    def __init__(self, host: str, port: int, bind_host: str, bind_port: int, transport: str = "tcp") -> None:
+        self.upstream = Client(host, port, transport)
+
+        # The host's last keyframe and every event since, a late spectator gets both and is then as up to date as the rest
+        self.keyframe = None
+        self.events: List[tuple[str, bytes]] = []
+        self.last_keyframe_request = 0
+
+        # Latest snapshot from the host, fanned out once per snapshot
+        self.shapes: List[RelayShape] = []
+        self.bullet_items: List[tuple[float, float, str]] = [] # x, y, JSON
+        self.snapshot_time = 0
+        self.new_snapshot = False
+
+        self.spectators = set() # connections that have been given the match
+        self.invited = set()
+        self.following: Dict[BaseClient, int] = {} # connection -> index of the shape its screen follows
+        self.replication = ReplicationScheduler(self.SNAPSHOT_RATE)
+
+        self.tick_times = deque(maxlen=self.TICK_HISTORY) # ms of work per tick
+
+        self.upstream_router = MessageRouter()
+        self.upstream_router.register("answer", "keyframe", self.on_keyframe)
+        self.upstream_router.register("answer", "player_update", self.on_player_update)
+        self.upstream_router.register("answer", "set_bullets", self.on_set_bullets)
+        for mtype in self.EVENT_MESSAGES:
+            self.upstream_router.register("answer", mtype, self.on_event)
+
+        self.router = MessageRouter()
+        self.router.register("answer", "ready", self.on_ready)
+        self.router.register("answer", "send_starting_info", self.on_send_starting_info)
+        self.router.register("answer", "spectate", self.on_spectate)
+        self.router.register("question", "keyframe", self.on_keyframe_question)
+        self.router.register("question", "server_stats", self.on_server_stats_question)
+
+        self.connect()
+        self.subscribe()
+
+        self.server = Server(bind_host, bind_port, transport)
+        self.main()
+
+    def connect(self) -> None:
+        while not self.upstream.connect(max_retries=1):
+            sleep(self.RECONNECT_INTERVAL)
+
+    def subscribe(self) -> None:
+        """Tells the host we're a relay until it sends the match"""
+        print(f"Subscribing to {(self.upstream.HOST, self.upstream.PORT)}...")
+
+        last_request = 0
+        while self.keyframe is None:
+            if self.upstream.base_client.dead:
+                raise ConnectionError("Lost the host while subscribing")
+
+            if time() - last_request >= self.HANDSHAKE_POLL_TIMEOUT:
+                self.upstream.send({"answer": {"subscribe": True}})
+                self.upstream.flush()
+                last_request = time()
+
+            message = self.upstream.base_client.recv(timeout=self.HANDSHAKE_POLL_TIMEOUT)
+            self.upstream_router.dispatch(message)
+
+        self.last_keyframe_request = time()
+
+    def join(self, client: BaseClient) -> None:
+        """Brings a spectator up to date, the keyframe first and then what happened since"""
+        self.spectators.add(client)
+
+        client.send({"answer": self.keyframe})
+        for mtype, payload in self.events:
+            client.send_encoded(mtype, payload)
+
+    def send_snapshots(self) -> None:
+        """Like ShapeRoyale.send_snapshots, every spectator gets the shapes and bullets around the one it follows within its own budget"""
+        sizes = {shape.index: len(shape.item) + 2 for shape in self.shapes}
+        shapes_by_index = {shape.index: shape for shape in self.shapes}
+
+        for client in list(self.spectators):
+            if client.dead:
+                self.spectators.discard(client)
+                self.following.pop(client, None)
+                self.replication.remove(client)
+                continue
+
+            viewer = shapes_by_index.get(self.following.get(client))
+            budget = self.replication.budget(client)
+
+            selected, used = self.replication.select(client, viewer, self.shapes, sizes, budget)
+            client.send_encoded("player_update", encode_answer_list("player_update", [shape.item for shape in selected], {"t": self.snapshot_time}))
+
+            if viewer is None:
+                continue
+
+            close_bullets = []
+            for x, y, item in sorted(self.bullet_items, key=lambda bullet_item: dist((bullet_item[0], bullet_item[1]), (viewer.x, viewer.y))):
+                used += len(item) + 2
+                if used > budget:
+                    break
+
+                close_bullets.append(item)
+
+            client.send_encoded("set_bullets", encode_answer_list("set_bullets", close_bullets))
+
+    def stats(self) -> dict[str, any]:
+        tick_times = sorted(self.tick_times) or [0.0]
+
+        return {
+            "players": len(self.shapes), "clients": len(self.spectators),
+            "tick_ms": sum(tick_times) / len(tick_times), "tick_p95_ms": tick_times[int(len(tick_times) * 0.95)], "tick_max_ms": tick_times[-1],
+            "router": self.router.stats(), "upstream_router": self.upstream_router.stats()
+        }
+
+    # Host handlers
+
+    def on_keyframe(self, query: dict[str, any]) -> None:
+        self.keyframe = query
+        self.events = []
+
+    def on_player_update(self, query: dict[str, any]) -> None:
+        self.shapes = [RelayShape(update) for update in query["player_update"]]
+        self.snapshot_time = query["t"]
+        self.new_snapshot = True
+
+    def on_set_bullets(self, query: dict[str, any]) -> None:
+        self.bullet_items = [(bullet["x"], bullet["y"], dumps(bullet)) for bullet in query["set_bullets"]]
+
+    def on_event(self, query: dict[str, any]) -> None:
+        """Passed straight on and kept for spectators that join before the next keyframe"""
+        mtype = next(iter(query))
+        payload = encode_standalone({"answer": query})
+
+        self.events.append((mtype, payload))
+        for client in self.spectators:
+            client.send_encoded(mtype, payload)
+
+    # Spectator handlers
+
+    def on_ready(self, client: BaseClient, query: dict[str, any]) -> None:
+        if query["ready"] and client not in self.spectators and client not in self.invited:
+            self.invited.add(client)
+            client.send({"question": "send_starting_info"})
+
+    def on_send_starting_info(self, client: BaseClient, query: dict[str, any]) -> None:
+        if client not in self.spectators:
+            self.join(client)
+
+    def on_spectate(self, client: BaseClient, query: dict[str, any]) -> None:
+        self.following[client] = query["spectate"]
+
+    def on_keyframe_question(self, client: BaseClient, query: str) -> None:
+        self.join(client)
+
+    def on_server_stats_question(self, client: BaseClient, query: str) -> None:
+        client.send({"answer": {"server_stats": self.stats()}})
+
+    def main(self) -> None:
+        print(f"Relaying to spectators on {self.server.address}...")
+
+        while not self.upstream.base_client.dead:
+            sleep(1 / self.TICK_RATE)
+            tick_start = perf_counter()
+
+            for message in self.upstream.base_client.data_stream:
+                self.upstream_router.dispatch(message)
+
+            for client in self.server.clients:
+                for message in client.data_stream:
+                    self.router.dispatch(message, client)
+
+            if self.new_snapshot:
+                self.new_snapshot = False
+                self.send_snapshots()
+
+            if time() - self.last_keyframe_request >= self.KEYFRAME_INTERVAL:
+                self.upstream.send({"question": "keyframe"})
+                self.last_keyframe_request = time()
+
+            self.upstream.flush()
+            self.server.flush()
+
+            self.tick_times.append((perf_counter() - tick_start) * 1000)
+
+        print("Lost the host, closing the relay.")
+        self.server.flush()
+        self.server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relays a ShapeRoyale match to spectators. Point spectators (main.py join) at --bind/--listen instead of the host.")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the host")
+    parser.add_argument("--port", type=int, default=31415, help="port of the host")
+    parser.add_argument("--bind", default="0.0.0.0", help="address spectators connect to")
+    parser.add_argument("--listen", type=int, default=31417, help="port spectators connect to")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp")
+    args = parser.parse_args()
+
+    # Like a dedicated server, follows one match after another
+    while True:
+        try:
+            SpectatorRelay(args.host, args.port, args.bind, args.listen, args.transport)
+        except ConnectionError as e:
+            print(f"SpectatorRelay - Error while relaying! {e}.")
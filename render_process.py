@@ -0,0 +1,470 @@
+import pygame as pg
+import atexit
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+from json import loads
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import time
+from typing import Dict, List
+
+from bullet import Bullet
+from menus import EndScreen
+from powerups import Powerup
+from shape import ShapeSprites
+from utils import FONTS_PATH
+
+# Single-player with the window in its own process (main.py split). The simulation publishes every finished frame as fixed size records
+# into one of two shared memory buffers, the renderer draws the latest whole one at its own frame rate and writes its inputs back.
+# A heavy simulation then slows down the shapes, not the window
+
+# Simulation -> renderer
+CONTROL = struct.Struct("<QI") # last published frame, match number
+ROSTER_ENTRY = struct.Struct("<B31s") # shape type, name. Written once per match, indexed by shape index
+FRAME = struct.Struct("<fHHHhH?dddd3IdBHhH?IIIdIIII") # see SharedFrames.publish
+SHAPE = struct.Struct("<Hhddffff") # index, rotation, x, y, hp, max hp, shield, max shield
+BULLET = struct.Struct("<ddf") # x, y, radius
+POWERUP = struct.Struct("<ddB") # x, y, rarity
+
+# Renderer -> simulation
+INPUT = struct.Struct("<BBiI?") # move, shoot, spectator steps, restarts, quit
+
+INPUT_OFFSET = 16
+ROSTER_OFFSET = 32
+
+MOVES = ("", "u", "r", "d", "l")
+SHAPE_NAMES = ("Square", "Triangle", "Circle")
+RARITIES = ("Common", "Uncommon", "Rare", "Legendary")
+SOUNDS = ("hitHurt", "laserShoot", "powerUp")
+NO_POPUP = 255
+
+class SharedFrames:
+    """The simulation's frames in a SharedMemory block. The simulation fills the buffer the renderer isn't reading and then publishes it
+    by bumping the frame counter, the renderer reads the buffer of the last published frame and checks the counter didn't move meanwhile"""
+
+    MAX_BULLETS = 4096 # more than this and the rest aren't drawn
+    MAX_POWERUPS = 8192
+
+    def __init__(self, max_shapes: int, name: str | None = None) -> None:
+        self.max_shapes = max_shapes
+
+        self.bullets_offset = FRAME.size + max_shapes * SHAPE.size
+        self.powerups_offset = self.bullets_offset + self.MAX_BULLETS * BULLET.size
+        self.frame_size = self.powerups_offset + self.MAX_POWERUPS * POWERUP.size
+        self.buffers_offset = ROSTER_OFFSET + max_shapes * ROSTER_ENTRY.size
+
+        if name is None:
+            self.shm = SharedMemory(create=True, size=self.buffers_offset + 2 * self.frame_size)
+            self.shm.buf[:self.buffers_offset] = bytes(self.buffers_offset)
+        else:
+            self.shm = SharedMemory(name=name)
+            # Only the creator unlinks, see SharedRing
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+
+    def buffer_offset(self, frame: int) -> int:
+        return self.buffers_offset + (frame % 2) * self.frame_size
+
+    def close(self, unlink: bool = False) -> None:
+        self.buf.release()
+        self.shm.close()
+
+        if unlink:
+            self.shm.unlink()
+
+class RenderProcess:
+    """Simulation side handle to the renderer, shared by every match in the process like the SnapshotWorkerPool"""
+
+    STOP_TIMEOUT = 5 # seconds the renderer gets to close its window and audio device before it's killed
+
+    _instance = None
+
+    def __init__(self, max_shapes: int, width: int, height: int, env: Dict[str, str]) -> None:
+        self.frames = SharedFrames(max_shapes)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.frames.name, str(max_shapes), str(width), str(height)], stdin=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+        )
+
+        self.frame = 0
+        self.match = 0
+        self.sound_counts = [0] * len(SOUNDS)
+
+        atexit.register(self.shutdown)
+
+    @classmethod
+    def get(cls, max_shapes: int, width: int, height: int, env: Dict[str, str]) -> "RenderProcess":
+        if cls._instance is None:
+            cls._instance = cls(max_shapes, width, height, env)
+
+        return cls._instance
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def start_match(self, players: List[any]) -> None:
+        """Names and shape types don't change during a match, they go over once instead of in every frame"""
+        for player in players:
+            name = player.player_name.encode("utf-8")[:ROSTER_ENTRY.size - 1]
+            ROSTER_ENTRY.pack_into(self.frames.buf, ROSTER_OFFSET + player.index * ROSTER_ENTRY.size, SHAPE_NAMES.index(player.shape_name), name)
+
+        self.match += 1
+        CONTROL.pack_into(self.frames.buf, 0, self.frame, self.match)
+
+    def play_sound(self, name: str) -> None:
+        self.sound_counts[SOUNDS.index(name)] += 1
+
+    def controls(self) -> tuple[str, bool, int, int, bool]:
+        """Move, shoot, spectator steps and restarts since the renderer started, whether its window was closed"""
+        move, shoot, spectator_steps, restarts, quit = INPUT.unpack_from(self.frames.buf, INPUT_OFFSET)
+        return MOVES[move], bool(shoot), spectator_steps, restarts, quit
+
+    def publish(self, game: any, show_end_screen: bool) -> None:
+        """game is the ShapeRoyale, packed into the buffer the renderer isn't on and then made the latest frame"""
+        frames = self.frames
+        offset = frames.buffer_offset(self.frame + 1)
+
+        players = game.players[:frames.max_shapes]
+        bullets = game.bullets[:frames.MAX_BULLETS]
+        powerups = game.powerups[:frames.MAX_POWERUPS]
+
+        followed = game.player
+        popup_rarity, popup_name = NO_POPUP, 0
+        if followed.is_player and followed.last_powerup is not None:
+            rarity, name = followed.last_powerup
+            popup_rarity, popup_name = RARITIES.index(rarity), list(game.powerup_info[rarity]["types"]).index(name)
+
+        winner = game.players[0] if game.end_screen is not None else None
+        winner_stats = (0, 0, 0, 0.0, 0, 0, 0, 0)
+        if winner is not None:
+            winner_stats = (
+                winner.kills, winner.shots_hit, winner.shots_fired, winner.total_damage,
+                winner.num_common_picked, winner.num_uncommon_picked, winner.num_rare_picked, winner.num_legendary_picked
+            )
+
+        FRAME.pack_into(
+            frames.buf, offset, game.clock.get_fps(), len(players), len(bullets), len(powerups),
+            players.index(followed) if followed in players else -1, game.spectator_index, game.spectating,
+            game.safezone.left_wall, game.safezone.right_wall, game.safezone.top_wall, game.safezone.bottom_wall, *self.sound_counts,
+            followed.powerup_popup_create_time, popup_rarity, popup_name,
+            winner.index if winner is not None else -1, game.starting_player.index, show_end_screen, *winner_stats
+        )
+
+        shape_data = b"".join(
+            SHAPE.pack(player.index, int(player.rotation), player.x, player.y, player.hp, player.max_hp, player.shield, player.max_shield) for player in players
+        )
+        frames.buf[offset + FRAME.size:offset + FRAME.size + len(shape_data)] = shape_data
+
+        bullet_data = b"".join(BULLET.pack(bullet.x, bullet.y, bullet.health_damage / 1.75) for bullet in bullets)
+        frames.buf[offset + frames.bullets_offset:offset + frames.bullets_offset + len(bullet_data)] = bullet_data
+
+        powerup_data = b"".join(POWERUP.pack(powerup.x, powerup.y, RARITIES.index(powerup.rarity)) for powerup in powerups)
+        frames.buf[offset + frames.powerups_offset:offset + frames.powerups_offset + len(powerup_data)] = powerup_data
+
+        # Published last, the renderer never picks up a half written frame
+        self.frame += 1
+        CONTROL.pack_into(frames.buf, 0, self.frame, self.match)
+
+    def shutdown(self) -> None:
+        if self.frames is None:
+            return
+
+        try:
+            # EOF tells the renderer the simulation is gone
+            self.process.stdin.close()
+            self.process.wait(timeout=self.STOP_TIMEOUT)
+        except Exception as e:
+            print(f"RenderProcess - Error while stopping the renderer! {e}.")
+            self.process.kill()
+
+        self.frames.close(unlink=True)
+        self.frames = None
+
+class EndScreenShape:
+    """What the EndScreen needs from the winner, taken from a frame"""
+
+    def __init__(self, shape_name: str, shape_image: pg.Surface, enemy_shape_image: pg.Surface, stats: tuple) -> None:
+        self.shape_name = shape_name
+        self.shape_image = shape_image
+        self.enemy_shape_image = enemy_shape_image
+
+        self.kills, self.shots_hit, self.shots_fired, self.total_damage, *picked = stats
+        self.num_common_picked, self.num_uncommon_picked, self.num_rare_picked, self.num_legendary_picked = picked
+
+class FrameRenderer:
+    """Runs in its own process, see RenderProcess. Owns the window, draws the latest frame like ShapeRoyale.main does and sends the inputs back"""
+
+    FPS = 60
+    READ_ATTEMPTS = 4 # times a frame is copied again if the simulation published over it mid copy
+    POPUP_DURATION = 3 # seconds, see Shape.draw
+
+    def __init__(self, name: str, max_shapes: int, width: int, height: int) -> None:
+        self.frames = SharedFrames(max_shapes, name)
+
+        self.WIDTH = width
+        self.HEIGHT = height
+        self.MAP_SIZE = 30_000 # ShapeRoyale.MAP_SIZE
+
+        pg.init()
+        self.screen = pg.display.set_mode((self.WIDTH, self.HEIGHT), pg.SRCALPHA | pg.FULLSCREEN | pg.SCALED, display=0)
+        self.clock = pg.time.Clock()
+
+        self.shape_sprites = ShapeSprites.get(SHAPE_NAMES)
+
+        with open("../ShapeRoyale/Data/powerups.json", "r") as f:
+            self.powerup_info = loads(f.read())
+
+        self.powerup_images = {}
+        for rarity in RARITIES:
+            self.powerup_images[rarity] = Powerup(0, 0, rarity, self.powerup_info, None, 0).image
+
+        self.sounds = {
+            "hitHurt": pg.Sound("../ShapeRoyale/Data/assets/Sounds/hitHurt.wav"),
+            "laserShoot": pg.Sound("../ShapeRoyale/Data/assets/Sounds/laserShoot.wav"),
+            "powerUp": pg.Sound("../ShapeRoyale/Data/assets/Sounds/powerUp.wav"),
+        }
+        self.sounds["hitHurt"].set_volume(0.70)
+        self.sounds["laserShoot"].set_volume(0.70)
+        self.sounds["powerUp"].set_volume(0.50)
+        self.sound_counts = None
+
+        self.name_font = pg.Font(f"{FONTS_PATH}/PressStart2P.ttf", 16)
+        self.fps_font = pg.font.Font(f"{FONTS_PATH}/PressStart2P.ttf", 15)
+        self.spectating_lbl = pg.font.Font(f"{FONTS_PATH}/PressStart2P.ttf", 60).render("You are spectating!", True, (255, 255, 255))
+
+        self.safezone_surf = pg.Surface((self.WIDTH, self.HEIGHT))
+        self.minimap_surf = pg.Surface((200, 200), pg.SRCALPHA)
+        self.info_surf = pg.Surface((100, 40), pg.SRCALPHA)
+
+        self.match = 0
+        self.shape_types: Dict[int, str] = {}
+        self.name_surfs: Dict[int, pg.Surface] = {}
+
+        self.popup_time = None
+        self.popup = None
+        self.end_screen = None
+
+        self.spectator_steps = 0
+        self.restarts = 0
+        self.quit = False
+
+        self.orphaned = False
+        threading.Thread(target=self.wait_for_simulation, daemon=True).start()
+
+    def wait_for_simulation(self) -> None:
+        sys.stdin.buffer.read()
+        self.orphaned = True
+
+    def read(self) -> tuple | None:
+        """(header, shapes, bullets, powerups) of the latest published frame, None before the first one"""
+        frames = self.frames
+
+        for _ in range(self.READ_ATTEMPTS):
+            frame, match = CONTROL.unpack_from(frames.buf)
+            if frame == 0:
+                return None
+
+            if match != self.match:
+                self.load_roster(match)
+
+            offset = frames.buffer_offset(frame)
+            header = FRAME.unpack_from(frames.buf, offset)
+            _, num_shapes, num_bullets, num_powerups, *_ = header
+
+            shapes = list(SHAPE.iter_unpack(frames.buf[offset + FRAME.size:offset + FRAME.size + num_shapes * SHAPE.size]))
+            bullets = list(BULLET.iter_unpack(frames.buf[offset + frames.bullets_offset:offset + frames.bullets_offset + num_bullets * BULLET.size]))
+            powerups = list(POWERUP.iter_unpack(frames.buf[offset + frames.powerups_offset:offset + frames.powerups_offset + num_powerups * POWERUP.size]))
+
+            if CONTROL.unpack_from(frames.buf)[0] == frame:
+                return header, shapes, bullets, powerups
+
+        return None
+
+    def load_roster(self, match: int) -> None:
+        self.match = match
+        self.shape_types = {}
+        self.name_surfs = {}
+        self.end_screen = None
+
+        for index in range(self.frames.max_shapes):
+            shape_type, name = ROSTER_ENTRY.unpack_from(self.frames.buf, ROSTER_OFFSET + index * ROSTER_ENTRY.size)
+            self.shape_types[index] = SHAPE_NAMES[shape_type]
+            self.name_surfs[index] = self.name_font.render(name.rstrip(b"\x00").decode("utf-8", "ignore"), True, (255, 255, 255), 15)
+
+    def write_input(self) -> None:
+        keys = pg.key.get_pressed()
+
+        move = ""
+        if keys[pg.K_UP] or keys[pg.K_w]: move = "u"
+        elif keys[pg.K_RIGHT] or keys[pg.K_d]: move = "r"
+        elif keys[pg.K_DOWN] or keys[pg.K_s]: move = "d"
+        elif keys[pg.K_LEFT] or keys[pg.K_a]: move = "l"
+
+        if not keys[pg.K_SPACE] and keys[pg.K_LSHIFT]:
+            self.popup = None
+
+        INPUT.pack_into(self.frames.buf, INPUT_OFFSET, MOVES.index(move), keys[pg.K_SPACE], self.spectator_steps, self.restarts, self.quit)
+
+    def play_sounds(self, sound_counts: tuple[int, int, int]) -> None:
+        if self.sound_counts is not None:
+            for name, count, last_count in zip(SOUNDS, sound_counts, self.sound_counts):
+                if count > last_count:
+                    self.sounds[name].play()
+
+        self.sound_counts = sound_counts
+
+    def draw_shape(self, shape: tuple, parent: tuple, friendly: bool) -> None:
+        """Shape.draw"""
+        index, rotation, x, y, hp, max_hp, shield, max_shield = shape
+        image = self.shape_sprites.variant(self.shape_types[index], friendly, rotation)
+
+        screen_rect = pg.Rect(parent[2] - self.WIDTH // 2 + image.width // 2, parent[3] - self.HEIGHT // 2 + image.height // 2, self.WIDTH, self.HEIGHT)
+        if not pg.Rect(x, y, image.width, image.height).colliderect(screen_rect): return
+
+        self.info_surf.fill((90, 90, 90))
+        pg.draw.rect(self.info_surf, (0, 255, 0), (0, 0, self.info_surf.width * hp / max_hp, self.info_surf.height // 2))
+        pg.draw.rect(self.info_surf, (0, 0, 255), (0, self.info_surf.height // 2, self.info_surf.width * shield / max_shield, self.info_surf.height // 2))
+
+        self.screen.blit(image, (x - screen_rect.x, y - screen_rect.y))
+        self.screen.blit(self.info_surf, (x - screen_rect.x - 100, y - screen_rect.y - 30))
+        self.screen.blit(self.name_surfs[index], (x - screen_rect.x - 100, y - screen_rect.y - 60))
+
+    def draw_safezone(self, walls: tuple[float, float, float, float], parent: tuple) -> None:
+        """Safezone.blit"""
+        left_wall, right_wall, top_wall, bottom_wall = walls[0] - parent[2], walls[1] - parent[2], walls[2] - parent[3], walls[3] - parent[3]
+
+        self.safezone_surf.fill((0, 0, 0))
+        self.safezone_surf.set_alpha(180)
+
+        pg.draw.rect(self.safezone_surf, (255, 0, 0), (0, 0, left_wall, self.HEIGHT))
+        pg.draw.rect(self.safezone_surf, (255, 0, 0), (right_wall, 0, self.WIDTH - right_wall, self.HEIGHT))
+        pg.draw.rect(self.safezone_surf, (255, 0, 0), (0, 0, self.WIDTH, top_wall))
+        pg.draw.rect(self.safezone_surf, (255, 0, 0), (0, bottom_wall, self.WIDTH, self.HEIGHT - bottom_wall))
+
+        self.screen.blit(self.safezone_surf, (0, 0))
+
+    def draw_popup(self, popup_time: float, popup_rarity: int, popup_name: int) -> None:
+        if popup_rarity == NO_POPUP:
+            return
+
+        if popup_time != self.popup_time:
+            rarity = RARITIES[popup_rarity]
+            name = list(self.powerup_info[rarity]["types"])[popup_name]
+            self.popup = Powerup(0, 0, rarity, self.powerup_info, None, 0, name).render_popup()
+            self.popup_time = popup_time
+
+        if self.popup is not None and time() - self.popup_time <= self.POPUP_DURATION:
+            self.screen.blit(self.popup, (self.WIDTH // 2 - self.popup.width // 2, self.HEIGHT - self.popup.height))
+
+    def draw_end_screen(self, winner_index: int, starting_index: int, winner_stats: tuple) -> None:
+        if self.end_screen is None:
+            shape_name = self.shape_types[winner_index]
+            winner = EndScreenShape(shape_name, self.shape_sprites.variant(shape_name, True), self.shape_sprites.variant(shape_name, False), winner_stats)
+            self.end_screen = EndScreen(self.screen, winner if winner_index == starting_index else None, winner)
+
+        self.end_screen.draw()
+
+    def draw(self, header: tuple, shapes: List[tuple], bullets: List[tuple], powerups: List[tuple]) -> None:
+        (sim_fps, _, _, _, followed, spectator_index, spectating, *walls) = header[:11]
+        sound_counts = header[11:14]
+        popup_time, popup_rarity, popup_name, winner_index, starting_index, show_end_screen = header[14:20]
+        winner_stats = header[20:]
+
+        self.play_sounds(sound_counts)
+
+        if show_end_screen:
+            self.draw_end_screen(winner_index, starting_index, winner_stats)
+            return
+
+        if followed < 0:
+            return
+
+        parent = shapes[followed]
+        self.screen.fill((0, 0, 0))
+        self.draw_safezone(walls, parent)
+
+        self.minimap_surf.fill((0, 0, 0))
+        for x, y, rarity in powerups:
+            image = self.powerup_images[RARITIES[rarity]]
+            screen_rect = pg.Rect(parent[2] - self.WIDTH // 2 + image.width // 2, parent[3] - self.HEIGHT // 2 + image.height // 2, self.WIDTH, self.HEIGHT)
+            if pg.Rect(x - image.width // 2, y - image.height // 2, image.width, image.height).colliderect(screen_rect):
+                self.screen.blit(image, (x - image.width // 2 - screen_rect.x, y - image.height // 2 - screen_rect.y))
+
+            self.minimap_surf.set_at((x / self.MAP_SIZE * 200, y / self.MAP_SIZE * 200), (255, 255, 255))
+
+        # Bullet.draw_all, the bullet image is 10x10
+        screen_rect = pg.Rect(parent[2] - self.WIDTH // 2 + 5, parent[3] - self.HEIGHT // 2 + 5, self.WIDTH, self.HEIGHT)
+        blits = []
+        for i in screen_rect.collidelistall([(x - 5, y - 5, 10, 10) for x, y, _ in bullets]):
+            x, y, radius = bullets[i]
+            radius = int(radius)
+            if radius >= 1:
+                blits.append((Bullet.sprite(radius), (x - screen_rect.x - radius, y - screen_rect.y - radius)))
+        self.screen.fblits(blits)
+
+        # Followed shape on top, like ShapeRoyale's draw pass
+        for shape in sorted(shapes, key=lambda shape: shape is parent):
+            self.draw_shape(shape, parent, shape is parent)
+
+        pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, (walls[0] - self.WIDTH / 2) / self.MAP_SIZE * 200, 200))
+        pg.draw.rect(self.minimap_surf, (255, 0, 0), ((walls[1]) / self.MAP_SIZE * 200, 0, 200, 200))
+        pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, 0, 200, (walls[2] - self.HEIGHT / 2) / self.MAP_SIZE * 200))
+        pg.draw.rect(self.minimap_surf, (255, 0, 0), (0, (walls[3] + self.HEIGHT / 2) / self.MAP_SIZE * 200, 200, 200))
+
+        pg.draw.rect(self.minimap_surf, (0, 0, 255), (parent[2] / self.MAP_SIZE * 200 - 1, parent[3] / self.MAP_SIZE * 200 - 1, 2, 2))
+
+        pg.draw.rect(self.screen, (255, 255, 255), (self.WIDTH - 252, 48, 204, 204), width=2)
+        self.screen.blit(self.minimap_surf, (self.WIDTH - 250, 50))
+
+        if spectating:
+            self.screen.blit(self.spectating_lbl, (self.WIDTH / 2 - self.spectating_lbl.width / 2, 50))
+        else:
+            self.draw_popup(popup_time, popup_rarity, popup_name)
+
+        self.screen.blit(self.fps_font.render(f"{self.clock.get_fps():.2f}", True, (255, 255, 255)), (20, 20))
+        self.screen.blit(self.fps_font.render(f"{spectator_index+1}/{len(shapes)}", True, (255, 255, 255)), (20, 40))
+        self.screen.blit(self.fps_font.render(f"sim {sim_fps:.2f}", True, (255, 255, 255)), (20, 60))
+
+    def main(self) -> None:
+        while not self.orphaned and not self.quit:
+            self.clock.tick(self.FPS)
+
+            frame = self.read()
+            spectating = frame is not None and frame[0][6]
+            show_end_screen = frame is not None and frame[0][19]
+
+            for event in pg.event.get():
+                if event.type == pg.QUIT:
+                    self.quit = True
+
+                if spectating and event.type == pg.MOUSEBUTTONDOWN:
+                    if event.button == 3:
+                        self.spectator_steps -= 1
+                    elif event.button == 1:
+                        self.spectator_steps += 1
+
+                if event.type == pg.KEYDOWN and event.key == pg.K_RETURN and show_end_screen:
+                    self.restarts += 1
+
+            self.write_input()
+
+            if self.orphaned:
+                break # The simulation is gone, don't hold up its shutdown with another frame
+
+            if frame is not None:
+                self.draw(*frame)
+
+            pg.display.flip()
+
+        self.frames.close()
+        pg.quit()
+
+if __name__ == "__main__":
+    FrameRenderer(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])).main()
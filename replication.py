@@ -0,0 +1,102 @@
+from math import hypot
+from time import time
+from typing import Dict, List, Tuple
+
+class ReplicationScheduler:
+    """Host only. Decides which shapes go into each client's snapshot.
+    Every tick each shape builds up priority for each client (more if it's close to them, has changed since they last got it or is shooting at them).
+    The highest ones are sent until the client's byte budget for the tick runs out and a sent shape's priority starts over,
+    so far away and idle shapes still get through, just less often. The client's own shape is always sent.
+    A client whose connection keeps up has no budget to speak of and gets every shape every tick."""
+
+    UNLIMITED_TICK_BUDGET = 4 * 1024 * 1024 # bytes, what a client gets per tick while nothing is backed up, more than a whole match takes
+    JSON_BYTES_PER_SECOND = 256 * 1024 # per client once its connection backs up, counted before compression so the wire usage is a lot lower
+    BACKLOG_SLACK = 8 * 1024 # bytes of write backlog that still count as keeping up, eg. reliable UDP packets waiting for their ack
+    MIN_TICK_BUDGET = 2048 # bytes, what a client gets per tick no matter how backed up it is
+
+    FAR_DISTANCE = 3000 # units, past this distance adds no priority
+    CHANGE_DISTANCE = 100 # units moved that count as a full change
+    SHOOTING_TIME = 0.5 # seconds since the last shot that still counts as shooting
+    SHOOTING_WIDTH = 300 # units either side of the line of fire
+
+    BASE_PRIORITY = 1.0
+    DISTANCE_WEIGHT = 4.0
+    CHANGE_WEIGHT = 2.0
+    SHOOTING_WEIGHT = 4.0
+
+    FIRE_DIRECTIONS = {0: (0, -1), 90: (-1, 0), 180: (0, 1), 270: (1, 0)} # rotation -> direction of Shape.shoot's bullets
+
+    def __init__(self, snapshot_rate: float, bytes_per_second: int = JSON_BYTES_PER_SECOND) -> None:
+        self.tick_budget = bytes_per_second / snapshot_rate
+
+        self.accumulators: Dict[any, Dict[int, float]] = {} # client -> shape index -> priority
+        self.last_sent: Dict[any, Dict[int, Tuple[float, float, float, float]]] = {} # client -> shape index -> (x, y, hp, shield) it was sent with
+
+    def budget(self, client: any) -> float:
+        """Bytes the client may get this tick. Once its connection backs up it's capped and shrinks further with the backlog,
+        so a slow client gets fewer shapes more often instead of a growing backlog"""
+        if client.write_backlog < self.BACKLOG_SLACK and not client.writing_paused:
+            return self.UNLIMITED_TICK_BUDGET
+
+        backlog = client.write_backlog / client.WRITE_BUFFER_HIGH
+        return max(self.MIN_TICK_BUDGET, self.tick_budget * (1 - backlog))
+
+    def priority(self, shape: any, viewer: object | None, last_sent: Tuple[float, float, float, float] | None, now: float) -> float:
+        priority = self.BASE_PRIORITY
+
+        if last_sent is None:
+            priority += self.CHANGE_WEIGHT
+        else:
+            x, y, hp, shield = last_sent
+            change = hypot(shape.x - x, shape.y - y) / self.CHANGE_DISTANCE + (hp != shape.hp or shield != shape.shield)
+            priority += min(change, 1) * self.CHANGE_WEIGHT
+
+        if viewer is None:
+            return priority # Spectating, distance means nothing
+
+        dx = viewer.x - shape.x
+        dy = viewer.y - shape.y
+        priority += max(0, 1 - hypot(dx, dy) / self.FAR_DISTANCE) * self.DISTANCE_WEIGHT
+
+        if now - shape.last_shoot_time < self.SHOOTING_TIME:
+            fire_x, fire_y = self.FIRE_DIRECTIONS.get(shape.rotation, (0, 0))
+            if dx * fire_x + dy * fire_y > 0 and abs(dx * fire_y - dy * fire_x) < self.SHOOTING_WIDTH:
+                priority += self.SHOOTING_WEIGHT
+
+        return priority
+
+    def select(self, client: any, viewer: object | None, shapes: List[any], sizes: Dict[int, int], budget: float) -> Tuple[List[any], float]:
+        """Returns the shapes to send to client this tick (viewer is its own shape, None if it's dead) and the bytes they use"""
+        now = time()
+        old_accumulator = self.accumulators.get(client, {})
+        last_sent = self.last_sent.setdefault(client, {})
+
+        # Rebuilt every tick so shapes that died drop out
+        accumulator = {shape.index: old_accumulator.get(shape.index, 0.0) + self.priority(shape, viewer, last_sent.get(shape.index), now) for shape in shapes}
+        self.accumulators[client] = accumulator
+
+        selected = []
+        used = 0
+        if viewer is not None:
+            selected.append(viewer)
+            used += sizes[viewer.index]
+
+        for shape in sorted(shapes, key=lambda shape: accumulator[shape.index], reverse=True):
+            if shape is viewer:
+                continue
+
+            if used + sizes[shape.index] > budget:
+                break
+
+            selected.append(shape)
+            used += sizes[shape.index]
+
+        for shape in selected:
+            accumulator[shape.index] = 0.0
+            last_sent[shape.index] = (shape.x, shape.y, shape.hp, shape.shield)
+
+        return selected, used
+
+    def remove(self, client: any) -> None:
+        self.accumulators.pop(client, None)
+        self.last_sent.pop(client, None)
@@ -10,7 +10,7 @@ from utils import FONTS_PATH, obj_dist
 from math import dist
 from random import randint
 from time import time
-from typing import List, Tuple, Dict
+from typing import Iterable, List, Tuple, Dict
 
 class Player:
     def __init__(self) -> None:
@@ -27,6 +27,44 @@ class Player:
         if self.ready: return pg.Color(0, 255, 0)
         else: return pg.Color(255, 0, 0)
 
+class ShapeSprites:
+    """Every variant a shape is drawn with, built once at load and shared by all shapes.
+    Keyed by shape name, allegiance (friendly or enemy), rotation and scale, shapes look theirs up instead of rotating copies every frame"""
+
+    ROTATIONS = (0, 90, 180, 270) # all a shape ever faces, see move_up etc
+    SCALE = 0.1 # of the sprite files
+    ASSETS_PATH = "../ShapeRoyale/Data/assets"
+
+    _instance = None
+
+    def __init__(self, shape_names: Iterable[str], scales: Iterable[float] = (SCALE,)) -> None:
+        self.variants: Dict[tuple[str, bool, int, float], pg.Surface] = {}
+
+        for shape_name in shape_names:
+            for friendly, sprite_name in ((True, "Player"), (False, "Enemy")):
+                image = pg.image.load(f"{self.ASSETS_PATH}/{shape_name}_Sprite_{sprite_name}.png")
+
+                for scale in scales:
+                    scaled_image = pg.transform.smoothscale_by(image, scale).convert_alpha()
+                    for rotation in self.ROTATIONS:
+                        self.variants[(shape_name, friendly, rotation, scale)] = pg.transform.rotate(scaled_image, rotation)
+
+    @classmethod
+    def get(cls, shape_names: Iterable[str]) -> "ShapeSprites":
+        """Loaded the first time, every match after that reuses them. Needs a display mode for convert_alpha"""
+        if cls._instance is None:
+            cls._instance = cls(shape_names)
+
+        return cls._instance
+
+    def variant(self, shape_name: str, friendly: bool, rotation: int = 0, scale: float = SCALE) -> pg.Surface:
+        key = (shape_name, friendly, rotation, scale)
+        if key not in self.variants:
+            # Never happens with ROTATIONS, but made once and kept rather than every frame if it does
+            self.variants[key] = pg.transform.rotate(self.variants[(shape_name, friendly, 0, scale)], rotation)
+
+        return self.variants[key]
+
 class Shape:
     POISON_DURATION = 10
 
@@ -46,7 +84,7 @@ class Shape:
         "damage_growth": float('inf')
     }
 
-    def __init__(self, map_size: int, x: float, y: float, index: int, shape_name: str, shape_info: Dict[str, Dict], shape_image: pg.Surface, enemy_shape_image: pg.Surface, bullets: List[Bullet],
+    def __init__(self, map_size: int, x: float, y: float, index: int, shape_name: str, shape_info: Dict[str, Dict], sprites: ShapeSprites, bullets: List[Bullet],
                  bullet_img: pg.Surface, is_player: bool, squad: List[any] = [], client: Client | None = None, player_name: str = "bot") -> None:
 
         self.map_size = map_size
@@ -60,10 +98,7 @@ class Shape:
         self.shape_info = shape_info
         self.info = self.shape_info[self.shape_name]
 
-        self.shape_image = shape_image
-        self.enemy_shape_image = enemy_shape_image
-        self.rotated_shape_image = shape_image.copy()
-        self.rotated_enemy_shape_image = enemy_shape_image.copy()
+        self.sprites = sprites
 
         self.bullet_img = bullet_img
 
@@ -99,6 +134,7 @@ class Shape:
 
         self.showing_powerup_popup = False
         self.powerup_popup = None
+        self.last_powerup = None # (rarity, name) the popup is for, what a render process needs to draw it again
         self.powerup_popup_create_time = time()
 
         self.rect = pg.Rect(0, 0, self.shape_image.width, self.shape_image.height)
@@ -124,10 +160,29 @@ class Shape:
         self.num_legendary_picked = 0
 
         self.last_update = time()
+        self.last_input_seq = 0
+        self.input_budget = 0.0 # seconds of this shape's client input the host will still simulate, see ShapeRoyale.apply_remote_inputs
+        self.input_budget_time = time()
+
+    @property
+    def shape_image(self) -> pg.Surface: return self.sprites.variant(self.shape_name, True)
+
+    @property
+    def enemy_shape_image(self) -> pg.Surface: return self.sprites.variant(self.shape_name, False)
+
+    @property
+    def rotated_shape_image(self) -> pg.Surface: return self.sprites.variant(self.shape_name, True, self.rotation)
+
+    @property
+    def rotated_enemy_shape_image(self) -> pg.Surface: return self.sprites.variant(self.shape_name, False, self.rotation)
 
     @property
     def global_rect(self) -> pg.Rect: return pg.Rect(self.x - self.rotated_shape_image.width * 0.5, self.y - self.rotated_shape_image.height * 0.5, self.rotated_shape_image.width, self.rotated_shape_image.height)
 
+    def set_player_name(self, player_name: str) -> None:
+        self.player_name = player_name
+        self.name_surf = self.name_font.render(f"{self.player_name}", True, (255, 255, 255), 15)
+
     def to_dict(self) -> dict[str, any]:
         return {
             "x": self.x, "y": self.y, "index": self.index, "shape_name": self.shape_name, "is_player": self.is_player, "squad": [], "player_name": self.player_name
@@ -245,6 +300,14 @@ class Shape:
         self.x -= self.max_speed * dt * 30
         self.rotation = 90
 
+    def apply_input(self, move: str, dt: float) -> None:
+        """Applies one frame of player movement input. move is one of "u", "r", "d", "l" or "" for no movement"""
+        match move:
+            case "u": self.move_up(dt)
+            case "r": self.move_right(dt)
+            case "d": self.move_down(dt)
+            case "l": self.move_left(dt)
+
     def move_to(self, x: float, y: float, dt: float) -> None:
         rx, ry = x - self.x, y - self.y
 
@@ -392,9 +455,6 @@ class Shape:
         self.give_hp(self.health_regen_rate * dt)
         self.give_shield_hp(self.shield_regen_rate * dt)
 
-        self.rotated_shape_image = pg.transform.rotate(self.shape_image, self.rotation)
-        self.rotated_enemy_shape_image = pg.transform.rotate(self.enemy_shape_image, self.rotation)
-
         self.render_info_surf()
 
     def draw(self, screen: pg.Surface, draw_parent: any) -> None:
@@ -0,0 +1,361 @@
+import atexit
+import os
+import struct
+import subprocess
+import sys
+
+from json import dumps
+from math import dist
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import time
+from typing import Dict, Generator, Iterable, List
+
+from keyframe import SHAPE_FLOAT_FIELDS
+from networking import encode_answer_list
+from replication import ReplicationScheduler
+
+# Host side snapshot encoding in worker processes. The game thread packs the shapes and bullets into fixed size records once per snapshot,
+# the workers pick what goes to each client, serialize and compress it on their own cores and hand the finished payloads back.
+# Both directions go through shared memory rings, nothing is pickled
+
+class SharedRing:
+    """Single producer, single consumer ring of variable length records in a SharedMemory block.
+    The first 24 bytes are the total bytes ever written and read and the records that didn't fit, each side only ever moves its own counters"""
+
+    POSITIONS = struct.Struct("<QQQ") # write position, read position, dropped records
+    LENGTH = struct.Struct("<I")
+    WRAP = 0xFFFFFFFF # length marking that the next record starts back at the beginning
+
+    def __init__(self, name: str | None = None, size: int = 0) -> None:
+        if name is None:
+            self.shm = SharedMemory(create=True, size=self.POSITIONS.size + size)
+            self.shm.buf[:self.POSITIONS.size] = bytes(self.POSITIONS.size)
+        else:
+            self.shm = SharedMemory(name=name)
+            # Only the creator unlinks, otherwise this process' resource tracker would remove the block when it exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.name = self.shm.name
+        self.data = self.shm.buf[self.POSITIONS.size:]
+        self.capacity = len(self.data)
+
+    def positions(self) -> tuple[int, int]:
+        return self.POSITIONS.unpack_from(self.shm.buf)[:2]
+
+    def dropped(self) -> int:
+        """Records push turned away"""
+        return self.POSITIONS.unpack_from(self.shm.buf)[2]
+
+    def push(self, record: bytes) -> bool:
+        """Producer side. False if the consumer is too far behind for the record to fit"""
+        write_pos, read_pos = self.positions()
+        needed = self.LENGTH.size + len(record)
+
+        offset = write_pos % self.capacity
+        padding = 0
+        if offset + needed > self.capacity:
+            padding = self.capacity - offset
+
+        if write_pos + padding + needed - read_pos > self.capacity:
+            struct.pack_into("<Q", self.shm.buf, 16, self.dropped() + 1)
+            return False
+
+        if padding > 0:
+            if padding >= self.LENGTH.size:
+                self.LENGTH.pack_into(self.data, offset, self.WRAP)
+
+            write_pos += padding
+            offset = 0
+
+        self.LENGTH.pack_into(self.data, offset, len(record))
+        self.data[offset + self.LENGTH.size:offset + needed] = record
+
+        # Published last, the consumer never sees a half written record
+        struct.pack_into("<Q", self.shm.buf, 0, write_pos + needed)
+        return True
+
+    def pop(self) -> bytes | None:
+        """Consumer side. The oldest record, None if there is nothing new"""
+        write_pos, read_pos = self.positions()
+
+        while read_pos < write_pos:
+            offset = read_pos % self.capacity
+            if self.capacity - offset < self.LENGTH.size:
+                read_pos += self.capacity - offset
+                continue
+
+            length, = self.LENGTH.unpack_from(self.data, offset)
+            if length == self.WRAP:
+                read_pos += self.capacity - offset
+                continue
+
+            record = bytes(self.data[offset + self.LENGTH.size:offset + self.LENGTH.size + length])
+            struct.pack_into("<Q", self.shm.buf, 8, read_pos + self.LENGTH.size + length)
+            return record
+
+        struct.pack_into("<Q", self.shm.buf, 8, read_pos)
+        return None
+
+    def close(self, unlink: bool = False) -> None:
+        self.data.release()
+        self.shm.close()
+
+        if unlink:
+            self.shm.unlink()
+
+# Request, game thread -> worker
+HEADER = struct.Struct("<dHHHH") # snapshot time, number of shapes, bullets, jobs and forgotten slots
+SHAPE = struct.Struct("<Hhddd" + "d" * len(SHAPE_FLOAT_FIELDS)) # index, rotation, x, y, last shot time, SHAPE_FLOAT_FIELDS
+BULLET = struct.Struct("<Hddddd") # parent index, x, y, velocity x, velocity y, damage
+JOB = struct.Struct("<IhBI") # slot, viewer shape index (-1 for none), full stream, byte budget
+SLOT = struct.Struct("<I")
+
+# Result, worker -> game thread
+RESULT = struct.Struct("<IB") # slot, message type
+RESULT_TYPES = ("player_update", "set_bullets")
+
+def pack_request(t: float, shapes: bytes, num_shapes: int, bullets: bytes, num_bullets: int, jobs: List[tuple[int, int, bool, int]], forgotten: List[int]) -> bytes:
+    return b"".join((
+        HEADER.pack(t, num_shapes, num_bullets, len(jobs), len(forgotten)), shapes, bullets,
+        b"".join(JOB.pack(*job) for job in jobs), b"".join(SLOT.pack(slot) for slot in forgotten)
+    ))
+
+class WorkerShape:
+    """A shape as the replication scheduler and the snapshot need it, unpacked from a SHAPE record"""
+
+    def __init__(self, record: tuple) -> None:
+        index, rotation, x, y, last_shoot_time, *values = record
+
+        self.index = index
+        self.rotation = rotation
+        self.x = x
+        self.y = y
+        self.last_shoot_time = last_shoot_time
+
+        full_dict = {"x": x, "y": y, "index": index, "rotation": rotation}
+        full_dict.update(zip(SHAPE_FLOAT_FIELDS, values))
+        self.hp = full_dict["hp"]
+        self.shield = full_dict["shield"]
+
+        self.item = dumps(full_dict)
+
+class SnapshotWorker:
+    """Runs in its own process, see SnapshotWorkerPool. Keeps the replication state of the clients it encodes for"""
+
+    def __init__(self, request_name: str, result_name: str, snapshot_rate: float) -> None:
+        self.requests = SharedRing(request_name)
+        self.results = SharedRing(result_name)
+        self.replication = ReplicationScheduler(snapshot_rate)
+
+    def encode(self, request: bytes) -> Generator:
+        t, num_shapes, num_bullets, num_jobs, num_forgotten = HEADER.unpack_from(request)
+        offset = HEADER.size
+
+        shapes = [WorkerShape(record) for record in SHAPE.iter_unpack(request[offset:offset + num_shapes * SHAPE.size])]
+        offset += num_shapes * SHAPE.size
+
+        bullets = []
+        for parent_index, x, y, velocity_x, velocity_y, damage in BULLET.iter_unpack(request[offset:offset + num_bullets * BULLET.size]):
+            bullets.append((x, y, dumps({"x": x, "y": y, "velocity": [velocity_x, velocity_y], "damage": damage, "parent_index": parent_index})))
+        offset += num_bullets * BULLET.size
+
+        jobs = list(JOB.iter_unpack(request[offset:offset + num_jobs * JOB.size]))
+        offset += num_jobs * JOB.size
+
+        for slot, in SLOT.iter_unpack(request[offset:offset + num_forgotten * SLOT.size]):
+            self.replication.remove(slot)
+
+        sizes = {shape.index: len(shape.item) + 2 for shape in shapes}
+        shapes_by_index = {shape.index: shape for shape in shapes}
+
+        for slot, viewer_index, full, budget in jobs:
+            if full:
+                yield slot, 0, encode_answer_list("player_update", [shape.item for shape in shapes], {"t": t})
+                yield slot, 1, encode_answer_list("set_bullets", [item for _, _, item in bullets])
+                continue
+
+            viewer = shapes_by_index.get(viewer_index)
+            selected, used = self.replication.select(slot, viewer, shapes, sizes, budget)
+            yield slot, 0, encode_answer_list("player_update", [shape.item for shape in selected], {"t": t})
+
+            if viewer is None:
+                continue
+
+            close_bullets = []
+            for _, _, item in sorted(bullets, key=lambda bullet: dist((bullet[0], bullet[1]), (viewer.x, viewer.y))):
+                used += len(item) + 2
+                if used > budget:
+                    break
+
+                close_bullets.append(item)
+
+            yield slot, 1, encode_answer_list("set_bullets", close_bullets)
+
+    def main(self) -> None:
+        # Every byte on stdin means there is something in the request ring, EOF means the host is gone
+        while sys.stdin.buffer.read(1):
+            while (request := self.requests.pop()) is not None:
+                for slot, mtype_id, payload in self.encode(request):
+                    # Dropped if the game thread is that far behind, the next snapshot replaces it anyway. The ring counts it for the pool's stats
+                    self.results.push(RESULT.pack(slot, mtype_id) + payload)
+
+        self.requests.close()
+        self.results.close()
+
+class SnapshotWorkerPool:
+    """Host side handle to the worker processes, shared by every match in the process like the NetworkLoop.
+    Clients are spread over the workers by slot, a number that stays with a connection for as long as it's alive"""
+
+    REQUEST_RING_SIZE = 4 * 1024 * 1024 # bytes, a few snapshots of 100 shapes and plenty of bullets
+    RESULT_RING_SIZE = 16 * 1024 * 1024 # bytes, a few ticks of finished payloads for every client
+    RESTART_INTERVAL = 1.0 # seconds, a worker that dies sooner than this after starting waits that long to be restarted
+
+    _instance = None
+
+    def __init__(self, num_workers: int, snapshot_rate: float) -> None:
+        self.snapshot_rate = snapshot_rate
+        self.workers = [self.start_worker() for _ in range(num_workers)]
+        self.start_times = [time() for _ in range(num_workers)]
+
+        self.slots: Dict[any, int] = {} # connection -> slot
+        self.clients: Dict[int, any] = {} # slot -> connection
+        self.next_slot = 0
+        self.forgotten: List[int] = []
+
+        self.submitted = 0
+        self.dropped = 0
+        self.encoded = 0
+        self.results_dropped = 0 # by workers that have since been restarted, the live ones count in their result ring
+        self.restarts = 0
+
+        atexit.register(self.shutdown)
+
+    @classmethod
+    def get(cls, num_workers: int, snapshot_rate: float) -> "SnapshotWorkerPool":
+        if cls._instance is None:
+            cls._instance = cls(num_workers, snapshot_rate)
+
+        return cls._instance
+
+    def start_worker(self) -> tuple[subprocess.Popen, SharedRing, SharedRing]:
+        requests = SharedRing(size=self.REQUEST_RING_SIZE)
+        results = SharedRing(size=self.RESULT_RING_SIZE)
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), requests.name, results.name, str(self.snapshot_rate)], stdin=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+
+        return process, requests, results
+
+    def restart_worker(self, i: int) -> bool:
+        """The worker process i has exited, replace it unless it only just started. Its clients' replication state starts over"""
+        if time() - self.start_times[i] < self.RESTART_INTERVAL:
+            return False
+
+        process, requests, results = self.workers[i]
+        print(f"SnapshotWorkerPool - Error while encoding! Worker exited with code {process.returncode}, restarting it.")
+
+        try:
+            process.stdin.close()
+        except OSError:
+            pass # Its end of the pipe is already gone
+
+        self.results_dropped += results.dropped()
+        requests.close(unlink=True)
+        results.close(unlink=True)
+
+        self.workers[i] = self.start_worker()
+        self.start_times[i] = time()
+        self.restarts += 1
+        return True
+
+    def slot(self, client: any) -> int:
+        if client not in self.slots:
+            self.slots[client] = self.next_slot
+            self.clients[self.next_slot] = client
+            self.next_slot += 1
+
+        return self.slots[client]
+
+    def forget(self, client: any) -> None:
+        """The connection is gone, its worker can drop its replication state"""
+        slot = self.slots.pop(client, None)
+        if slot is not None:
+            self.clients.pop(slot, None)
+            self.forgotten.append(slot)
+
+    def submit(self, t: float, shapes: Iterable[any], bullets: Iterable[any], jobs: List[tuple[any, object | None, bool, float]]) -> None:
+        """Game thread. jobs are (connection, shape it controls or None, whether it gets the full stream, byte budget)"""
+        shape_records = [
+            SHAPE.pack(shape.index, int(shape.rotation), shape.x, shape.y, shape.last_shoot_time, *(getattr(shape, field) for field in SHAPE_FLOAT_FIELDS))
+            for shape in shapes
+        ]
+        bullet_records = [
+            BULLET.pack(bullet.parent.index, bullet.x, bullet.y, bullet.velocity[0], bullet.velocity[1], bullet.base_damage) for bullet in bullets
+        ]
+        shape_data = b"".join(shape_records)
+        bullet_data = b"".join(bullet_records)
+
+        worker_jobs = [[] for _ in self.workers]
+        for client, viewer, full, budget in jobs:
+            slot = self.slot(client)
+            worker_jobs[slot % len(self.workers)].append((slot, viewer.index if viewer is not None else -1, full, int(budget)))
+
+        for i, jobs in enumerate(worker_jobs):
+            if len(jobs) == 0 and len(self.forgotten) == 0:
+                continue
+
+            if self.workers[i][0].poll() is not None and not self.restart_worker(i):
+                self.dropped += 1
+                continue
+
+            process, requests, _ = self.workers[i]
+
+            request = pack_request(t, shape_data, len(shape_records), bullet_data, len(bullet_records), jobs, self.forgotten)
+            if not requests.push(request):
+                self.dropped += 1
+                continue
+
+            self.submitted += 1
+            try:
+                process.stdin.write(b"\x01")
+                process.stdin.flush()
+            except OSError as e:
+                print(f"SnapshotWorkerPool - Error while waking a worker! {e}.")
+
+        self.forgotten = []
+
+    def results(self) -> Generator:
+        """Game thread. (connection, message type, payload) for every payload the workers have finished since the last call"""
+        for _, _, results in self.workers:
+            while (record := results.pop()) is not None:
+                slot, mtype_id = RESULT.unpack_from(record)
+                client = self.clients.get(slot)
+                self.encoded += 1
+
+                if client is not None:
+                    yield client, RESULT_TYPES[mtype_id], record[RESULT.size:]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "workers": len(self.workers), "submitted": self.submitted, "dropped": self.dropped, "encoded": self.encoded,
+            "results_dropped": self.results_dropped + sum(results.dropped() for _, _, results in self.workers), "restarts": self.restarts
+        }
+
+    def shutdown(self) -> None:
+        for process, requests, results in self.workers:
+            try:
+                process.stdin.close()
+                process.wait(timeout=1)
+            except Exception as e:
+                print(f"SnapshotWorkerPool - Error while stopping a worker! {e}.")
+                process.kill()
+
+            requests.close(unlink=True)
+            results.close(unlink=True)
+
+        self.workers = []
+
+if __name__ == "__main__":
+    SnapshotWorker(sys.argv[1], sys.argv[2], float(sys.argv[3])).main()
@@ -1,4 +1,5 @@
-from math import dist
+from math import dist, floor
+from typing import Dict, Iterable, List
 
 FONTS_PATH = "./UI/Fonts"
 
@@ -6,6 +7,29 @@ def obj_dist(obj1: object, obj2: object) -> float:
     """Returns the distance between 2 objects with x and y position properties"""
     return dist((obj1.x, obj1.y), (obj2.x, obj2.y))
 
+class SpatialGrid:
+    """Uniform grid broadphase over objects with x and y position properties, rebuilt whenever they have moved"""
+
+    def __init__(self, cell_size: float) -> None:
+        self.cell_size = cell_size
+        self.cells: Dict[tuple[int, int], List[object]] = {}
+
+    def rebuild(self, objects: Iterable[object]) -> None:
+        cells = {}
+        for obj in objects:
+            cells.setdefault((floor(obj.x / self.cell_size), floor(obj.y / self.cell_size)), []).append(obj)
+
+        self.cells = cells
+
+    def query(self, left: float, top: float, right: float, bottom: float) -> List[object]:
+        """Objects in every cell the area touches, so some may be just outside of it"""
+        found = []
+        for cell_y in range(floor(top / self.cell_size), floor(bottom / self.cell_size) + 1):
+            for cell_x in range(floor(left / self.cell_size), floor(right / self.cell_size) + 1):
+                found.extend(self.cells.get((cell_x, cell_y), ()))
+
+        return found
+
 class Anim:
     def __init__(self, obj: object, property: str, target: float, step: float, max_finish_dist: float) -> None:
         self.object = obj